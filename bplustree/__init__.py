@@ -1,7 +1,9 @@
 from .tree import BPlusTree
 from .serializer import (
-    IntSerializer, StrSerializer, UUIDSerializer, DatetimeUTCSerializer
+    IntSerializer, SignedIntSerializer, FloatSerializer, StrSerializer,
+    BytesSerializer, UUIDSerializer, DatetimeUTCSerializer
 )
 from .const import VERSION
+from .database import Database
 
 __version__ = VERSION
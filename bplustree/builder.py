@@ -0,0 +1,169 @@
+from typing import Callable, List, Optional, Tuple
+
+from .const import TreeConf
+from .entry import Record, Reference
+from .node import Node, LonelyRootNode, RootNode, InternalNode, LeafNode
+
+
+class _Level:
+    """Nodes of a level above the leaves that are not written yet.
+
+    The open node receives the children pushed to the level. Once full it
+    is kept aside until the next one is full too, so that the last node of
+    the level can take a child from it if it ends up with a single one.
+    """
+
+    __slots__ = ['separator', 'first_child', 'node', 'full']
+
+    def __init__(self, tree_conf: TreeConf):
+        # Key separating the first child of the open node from the last
+        # child of the previous node of the level
+        self.separator = None
+        self.first_child = None  # type: Optional[Tuple[int, int]]
+
+        # References between the children of the open node
+        self.node = InternalNode(tree_conf)
+
+        # Separator and references of the full node kept aside
+        self.full = None  # type: Optional[Tuple[object, List[Reference]]]
+
+    @property
+    def last_child(self) -> Tuple[int, int]:
+        if self.node.entries:
+            last = self.node.entries[-1]
+            return last.after, last.after_count
+        return self.first_child
+
+
+class TreeBuilder:
+    """Build a tree bottom-up from records given in key order.
+
+    Leaves are filled as much as their page allows and given to
+    `write_node` as soon as they are full, on pages taken in order from
+    `allocate_page`. Each written node is pushed to the level above it,
+    where internal nodes are written as soon as they are full. Only the
+    nodes being filled are kept in memory, about two per level.
+    """
+
+    def __init__(self, tree_conf: TreeConf, allocate_page: Callable[[], int],
+                 write_node: Callable[[Node], None]):
+        self._tree_conf = tree_conf
+        self._allocate_page = allocate_page
+        self._write_node = write_node
+        self._leaf = None
+
+        # Key separating the leaf being filled from the previous one
+        self._separator = None
+
+        # Levels above the leaves, from the lowest
+        self._levels = list()  # type: List[_Level]
+
+    def add(self, record: Record):
+        if self._leaf is None:
+            self._leaf = LeafNode(self._tree_conf, page=self._allocate_page())
+
+        self._leaf.insert_entry_at_the_end(record)
+        if not self._leaf.must_split or len(self._leaf.entries) == 1:
+            return
+
+        self._leaf.entries.pop()
+        full_leaf = self._leaf
+        self._leaf = LeafNode(self._tree_conf, page=self._allocate_page())
+        self._leaf.insert_entry_at_the_end(record)
+
+        full_leaf.next_page = self._leaf.page
+        self._write_node(full_leaf)
+        self._push(0, self._separator, full_leaf.page, len(full_leaf.entries))
+        self._separator = self._tree_conf.serializer.shortest_separator(
+            full_leaf.biggest_key, record.key
+        )
+
+    def finish(self) -> int:
+        """Write the last leaf and the internal nodes, return the root."""
+        if not self._levels:
+            root = LonelyRootNode(self._tree_conf)
+            if self._leaf is None:
+                root.page = self._allocate_page()
+            else:
+                root.page = self._leaf.page
+                root.entries = self._leaf.entries
+            self._write_node(root)
+            return root.page
+
+        self._write_node(self._leaf)
+        self._push(0, self._separator, self._leaf.page,
+                   len(self._leaf.entries))
+
+        # Write the nodes left at each level, the only node of the top
+        # level is the root
+        index = 0
+        while True:
+            level = self._levels[index]
+            if level.full is None and index == len(self._levels) - 1:
+                assert level.node.entries
+                return self._write_internal(RootNode, level.node.entries).page
+
+            if not level.node.entries:
+                # A node cannot have a single child, take one from the
+                # full node before it
+                self._move_last_child(level)
+            if level.full is not None:
+                self._close_full(index, level)
+            node = self._write_internal(InternalNode, level.node.entries)
+            self._push(index + 1, level.separator, node.page,
+                       node.subtree_count)
+            index += 1
+
+    def _push(self, index: int, separator, page: int, count: int):
+        """Add a written node as the last child of the level."""
+        if index == len(self._levels):
+            self._levels.append(_Level(self._tree_conf))
+        level = self._levels[index]
+
+        if level.first_child is None:
+            level.separator = separator
+            level.first_child = (page, count)
+            return
+
+        before, before_count = level.last_child
+        level.node.entries.append(Reference(
+            self._tree_conf, separator, before, page,
+            before_count=before_count, after_count=count
+        ))
+        if not level.node.must_split:
+            return
+
+        # The open node is full without its last child, which starts the
+        # next node of the level
+        level.node.entries.pop()
+        if level.full is not None:
+            self._close_full(index, level)
+        level.full = (level.separator, level.node.entries)
+        level.node.entries = list()
+        level.separator = separator
+        level.first_child = (page, count)
+
+    def _close_full(self, index: int, level: _Level):
+        separator, entries = level.full
+        level.full = None
+        node = self._write_internal(InternalNode, entries)
+        self._push(index + 1, separator, node.page, node.subtree_count)
+
+    def _move_last_child(self, level: _Level):
+        """Move the last child of the full node to the open node."""
+        _, entries = level.full
+        last = entries.pop()
+        assert entries
+        level.node.entries.insert(0, Reference(
+            self._tree_conf, level.separator, last.after,
+            level.first_child[0], before_count=last.after_count,
+            after_count=level.first_child[1]
+        ))
+        level.separator = last.key
+        level.first_child = (last.after, last.after_count)
+
+    def _write_internal(self, node_class, entries: List[Reference]) -> Node:
+        node = node_class(self._tree_conf, page=self._allocate_page())
+        node.entries = entries
+        self._write_node(node)
+        return node
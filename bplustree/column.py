@@ -38,4 +38,7 @@ class FloatCol(Column):
 
 class DateTimeCol(Column):
     def __init__(self, name, nullable=True, unique=False):
-        super().__init__(name, "datetime", 19, datetime.datetime.now(), nullable, unique) 
\ No newline at end of file
+        # stored as microseconds since the epoch
+        super().__init__(
+            name, "datetime", 8, datetime.datetime.now(), nullable, unique
+        )
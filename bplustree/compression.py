@@ -0,0 +1,113 @@
+from collections import namedtuple
+import lzma
+from typing import Callable, Optional
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .const import ENDIAN, NODE_TYPE_BYTES, USED_PAGE_LENGTH_BYTES
+
+# A compressed page starts with a byte that has this flag set, node types
+# stored in the first byte of raw pages are always smaller
+COMPRESSED_PAGE_FLAG = 0x80
+
+COMPRESSED_HEADER_LENGTH = NODE_TYPE_BYTES + USED_PAGE_LENGTH_BYTES
+
+Codec = namedtuple('Codec', [
+    'codec_id',    # Identifier stored with each compressed page
+    'name',        # Name used to select the codec
+    'compress',    # Function compressing bytes
+    'decompress',  # Function decompressing bytes
+])
+
+_codecs_by_id = dict()
+_codecs_by_name = dict()
+
+
+def register_codec(codec_id: int, name: str,
+                   compress: Callable[[bytes], bytes],
+                   decompress: Callable[[bytes], bytes]):
+    """Make a compression algorithm available to trees.
+
+    The id is stored in every page compressed with the codec, it must not
+    change once pages have been written with it.
+    """
+    if not 0 < codec_id < COMPRESSED_PAGE_FLAG:
+        raise ValueError('Codec id must be between 1 and {}'.format(
+            COMPRESSED_PAGE_FLAG - 1
+        ))
+    codec = Codec(codec_id, name, compress, decompress)
+    _codecs_by_id[codec_id] = codec
+    _codecs_by_name[name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return _codecs_by_name[name]
+    except KeyError:
+        raise ValueError('No compression codec named {}'.format(name))
+
+
+def compress_page(data: bytes, codec: Codec, page_size: int) -> bytes:
+    """Compress the data of a page.
+
+    The data is returned untouched when compressing it does not save space.
+    """
+    compressed = codec.compress(bytes(data))
+    length = COMPRESSED_HEADER_LENGTH + len(compressed)
+    if length >= page_size:
+        return data
+
+    return (
+        (COMPRESSED_PAGE_FLAG | codec.codec_id).to_bytes(NODE_TYPE_BYTES,
+                                                         ENDIAN) +
+        len(compressed).to_bytes(USED_PAGE_LENGTH_BYTES, ENDIAN) +
+        compressed
+    )
+
+
+def compressed_length(data: bytes) -> Optional[int]:
+    """Return the length of a compressed page, None for a raw page."""
+    if not data[0] & COMPRESSED_PAGE_FLAG:
+        return None
+    return COMPRESSED_HEADER_LENGTH + int.from_bytes(
+        data[NODE_TYPE_BYTES:COMPRESSED_HEADER_LENGTH], ENDIAN
+    )
+
+
+def decompress_page(data: bytes) -> bytes:
+    """Return the raw data of a page, compressed or not.
+
+    Compressed pages may be followed by garbage, it is ignored.
+    """
+    length = compressed_length(data)
+    if length is None:
+        return data
+
+    codec_id = data[0] & ~COMPRESSED_PAGE_FLAG
+    try:
+        codec = _codecs_by_id[codec_id]
+    except KeyError:
+        raise ValueError('Page compressed with unknown codec {}'.format(
+            codec_id
+        ))
+    return codec.decompress(data[COMPRESSED_HEADER_LENGTH:length])
+
+
+register_codec(1, 'zlib', zlib.compress, zlib.decompress)
+register_codec(2, 'lzma', lzma.compress, lzma.decompress)
+
+if lz4 is not None:
+    register_codec(3, 'lz4', lz4.frame.compress, lz4.frame.decompress)
+
+if zstandard is not None:
+    register_codec(4, 'zstd', zstandard.ZstdCompressor().compress,
+                   zstandard.ZstdDecompressor().decompress)
@@ -1,6 +1,10 @@
 from collections import namedtuple
 
-VERSION = '0.0.4.dev1'
+VERSION = '0.0.5.dev1'
+
+# Version of the format of the files, stored in their metadata. Files
+# written with another format cannot be opened
+FORMAT_VERSION = 1
 
 # Endianess for storing numbers
 ENDIAN = 'little'
@@ -20,12 +24,28 @@ USED_PAGE_LENGTH_BYTES = 3
 USED_KEY_LENGTH_BYTES = 2
 USED_VALUE_LENGTH_BYTES = 2
 
+# Bytes used for storing the number of records below a reference in
+# internal nodes
+SUBTREE_COUNT_BYTES = 4
+
+# Stored instead of the number of records below a reference when it is not
+# known
+UNKNOWN_SUBTREE_COUNT = 2 ** (8 * SUBTREE_COUNT_BYTES) - 1
+
+# Bytes used for storing the level of an overflow directory and the total
+# length of the value it points to
+OVERFLOW_LEVEL_BYTES = 1
+OVERFLOW_LENGTH_BYTES = 8
+
 # Max 256 types of frames
 FRAME_TYPE_BYTES = 1
 
 # Bytes used for storing general purpose integers like file metadata
 OTHERS_BYTES = 4
 
+# Bytes used for storing the offset of a page in the map of packed files
+PAGE_OFFSET_BYTES = 8
+
 USED_HEADER_PAGE_LENGTH = NODE_TYPE_BYTES + USED_PAGE_LENGTH_BYTES + PAGE_REFERENCE_BYTES * 2
 
 TreeConf = namedtuple('TreeConf', [
@@ -0,0 +1,339 @@
+from contextlib import contextmanager
+import json
+from typing import Iterator, List, Optional, Union
+
+from .column import Column, DateTimeCol
+from .const import TreeConf
+from .memory import FileMemory
+from .node import Node
+from .schema import Schema
+from .serializer import Serializer, StrSerializer
+from .tree import BPlusTree
+
+# The catalog maps names to JSON descriptions of the trees and tables, a
+# prefix keeps the names of trees and tables apart
+TREE_PREFIX = 'tree:'
+TABLE_PREFIX = 'table:'
+
+CATALOG_ORDER = 20
+CATALOG_KEY_SIZE = 64
+CATALOG_VALUE_SIZE = 128
+
+
+def column_to_dict(col: Column) -> dict:
+    rv = {
+        'name': col.name,
+        'type': col.type,
+        'length': col.length,
+        'nullable': col.nullable,
+        'unique': col.unique,
+    }
+    # Datetime columns get their default when they are created
+    if col.type != 'datetime':
+        rv['default'] = col.default
+    return rv
+
+
+def column_from_dict(data: dict) -> Column:
+    if data['type'] == 'datetime':
+        return DateTimeCol(data['name'], data['nullable'], data['unique'])
+    return Column(data['name'], data['type'], data['length'],
+                  data['default'], data['nullable'], data['unique'])
+
+
+class TreeMemory:
+    """Memory of a tree hosted in a Database, shared with the other trees.
+
+    Pages go through the cache, freelist and WAL of the database file and
+    are decoded with the configuration of the tree. The root of the tree is
+    kept in the catalog instead of the metadata page, and its transactions
+    are the ones of the database.
+    """
+
+    __slots__ = ['_database', '_name', '_mem', '_tree_conf']
+
+    def __init__(self, database: 'Database', name: str, tree_conf: TreeConf):
+        self._database = database
+        self._name = name
+        self._mem = database._mem
+        self._tree_conf = tree_conf
+
+    def get_node(self, page: int) -> Node:
+        return self._mem.get_node(page, self._tree_conf)
+
+    def get_nodes(self, pages) -> List[Node]:
+        return self._mem.get_nodes(pages, self._tree_conf)
+
+    def iter_chain(self, node: Node) -> Iterator[Node]:
+        return self._mem.iter_chain(node, self._tree_conf)
+
+    def set_node(self, node: Node):
+        self._mem.set_node(node)
+
+    def del_node(self, node: Node):
+        self._mem.del_node(node)
+
+    def del_page(self, page: int):
+        self._mem.del_page(page)
+
+    @property
+    def read_transaction(self):
+        return self._database.read_transaction
+
+    @property
+    def write_transaction(self):
+        return self._database.write_transaction
+
+    @property
+    def in_write_transaction(self) -> bool:
+        return self._mem.in_write_transaction
+
+    @property
+    def next_available_page(self) -> int:
+        return self._mem.next_available_page
+
+    @property
+    def last_page(self) -> int:
+        return self._mem.last_page
+
+    def get_free_pages(self) -> List[int]:
+        return self._mem.get_free_pages()
+
+    @property
+    def compression(self) -> Optional[str]:
+        return self._mem.compression
+
+    def get_metadata(self) -> tuple:
+        root_node_page, self._tree_conf = self._database._get_tree_metadata(
+            self._name, self._tree_conf
+        )
+        return root_node_page, self._tree_conf
+
+    def set_metadata(self, root_node_page: int, tree_conf: TreeConf):
+        self._database._set_tree_metadata(self._name, root_node_page,
+                                          tree_conf)
+        self._tree_conf = tree_conf
+
+    def perform_checkpoint(self, reopen_wal=False):
+        self._mem.perform_checkpoint(reopen_wal=reopen_wal)
+
+    def close(self):
+        """The file is closed with the database, not with its trees."""
+
+    def __repr__(self):
+        return '<TreeMemory: {} in {}>'.format(self._name, self._mem)
+
+
+class Database:
+    """Many trees and tables stored in a single file.
+
+    The file holds a tree of its own, the catalog, giving the root page and
+    configuration of every tree and the columns of every table. All trees
+    share the memory of the file: its cache, its freelist and its WAL. A
+    write transaction of the database can modify many trees, they are all
+    committed at once with a single fsync, or all rolled back.
+    """
+
+    __slots__ = ['_filename', '_catalog', '_mem', '_trees']
+
+    def __init__(self, filename: str, page_size: int=4096,
+                 cache_size: int=512, compression: Optional[str]=None,
+                 read_ahead: int=8):
+        self._filename = filename
+        self._catalog = BPlusTree(
+            filename, page_size=page_size, order=CATALOG_ORDER,
+            key_size=CATALOG_KEY_SIZE, value_size=CATALOG_VALUE_SIZE,
+            cache_size=cache_size, serializer=StrSerializer(),
+            compression=compression, read_ahead=read_ahead
+        )
+        self._mem = self._catalog._mem  # type: FileMemory
+
+        # Open trees by name, a tree is opened only once so that its root
+        # is not cached by many instances
+        self._trees = dict()
+
+    def close(self):
+        for tree in self._trees.values():
+            tree.close()
+        self._trees.clear()
+        self._catalog.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def checkpoint(self):
+        with self.write_transaction:
+            for tree in self._trees.values():
+                tree._write_counts()
+        self._catalog.checkpoint()
+
+    @property
+    def read_transaction(self):
+        return self._mem.read_transaction
+
+    @property
+    def write_transaction(self):
+        """Transaction spanning all the trees of the database.
+
+        Transactions of the trees started by the same thread within it are
+        part of it: they are committed when it ends. An error rolls back
+        all the trees.
+        """
+        return self._write_transaction()
+
+    def tree_memory(self, name: str, tree_conf: TreeConf) -> TreeMemory:
+        if tree_conf.page_size != self._mem._tree_conf.page_size:
+            raise ValueError('Trees of the database must use pages of {} '
+                             'bytes'.format(self._mem._tree_conf.page_size))
+        return TreeMemory(self, name, tree_conf)
+
+    def open_tree(self, name: str, order: int=100, key_size: int=8,
+                  value_size: int=32, serializer: Optional[Serializer]=None,
+                  split_policy: str='balanced',
+                  fill_factor: float=0.9) -> BPlusTree:
+        """Open a tree of the database, it is created if it does not exist.
+
+        The configuration of an existing tree is read from the catalog, only
+        its serializer must be given again.
+        """
+        tree = self._trees.get(name)
+        if tree is not None and tree._is_open:
+            return tree
+
+        self._check_name(TREE_PREFIX, name)
+
+        with self.write_transaction:
+            tree = BPlusTree(
+                name, page_size=self._mem._tree_conf.page_size, order=order,
+                key_size=key_size, value_size=value_size,
+                serializer=serializer, split_policy=split_policy,
+                fill_factor=fill_factor, database=self
+            )
+        self._trees[name] = tree
+        return tree
+
+    def tree_names(self) -> List[str]:
+        return self._catalog_names(TREE_PREFIX)
+
+    def create_table(self, table_name: str, columns: List[Column],
+                     key_col: Union[str, tuple, None]=None,
+                     custom_index=None, order: int=100) -> Schema:
+        """Create a table, its columns are kept in the catalog."""
+        # The table and its indexes are trees of the database
+        self._check_name(TABLE_PREFIX, table_name)
+        self._check_name(TREE_PREFIX, table_name)
+        for col_name, _ in custom_index or []:
+            self._check_name(TREE_PREFIX, table_name + '_' + col_name)
+
+        definition = {
+            'columns': [column_to_dict(col) for col in columns],
+            'key_col': key_col,
+            'custom_index': custom_index or [],
+            'order': order,
+        }
+        with self.write_transaction:
+            if self._catalog._get(TABLE_PREFIX + table_name) is not None:
+                raise ValueError('Table {} already exists'.format(table_name))
+            self._catalog._insert(TABLE_PREFIX + table_name,
+                                  json.dumps(definition).encode(),
+                                  replace=False)
+            return Schema(table_name, columns, key_col, custom_index, order,
+                          database=self)
+
+    def open_table(self, table_name: str) -> Schema:
+        """Open a table created earlier with the columns from the catalog."""
+        with self.read_transaction:
+            data = self._catalog._get(TABLE_PREFIX + table_name)
+        if data is None:
+            raise ValueError('Table {} does not exist'.format(table_name))
+
+        definition = json.loads(data.decode())
+        return Schema(
+            table_name,
+            [column_from_dict(col) for col in definition['columns']],
+            definition['key_col'],
+            [tuple(index) for index in definition['custom_index']],
+            definition['order'],
+            database=self
+        )
+
+    def table_names(self) -> List[str]:
+        return self._catalog_names(TABLE_PREFIX)
+
+    def __repr__(self):
+        return '<Database: {}>'.format(self._filename)
+
+    # ####################### Implementation ##############################
+
+    @contextmanager
+    def _write_transaction(self):
+        if self._mem.in_write_transaction:
+            yield
+            return
+
+        try:
+            with self._mem.write_transaction:
+                yield
+        except BaseException:
+            self._reload_roots()
+            raise
+
+    def _reload_roots(self):
+        """Forget the changes made to the roots by a rolled back transaction.
+
+        Trees created during the transaction are not in the catalog anymore,
+        they are dropped.
+        """
+        self._catalog._last_leaf = None
+        with self._mem.read_transaction:
+            self._catalog._root_node_page, _ = self._mem.get_metadata()
+            for name, tree in list(self._trees.items()):
+                tree._last_leaf = None
+                data = self._catalog._get(TREE_PREFIX + name)
+                if data is None:
+                    del self._trees[name]
+                else:
+                    tree._root_node_page = json.loads(data.decode())['root']
+
+    def _get_tree_metadata(self, name: str, tree_conf: TreeConf) -> tuple:
+        with self.read_transaction:
+            data = self._catalog._get(TREE_PREFIX + name)
+        if data is None:
+            raise ValueError('Tree {} not in the catalog'.format(name))
+
+        entry = json.loads(data.decode())
+        return entry['root'], TreeConf(
+            entry['page_size'], entry['order'], entry['key_size'],
+            entry['value_size'], tree_conf.serializer
+        )
+
+    def _set_tree_metadata(self, name: str, root_node_page: int,
+                           tree_conf: TreeConf):
+        entry = {
+            'root': root_node_page,
+            'page_size': tree_conf.page_size,
+            'order': tree_conf.order,
+            'key_size': tree_conf.key_size,
+            'value_size': tree_conf.value_size,
+        }
+        with self.write_transaction:
+            self._catalog._insert(TREE_PREFIX + name,
+                                  json.dumps(entry).encode(), replace=True)
+
+    def _check_name(self, prefix: str, name: str):
+        """Make sure that a name fits in the keys of the catalog."""
+        max_length = CATALOG_KEY_SIZE - len(prefix.encode())
+        if len(name.encode()) > max_length:
+            raise ValueError('Name {} is too long, names of trees and tables '
+                             'are limited to {} bytes'.format(name,
+                                                              max_length))
+
+    def _catalog_names(self, prefix: str) -> List[str]:
+        # Prefixes end with a colon, the next character ends their range
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self.read_transaction:
+            return [record.key[len(prefix):] for record in
+                    self._catalog._iter_slice(slice(prefix, end))]
@@ -1,8 +1,8 @@
 import abc
 from typing import Optional
 
-from .const import (ENDIAN, PAGE_REFERENCE_BYTES,
-                    USED_KEY_LENGTH_BYTES, USED_VALUE_LENGTH_BYTES, TreeConf)
+from .const import (ENDIAN, PAGE_REFERENCE_BYTES, USED_KEY_LENGTH_BYTES,
+                    USED_VALUE_LENGTH_BYTES, TreeConf)
 
 
 # Sentinel value indicating that a lazy loaded attribute is not yet loaded
@@ -22,7 +22,7 @@ class Entry(metaclass=abc.ABCMeta):
         """Serialize object to data."""
 
 
-class ComparableEntry(Entry, metaclass=abc.ABCMeta):
+class ComparableEntry(metaclass=abc.ABCMeta):
     """Entry that can be sorted against other entries based on their key."""
 
     __slots__ = []
@@ -43,8 +43,14 @@ class ComparableEntry(Entry, metaclass=abc.ABCMeta):
         return self.key >= other.key
 
 
-class Record(ComparableEntry):
-    """A container for the actual data the tree stores."""
+class Record(ComparableEntry, Entry):
+    """A container for the actual data the tree stores.
+
+    Records are serialized with a variable length, only the bytes actually
+    used by the key and the value are stored:
+
+    key length | key | value length | value | overflow page
+    """
 
     __slots__ = ['_tree_conf', 'length', '_key', '_value', '_overflow_page',
                  '_data']
@@ -53,6 +59,7 @@ class Record(ComparableEntry):
                  value: Optional[bytes]=None, data: Optional[bytes]=None,
                  overflow_page: Optional[int]=None):
         self._tree_conf = tree_conf
+        # Maximum length of a serialized record
         self.length = (
             USED_KEY_LENGTH_BYTES + self._tree_conf.key_size +
             USED_VALUE_LENGTH_BYTES + self._tree_conf.value_size +
@@ -69,6 +76,12 @@ class Record(ComparableEntry):
             self._value = value
             self._overflow_page = overflow_page
 
+    def _unload_data(self):
+        """Make sure all attributes are loaded before modifying one."""
+        if self._data:
+            self.load(self._data)
+        self._data = None
+
     @property
     def key(self):
         if self._key == NOT_LOADED:
@@ -77,9 +90,44 @@ class Record(ComparableEntry):
 
     @key.setter
     def key(self, v):
-        self._data = None
+        self._unload_data()
         self._key = v
 
+    @property
+    def key_bytes(self) -> bytes:
+        """Serialized key, taken from raw data without deserializing it."""
+        if self._data:
+            end_used_key_length = USED_KEY_LENGTH_BYTES
+            used_key_length = int.from_bytes(
+                self._data[0:end_used_key_length], ENDIAN
+            )
+            return self._data[end_used_key_length:
+                              end_used_key_length + used_key_length]
+        return self._tree_conf.serializer.serialize(
+            self.key, self._tree_conf.key_size
+        )
+
+    @property
+    def value_bytes(self) -> Optional[memoryview]:
+        """Value taken from raw data without loading the record.
+
+        Return a view over the raw data, or None for an overflowing value.
+        """
+        if not self._data:
+            return None if self.overflow_page else memoryview(self.value)
+
+        end_used_key_length = USED_KEY_LENGTH_BYTES
+        end_key = end_used_key_length + int.from_bytes(
+            self._data[0:end_used_key_length], ENDIAN
+        )
+        end_used_value_length = end_key + USED_VALUE_LENGTH_BYTES
+        end_value = end_used_value_length + int.from_bytes(
+            self._data[end_key:end_used_value_length], ENDIAN
+        )
+        if any(self._data[end_value:end_value + PAGE_REFERENCE_BYTES]):
+            return None
+        return memoryview(self._data)[end_used_value_length:end_value]
+
     @property
     def value(self):
         if self._value == NOT_LOADED:
@@ -88,7 +136,7 @@ class Record(ComparableEntry):
 
     @value.setter
     def value(self, v):
-        self._data = None
+        self._unload_data()
         self._value = v
 
     @property
@@ -99,11 +147,11 @@ class Record(ComparableEntry):
 
     @overflow_page.setter
     def overflow_page(self, v):
-        self._data = None
+        self._unload_data()
         self._overflow_page = v
 
     def load(self, data: bytes):
-        assert len(data) == self.length
+        assert len(data) <= self.length
 
         end_used_key_length = USED_KEY_LENGTH_BYTES
         used_key_length = int.from_bytes(data[0:end_used_key_length], ENDIAN)
@@ -114,23 +162,16 @@ class Record(ComparableEntry):
             data[end_used_key_length:end_key]
         )
 
-        start_used_value_length = (
-            end_used_key_length + self._tree_conf.key_size
-        )
-        end_used_value_length = (
-            start_used_value_length + USED_VALUE_LENGTH_BYTES
-        )
+        end_used_value_length = end_key + USED_VALUE_LENGTH_BYTES
         used_value_length = int.from_bytes(
-            data[start_used_value_length:end_used_value_length], ENDIAN
+            data[end_key:end_used_value_length], ENDIAN
         )
         assert 0 <= used_value_length <= self._tree_conf.value_size
 
         end_value = end_used_value_length + used_value_length
-
-        start_overflow = end_used_value_length + self._tree_conf.value_size
-        end_overflow = start_overflow + PAGE_REFERENCE_BYTES
+        end_overflow = end_value + PAGE_REFERENCE_BYTES
         overflow_page = int.from_bytes(
-            data[start_overflow:end_overflow], ENDIAN
+            data[end_value:end_overflow], ENDIAN
         )
 
         if overflow_page:
@@ -158,14 +199,15 @@ class Record(ComparableEntry):
         used_value_length = len(value)
 
         data = (
-            used_key_length.to_bytes(USED_VALUE_LENGTH_BYTES, ENDIAN) +
+            used_key_length.to_bytes(USED_KEY_LENGTH_BYTES, ENDIAN) +
             key_as_bytes +
-            bytes(self._tree_conf.key_size - used_key_length) +
             used_value_length.to_bytes(USED_VALUE_LENGTH_BYTES, ENDIAN) +
             value +
-            bytes(self._tree_conf.value_size - used_value_length) +
             overflow_page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
         )
+        # Keep the serialized record around, a Node is often dumped many
+        # times, setting any attribute forgets it
+        self._data = data
         return data
 
     def __repr__(self):
@@ -179,103 +221,50 @@ class Record(ComparableEntry):
 
 
 class Reference(ComparableEntry):
-    """A container for a reference to other nodes."""
+    """A container for a reference to other nodes.
+
+    Besides the pages before and after the key, a reference keeps the number
+    of records stored below each of these pages. References are not
+    serialized on their own: ReferenceNode stores all the references of a
+    node together, with their common key prefix written once.
+    """
 
-    __slots__ = ['_tree_conf', 'length', '_key', '_before', '_after', '_data']
+    __slots__ = ['_tree_conf', '_key', '_key_bytes', 'before', 'after',
+                 'before_count', 'after_count']
 
     def __init__(self, tree_conf: TreeConf, key=None, before=None, after=None,
-                 data: bytes=None):
+                 before_count: int=0, after_count: int=0,
+                 key_bytes: Optional[bytes]=None):
         self._tree_conf = tree_conf
-        self.length = (
-            2 * PAGE_REFERENCE_BYTES +
-            USED_KEY_LENGTH_BYTES +
-            self._tree_conf.key_size
-        )
-        self._data = data
-
-        if self._data:
-            self._key = NOT_LOADED
-            self._before = NOT_LOADED
-            self._after = NOT_LOADED
-        else:
-            self._key = key
-            self._before = before
-            self._after = after
+        # A serialized key is only deserialized when needed
+        self._key = key if key_bytes is None else NOT_LOADED
+        self._key_bytes = key_bytes
+        self.before = before
+        self.after = after
+        self.before_count = before_count
+        self.after_count = after_count
 
     @property
     def key(self):
         if self._key == NOT_LOADED:
-            self.load(self._data)
+            self._key = self._tree_conf.serializer.deserialize(
+                self._key_bytes
+            )
         return self._key
 
     @key.setter
     def key(self, v):
-        self._data = None
         self._key = v
+        self._key_bytes = None
 
     @property
-    def before(self):
-        if self._before == NOT_LOADED:
-            self.load(self._data)
-        return self._before
-
-    @before.setter
-    def before(self, v):
-        self._data = None
-        self._before = v
-
-    @property
-    def after(self):
-        if self._after == NOT_LOADED:
-            self.load(self._data)
-        return self._after
-
-    @after.setter
-    def after(self, v):
-        self._data = None
-        self._after = v
-
-    def load(self, data: bytes):
-        assert len(data) == self.length
-        end_before = PAGE_REFERENCE_BYTES
-        self._before = int.from_bytes(data[0:end_before], ENDIAN)
-
-        end_used_key_length = end_before + USED_KEY_LENGTH_BYTES
-        used_key_length = int.from_bytes(
-            data[end_before:end_used_key_length], ENDIAN
-        )
-        assert 0 <= used_key_length <= self._tree_conf.key_size
-
-        end_key = end_used_key_length + used_key_length
-        self._key = self._tree_conf.serializer.deserialize(
-            data[end_used_key_length:end_key]
-        )
-
-        start_after = end_used_key_length + self._tree_conf.key_size
-        end_after = start_after + PAGE_REFERENCE_BYTES
-        self._after = int.from_bytes(data[start_after:end_after], ENDIAN)
-
-    def dump(self) -> bytes:
-
-        if self._data:
-            return self._data
-
-        assert isinstance(self._before, int)
-        assert isinstance(self._after, int)
-
-        key_as_bytes = self._tree_conf.serializer.serialize(
-            self._key, self._tree_conf.key_size
-        )
-        used_key_length = len(key_as_bytes)
-
-        data = (
-            self._before.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN) +
-            used_key_length.to_bytes(USED_VALUE_LENGTH_BYTES, ENDIAN) +
-            key_as_bytes +
-            bytes(self._tree_conf.key_size - used_key_length) +
-            self._after.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN)
-        )
-        return data
+    def key_bytes(self) -> bytes:
+        """Serialized key, kept from the page it was read from."""
+        if self._key_bytes is None:
+            self._key_bytes = self._tree_conf.serializer.serialize(
+                self.key, self._tree_conf.key_size
+            )
+        return self._key_bytes
 
     def __repr__(self):
         return '<Reference: key={} before={} after={}>'.format(
@@ -1,25 +1,54 @@
 import enum
 import io
+import itertools
 from logging import getLogger
+import math
 import os
 import platform
-from typing import Union, Tuple, Optional
+import queue
+import threading
+from typing import Union, Tuple, Optional, Iterable, Iterator, List
 
 import cachetools
 import rwlock
 
-from .node import Node, FreelistNode
+from .compression import (
+    get_codec, compress_page, compressed_length, decompress_page
+)
+from .node import Node, FreelistNode, RecordNode, OverflowNode
 from .const import (
-    ENDIAN, PAGE_REFERENCE_BYTES, OTHERS_BYTES, TreeConf, FRAME_TYPE_BYTES
+    ENDIAN, PAGE_REFERENCE_BYTES, OTHERS_BYTES, TreeConf, FRAME_TYPE_BYTES,
+    USED_PAGE_LENGTH_BYTES, FORMAT_VERSION, PAGE_OFFSET_BYTES
 )
 
 logger = getLogger(__name__)
 
+HAS_PREAD = hasattr(os, 'pread')
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+
+# Number of pages followed through next_page before a chain of nodes is
+# considered as being scanned and read-ahead kicks in
+SCAN_DETECTION_PAGES = 2
+
+# Pages of packed files are stored on a whole number of cells, so that the
+# space freed by a page can be reused by pages of about the same length
+PACKED_CELL_SIZE = 64
+
+# Flag set in the metadata of packed files, followed by the location of
+# their page map
+METADATA_PACKED = 1
+PAGE_MAP_LOCATION_START = 2 * PAGE_REFERENCE_BYTES + 5 * OTHERS_BYTES
+PAGE_MAP_LOCATION_LENGTH = 2 * OTHERS_BYTES + PAGE_OFFSET_BYTES
+
 
 class ReachedEndOfFile(Exception):
     """Read a file until its end."""
 
 
+class UnsupportedFormat(Exception):
+    """File written with a format that this version cannot read."""
+
+
 def open_file_in_dir(path: str) -> Tuple[io.FileIO, Optional[int]]:
     """Open a file and its directory.
 
@@ -66,12 +95,23 @@ def fsync_file_and_dir(file_fileno: int, dir_fileno: Optional[int]):
 
 
 def read_from_file(file_fd: io.FileIO, start: int, stop: int) -> bytes:
+    """Read the bytes of a file between two offsets.
+
+    On platforms providing pread the position of the file is neither used
+    nor changed, so reads can happen from multiple threads at once.
+    """
     length = stop - start
     assert length >= 0
-    file_fd.seek(start)
+    if not HAS_PREAD:
+        file_fd.seek(start)
+
     data = bytes()
-    while file_fd.tell() < stop:
-        read_data = file_fd.read(stop - file_fd.tell())
+    while len(data) < length:
+        if HAS_PREAD:
+            read_data = os.pread(file_fd.fileno(), length - len(data),
+                                 start + len(data))
+        else:
+            read_data = file_fd.read(length - len(data))
         if read_data == b'':
             raise ReachedEndOfFile('Read until the end of file')
         data += read_data
@@ -79,6 +119,13 @@ def read_from_file(file_fd: io.FileIO, start: int, stop: int) -> bytes:
     return data
 
 
+def advise_will_need(file_fd: io.FileIO, start: int, length: int):
+    """Tell the OS that a part of a file will be read soon, if supported."""
+    if HAS_FADVISE:
+        os.posix_fadvise(file_fd.fileno(), start, length,
+                         os.POSIX_FADV_WILLNEED)
+
+
 class FakeCache:
     """A cache that doesn't cache anything.
 
@@ -95,103 +142,498 @@ class FakeCache:
         pass
 
 
+class PageMap:
+    """Location of the pages in a packed file.
+
+    A packed file stores the pages following the metadata page on as many
+    cells as their data needs instead of on slots of page_size bytes, so
+    compressed pages take less space on disk. The map gives the offset and
+    the length of the data of each page. It is stored in the file like the
+    pages, the metadata page gives its location:
+
+    offset | length    for each page from 1 to last_page
+
+    Pages are written where the map committed in the file does not point,
+    a crash before the new map is committed leaves the file as it was. For
+    the same reason the space of a rewritten page is only reused once the
+    map that does not use it anymore is committed.
+    """
+
+    __slots__ = ['_start', '_max_cells', '_pages', '_free', 'last_page',
+                 'extent', 'end', 'dirty']
+
+    ENTRY_LENGTH = PAGE_OFFSET_BYTES + USED_PAGE_LENGTH_BYTES
+
+    def __init__(self, page_size: int):
+        # Pages are stored after the metadata page
+        self._start = page_size
+        self._max_cells = self.cells(page_size)
+        self._pages = dict()  # Page -> offset and length
+
+        # Offsets of the free runs of cells between the used ones, by
+        # number of cells
+        self._free = dict()  # type: Dict[int, List[int]]
+
+        self.last_page = 0
+        self.extent = (page_size, 0)  # Map committed in the file
+        self.end = page_size  # End of the space used in the file
+        self.dirty = False
+
+    @staticmethod
+    def cells(length: int) -> int:
+        return math.ceil(length / PACKED_CELL_SIZE)
+
+    def load(self, data: bytes, extent: Tuple[int, int]):
+        for start in range(0, len(data), self.ENTRY_LENGTH):
+            end_offset = start + PAGE_OFFSET_BYTES
+            end_length = end_offset + USED_PAGE_LENGTH_BYTES
+            length = int.from_bytes(data[end_offset:end_length], ENDIAN)
+            if length:
+                offset = int.from_bytes(data[start:end_offset], ENDIAN)
+                self._pages[start // self.ENTRY_LENGTH + 1] = (offset, length)
+        self.last_page = len(data) // self.ENTRY_LENGTH
+        self.commit(extent)
+
+    def dump(self) -> bytes:
+        no_page = (0, 0)
+        return b''.join(
+            offset.to_bytes(PAGE_OFFSET_BYTES, ENDIAN) +
+            length.to_bytes(USED_PAGE_LENGTH_BYTES, ENDIAN)
+            for offset, length in (self._pages.get(page, no_page)
+                                   for page in range(1, self.last_page + 1))
+        )
+
+    def get(self, page: int) -> Optional[Tuple[int, int]]:
+        """Return the offset and the length of a page."""
+        return self._pages.get(page)
+
+    def allocate(self, length: int, before: Optional[int]=None
+                 ) -> Optional[int]:
+        """Return the offset of free space for data of a given length.
+
+        The smallest free run of cells that is long enough is used, the
+        end of the file otherwise. When the space must start before an
+        offset, None is returned if no free run fits.
+        """
+        cells = self.cells(length)
+        bigger = [size for size in self._free if size > self._max_cells]
+        for size in itertools.chain(range(cells, self._max_cells + 1),
+                                    bigger):
+            offsets = self._free.get(size)
+            if size < cells or not offsets:
+                continue
+            if before is not None and offsets[-1] >= before:
+                continue
+
+            offset = offsets.pop()
+            if not offsets:
+                del self._free[size]
+            self._add_free(offset + cells * PACKED_CELL_SIZE, size - cells)
+            return offset
+
+        if before is not None:
+            return None
+        offset = self.end
+        self.end += cells * PACKED_CELL_SIZE
+        return offset
+
+    def pages_after_used_space(self) -> List[Tuple[int, int, int]]:
+        """Return the offset, the length and the page of misplaced pages.
+
+        These pages are stored after the space all the pages and the map
+        would take in a file without free space, the last one first.
+        """
+        used = sum(self.cells(length) * PACKED_CELL_SIZE for _, length
+                   in itertools.chain(self._pages.values(), [self.extent]))
+        return sorted(((offset, length, page) for page, (offset, length)
+                       in self._pages.items()
+                       if offset >= self._start + used), reverse=True)
+
+    def set_page(self, page: int, offset: int, length: int):
+        self._pages[page] = (offset, length)
+        self.last_page = max(self.last_page, page)
+        self.dirty = True
+
+    def truncate(self, last_page: int):
+        """Forget the pages after last_page."""
+        for page in [page for page in self._pages if page > last_page]:
+            del self._pages[page]
+        self.last_page = last_page
+        self.dirty = True
+
+    def commit(self, extent: Tuple[int, int]):
+        """Record that the map is stored in the file at the given extent.
+
+        The free space of the file is found again from the pages in the
+        map, which gives back the space of the pages it does not use
+        anymore.
+        """
+        self.extent = extent
+        self.dirty = False
+        self._free = dict()
+        position = self._start
+        for offset, length in sorted(itertools.chain(self._pages.values(),
+                                                     [extent])):
+            if offset > position:
+                self._add_free(position,
+                               (offset - position) // PACKED_CELL_SIZE)
+            position = max(position,
+                           offset + self.cells(length) * PACKED_CELL_SIZE)
+        self.end = position
+
+        # Free runs at the start of the file are used first
+        for offsets in self._free.values():
+            offsets.reverse()
+
+    def _add_free(self, offset: int, cells: int):
+        if cells:
+            self._free.setdefault(cells, list()).append(offset)
+
+    def __repr__(self):
+        return '<PageMap: {} pages>'.format(len(self._pages))
+
+
 class FileMemory:
 
     __slots__ = ['_filename', '_tree_conf', '_lock', '_cache', '_fd',
                  '_dir_fd', '_wal', 'last_page', '_freelist_start_page',
-                 '_root_node_page']
+                 '_root_node_page', '_codec', '_page_lengths', '_read_ahead',
+                 '_writer', '_page_map']
 
     def __init__(self, filename: str, tree_conf: TreeConf,
-                 cache_size: int=512):
+                 cache_size: int=512, compression: Optional[str]=None,
+                 read_ahead: int=8):
         self._filename = filename
         self._tree_conf = tree_conf
         self._lock = rwlock.RWLock()
 
+        # Thread holding the write transaction, transactions it starts while
+        # holding it are nested in it
+        self._writer = None  # type: Optional[int]
+
+        # Number of nodes decoded in advance when a chain of nodes is
+        # scanned, 0 disables read-ahead. Without pread the thread reading
+        # ahead would move the position of the file under the other readers
+        self._read_ahead = read_ahead if HAS_PREAD else 0
+
+        # Leaf and overflow pages are compressed when written if a codec
+        # is given, pages are always decompressed when read
+        self._codec = None
+        if compression is not None:
+            self._codec = get_codec(compression)
+
+        # Files created with compression are packed, see PageMap. Pages of
+        # other files keep their slot of page_size bytes, only the length
+        # of the data stored in the slot of a compressed page is read
+        self._page_map = None  # type: Optional[PageMap]
+        self._page_lengths = dict()
+
         if cache_size == 0:
             self._cache = FakeCache()
         else:
             self._cache = cachetools.LRUCache(maxsize=cache_size)
 
+        self._freelist_start_page = 0
+
+        # Todo: Remove this, it should only be in Tree
+        self._root_node_page = 0
+
         self._fd, self._dir_fd = open_file_in_dir(filename)
 
         self._wal = WAL(filename, tree_conf.page_size)
+        self._page_map = self._load_page_map(compression is not None)
         if self._wal.needs_recovery:
             self.perform_checkpoint(reopen_wal=True)
 
         # Get the next available page
-        self._fd.seek(0, io.SEEK_END)
-        last_byte = self._fd.tell()
-        self.last_page = int(last_byte / self._tree_conf.page_size)
-        self._freelist_start_page = 0
+        self.last_page = self._get_last_page()
 
-        # Todo: Remove this, it should only be in Tree
-        self._root_node_page = 0
-
-    def get_node(self, page: int):
+    def get_node(self, page: int, tree_conf: Optional[TreeConf]=None):
         """Get a node from storage.
 
         The cache is not there to prevent hitting the disk, the OS is already
         very good at it. It is there to avoid paying the price of deserializing
         the data to create the Node object and its entry. This is a very
-        expensive operation in Python.
+        expensive operation in Python. Pages are cached decompressed, as
+        Nodes, so hot pages never go through decompression again.
 
         Since we have at most a single writer we can write to cache on
         `set_node` if we invalidate the cache when a transaction is rolled
         back.
+
+        Nodes are decoded with the configuration of the memory unless the
+        one of the tree owning the page is given, a file hosting many trees
+        shares its memory between them.
         """
         node = self._cache.get(page)
         if node is not None:
             return node
 
+        node = self._read_node(page, tree_conf)
+        self._cache[node.page] = node
+        return node
+
+    def get_nodes(self, pages: Iterable[int],
+                  tree_conf: Optional[TreeConf]=None) -> List[Node]:
+        """Get many nodes from storage at once, in the order of the pages.
+
+        Pages that are neither cached nor in the WAL are read from the file
+        with a single read for each run of pages stored one after the other.
+        """
+        pages = list(pages)
+        nodes = dict()
+        to_read = list()
+        for page in set(pages):
+            node = self._cache.get(page)
+            if node is not None:
+                nodes[page] = node
+                continue
+
+            data = self._wal.get_page(page)
+            if data:
+                nodes[page] = self._node_from_page_data(page, data, tree_conf)
+                self._cache[page] = nodes[page]
+            else:
+                to_read.append(page)
+
+        extents = sorted(self._page_extent(page) + (page, )
+                         for page in to_read)
+        run = list()
+        for i, (start, stop, page) in enumerate(extents):
+            run.append((start, stop, page))
+            # Only the padding of a cell can separate pages of a run
+            if (i + 1 < len(extents) and
+                    extents[i + 1][0] - stop < PACKED_CELL_SIZE):
+                continue
+
+            run_start = run[0][0]
+            data = read_from_file(self._fd, run_start, stop)
+            for start, stop, page in run:
+                page_data = data[start - run_start:stop - run_start]
+                if self._page_map is None:
+                    length = compressed_length(page_data)
+                    if length is not None:
+                        self._page_lengths[page] = length
+                nodes[page] = self._node_from_page_data(page, page_data,
+                                                        tree_conf)
+                self._cache[page] = nodes[page]
+            run = list()
+
+        return [nodes[page] for page in pages]
+
+    def iter_chain(self, node: Node,
+                   tree_conf: Optional[TreeConf]=None) -> Iterator[Node]:
+        """Yield a node and the ones following it through next_page.
+
+        Once the chain has been followed for a few pages it is considered
+        as being scanned: a worker thread then reads and decodes the next
+        pages ahead of the consumer, while the OS is asked to fetch the
+        page that comes after them.
+        """
+        yield node
+        followed = 0
+        while node.next_page:
+            if self._read_ahead and followed == SCAN_DETECTION_PAGES:
+                yield from self._iter_read_ahead(node.next_page, tree_conf)
+                return
+
+            node = self.get_node(node.next_page, tree_conf)
+            followed += 1
+            yield node
+
+    def _iter_read_ahead(self, page: int,
+                         tree_conf: Optional[TreeConf]) -> Iterator[Node]:
+        nodes = queue.Queue(maxsize=self._read_ahead)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._read_ahead_chain,
+                                  args=(page, nodes, stop, tree_conf),
+                                  daemon=True)
+        worker.start()
+        try:
+            while True:
+                node = nodes.get()
+                if node is None:
+                    return
+                if isinstance(node, Exception):
+                    raise node
+
+                # Nodes already cached may have been modified in memory
+                cached_node = self._cache.get(node.page)
+                if cached_node is None:
+                    self._cache[node.page] = node
+                else:
+                    node = cached_node
+                yield node
+        finally:
+            # Pages must not be read after the consumer is done, a writer
+            # may be waiting for it
+            stop.set()
+            worker.join()
+
+    def _read_ahead_chain(self, page: int, nodes: queue.Queue,
+                          stop: threading.Event,
+                          tree_conf: Optional[TreeConf]):
+        """Read nodes of a chain into a queue, in a worker thread.
+
+        The cache is not thread-safe, the worker does not touch it.
+        """
+        try:
+            while page and not stop.is_set():
+                node = self._read_node(page, tree_conf)
+                page = node.next_page
+                if page:
+                    self._advise_will_need(page)
+                self._put_until_stopped(nodes, node, stop)
+        except Exception as e:
+            self._put_until_stopped(nodes, e, stop)
+        else:
+            self._put_until_stopped(nodes, None, stop)
+
+    def _advise_will_need(self, page: int):
+        try:
+            start, stop = self._page_extent(page)
+        except ReachedEndOfFile:
+            # Page not checkpointed yet, it is read from the WAL
+            return
+        advise_will_need(self._fd, start, stop - start)
+
+    @staticmethod
+    def _put_until_stopped(nodes: queue.Queue, item, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                nodes.put(item, timeout=0.05)
+            except queue.Full:
+                continue
+            return
+
+    def _read_node(self, page: int,
+                   tree_conf: Optional[TreeConf]=None) -> Node:
+        """Read and decode a node without going through the cache."""
         data = self._wal.get_page(page)
         if not data:
             data = self._read_page(page)
 
-        node = Node.from_page_data(self._tree_conf, data=data, page=page)
-        self._cache[node.page] = node
-        return node
+        return self._node_from_page_data(page, data, tree_conf)
+
+    def _node_from_page_data(self, page: int, data: bytes,
+                             tree_conf: Optional[TreeConf]=None) -> Node:
+        data = decompress_page(data)
+        return Node.from_page_data(tree_conf or self._tree_conf,
+                                   data=data, page=page)
 
     def set_node(self, node: Node):
-        self._wal.set_page(node.page, node.dump())
+        self._wal.set_page(node.page, self._dump_node(node))
         self._cache[node.page] = node
 
+    def write_node(self, node: Node):
+        """Write a node directly in the file, bypassing the WAL and the cache.
+
+        Only meant for building a file that nobody else uses yet, the file
+        must be synced before being used.
+        """
+        self._write_page_in_tree(node.page, self._dump_node(node),
+                                 fsync=False)
+
+    def _dump_node(self, node: Node) -> bytes:
+        data = node.dump()
+        if self._codec and isinstance(node, (RecordNode, OverflowNode)):
+            data = compress_page(data, self._codec, self._tree_conf.page_size)
+        return data
+
+    @property
+    def compression(self) -> Optional[str]:
+        """Name of the codec compressing the pages written."""
+        return self._codec.name if self._codec else None
+
+    def replace_file(self, path: str):
+        """Atomically replace the file of the tree with another one.
+
+        Must be called within a write transaction, the WAL of the current
+        file is checkpointed and a new one is created for the new file.
+        """
+        self.perform_checkpoint()
+        self._fd.close()
+        os.replace(path, self._filename)
+        if self._dir_fd is not None:
+            os.fsync(self._dir_fd)
+            os.close(self._dir_fd)
+
+        self._fd, self._dir_fd = open_file_in_dir(self._filename)
+        self._wal = WAL(self._filename, self._tree_conf.page_size)
+        self._cache.clear()
+        self._page_lengths = dict()
+        self._page_map = None
+        self._page_map = self._load_page_map(False)
+        self.last_page = self._get_last_page()
+        self.get_metadata()
+
     def del_node(self, node: Node):
         self._insert_in_freelist(node.page)
 
     def del_page(self, page: int):
         self._insert_in_freelist(page)
 
+    @property
+    def in_write_transaction(self) -> bool:
+        """Whether the current thread holds the write transaction."""
+        return self._writer == threading.get_ident()
+
     @property
     def read_transaction(self):
 
         class ReadTransaction:
 
             def __enter__(self2):
-                self._lock.reader_lock.acquire()
+                # The writer reads within its own transaction
+                self2.nested = self.in_write_transaction
+                if not self2.nested:
+                    self._lock.reader_lock.acquire()
 
             def __exit__(self2, exc_type, exc_val, exc_tb):
-                self._lock.reader_lock.release()
+                if not self2.nested:
+                    self._lock.reader_lock.release()
 
         return ReadTransaction()
 
     @property
     def write_transaction(self):
+        """Transaction committed with a single fsync when it ends.
+
+        Write transactions started by the writer while it holds one are
+        nested in it: they commit or roll back with it.
+        """
 
         class WriteTransaction:
 
             def __enter__(self2):
+                self2.nested = self.in_write_transaction
+                if self2.nested:
+                    return
+
                 self._lock.writer_lock.acquire()
+                self._writer = threading.get_ident()
+                self2.state = (self.last_page, self._freelist_start_page,
+                               self._root_node_page, self._tree_conf)
 
             def __exit__(self2, exc_type, exc_val, exc_tb):
-                if exc_type:
-                    # When an error happens in the middle of a write
-                    # transaction we must roll it back and clear the cache
-                    # because the writer may have partially modified the Nodes
-                    self._wal.rollback()
-                    self._cache.clear()
-                else:
-                    self._wal.commit()
-                self._lock.writer_lock.release()
+                if self2.nested:
+                    return
+
+                try:
+                    if exc_type:
+                        # When an error happens in the middle of a write
+                        # transaction we must roll it back and clear the
+                        # cache because the writer may have partially
+                        # modified the Nodes
+                        self._wal.rollback()
+                        self._cache.clear()
+                        (self.last_page, self._freelist_start_page,
+                         self._root_node_page, self._tree_conf) = self2.state
+                    else:
+                        self._wal.commit()
+                finally:
+                    self._writer = None
+                    self._lock.writer_lock.release()
 
         return WriteTransaction()
 
@@ -204,6 +646,42 @@ class FileMemory:
         self.last_page += 1
         return self.last_page
 
+    def get_free_pages(self) -> List[int]:
+        """Return the pages of the freelist."""
+        pages = list()
+        page = self._freelist_start_page
+        while page:
+            pages.append(page)
+            page = self.get_node(page).next_page
+        return pages
+
+    def truncate(self, last_page: int):
+        """Remove the pages after last_page and empty the freelist.
+
+        Must be called at the end of a write transaction. The transaction is
+        committed and checkpointed before the file is truncated, the pages
+        removed or in the freelist must not be used anymore.
+        """
+        self._freelist_start_page = 0
+        self.set_metadata(None, None)
+        self._wal.commit()
+        self.perform_checkpoint(reopen_wal=True)
+
+        if self._page_map is not None:
+            # The space of the pages removed is given back when the map
+            # not using them anymore is committed
+            self._page_map.truncate(last_page)
+            self._commit_page_map(None)
+            self._move_pages_to_free_space()
+        else:
+            self._fd.truncate((last_page + 1) * self._tree_conf.page_size)
+            fsync_file_and_dir(self._fd.fileno(), self._dir_fd)
+        self.last_page = last_page
+        self._cache.clear()
+        self._page_lengths = {page: length for page, length
+                              in self._page_lengths.items()
+                              if page <= last_page}
+
     def _traverse_free_list(self) -> Tuple[Optional[FreelistNode],
                                            Optional[FreelistNode]]:
         if self._freelist_start_page == 0:
@@ -229,6 +707,7 @@ class FileMemory:
             self._freelist_start_page = page
             self.set_metadata(None, None)
         else:
+            last_node = last_node.copy()
             last_node.next_page = page
             self.set_node(last_node)
 
@@ -245,6 +724,7 @@ class FileMemory:
             self._freelist_start_page = 0
             self.set_metadata(None, None)
         else:
+            second_to_last_node = second_to_last_node.copy()
             second_to_last_node.next_page = None
             self.set_node(second_to_last_node)
 
@@ -252,10 +732,12 @@ class FileMemory:
 
     # Todo: make metadata as a normal Node
     def get_metadata(self) -> tuple:
-        try:
-            data = self._read_page(0)
-        except ReachedEndOfFile:
-            raise ValueError('Metadata not set yet')
+        data = self._wal.get_page(0)
+        if not data:
+            try:
+                data = self._read_page(0)
+            except ReachedEndOfFile:
+                raise ValueError('Metadata not set yet')
         end_root_node_page = PAGE_REFERENCE_BYTES
         root_node_page = int.from_bytes(
             data[0:end_root_node_page], ENDIAN
@@ -280,6 +762,17 @@ class FileMemory:
         self._freelist_start_page = int.from_bytes(
             data[end_value_size:end_freelist_start_page], ENDIAN
         )
+        end_format_version = end_freelist_start_page + OTHERS_BYTES
+        format_version = int.from_bytes(
+            data[end_freelist_start_page:end_format_version], ENDIAN
+        )
+        if format_version != FORMAT_VERSION:
+            # Files written before the format was versioned have a zero
+            raise UnsupportedFormat(
+                'File {} has format {}, only format {} is supported'.format(
+                    self._filename, format_version, FORMAT_VERSION
+                )
+            )
         self._tree_conf = TreeConf(
             page_size, order, key_size, value_size, self._tree_conf.serializer
         )
@@ -295,20 +788,31 @@ class FileMemory:
         if tree_conf is None:
             tree_conf = self._tree_conf
 
-        length = 2 * PAGE_REFERENCE_BYTES + 4 * OTHERS_BYTES
-        data = (
+        data = self._dump_metadata(root_node_page, tree_conf)
+        if self._writer is None:
+            self._write_page_in_tree(0, data, fsync=True)
+        else:
+            # Metadata changes are part of the transaction, they are rolled
+            # back with it
+            self._wal.set_page(0, data)
+
+        self._tree_conf = tree_conf
+        self._root_node_page = root_node_page
+
+    def _dump_metadata(self, root_node_page: int,
+                       tree_conf: TreeConf) -> bytes:
+        length = PAGE_MAP_LOCATION_START + PAGE_MAP_LOCATION_LENGTH
+        return (
             root_node_page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN) +
             tree_conf.page_size.to_bytes(OTHERS_BYTES, ENDIAN) +
             tree_conf.order.to_bytes(OTHERS_BYTES, ENDIAN) +
             tree_conf.key_size.to_bytes(OTHERS_BYTES, ENDIAN) +
             tree_conf.value_size.to_bytes(OTHERS_BYTES, ENDIAN) +
             self._freelist_start_page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN) +
+            FORMAT_VERSION.to_bytes(OTHERS_BYTES, ENDIAN) +
+            self._dump_page_map_location() +
             bytes(tree_conf.page_size - length)
         )
-        self._write_page_in_tree(0, data, fsync=True)
-
-        self._tree_conf = tree_conf
-        self._root_node_page = root_node_page
 
     def close(self):
         self.perform_checkpoint()
@@ -317,27 +821,190 @@ class FileMemory:
             os.close(self._dir_fd)
 
     def perform_checkpoint(self, reopen_wal=False):
+        """Transfer the pages of the WAL to the file and remove the WAL.
+
+        The WAL is only removed once its pages are synced in the file.
+        """
         logger.info('Performing checkpoint of %s', self._filename)
+        metadata = None
         for page, page_data in self._wal.checkpoint():
+            if page == 0 and self._page_map is not None:
+                # Written with the page map, it commits the checkpoint
+                metadata = page_data
+                continue
             self._write_page_in_tree(page, page_data, fsync=False)
-        fsync_file_and_dir(self._fd.fileno(), self._dir_fd)
+
+        if self._page_map is not None:
+            self._commit_page_map(metadata)
+        else:
+            # Compressed pages do not fill their whole page, the file is
+            # extended with a hole to keep the last page complete
+            self._fd.seek(0, io.SEEK_END)
+            page_size = self._tree_conf.page_size
+            end_of_pages = math.ceil(self._fd.tell() / page_size) * page_size
+            if self._fd.tell() < end_of_pages:
+                self._fd.truncate(end_of_pages)
+            fsync_file_and_dir(self._fd.fileno(), self._dir_fd)
+
+        self._wal.remove()
         if reopen_wal:
             self._wal = WAL(self._filename, self._tree_conf.page_size)
 
+    def _load_page_map(self, packed: bool) -> Optional[PageMap]:
+        """Load the page map of a packed file, None for other files.
+
+        A file without metadata yet is packed if asked to.
+        """
+        try:
+            data = self._read_page(0)
+        except ReachedEndOfFile:
+            data = self._wal.get_page(0)
+
+        if data:
+            end_flags = PAGE_MAP_LOCATION_START + OTHERS_BYTES
+            flags = int.from_bytes(
+                data[PAGE_MAP_LOCATION_START:end_flags], ENDIAN
+            )
+            packed = bool(flags & METADATA_PACKED)
+        if not packed:
+            return None
+
+        page_map = PageMap(self._tree_conf.page_size)
+        if data:
+            end_offset = end_flags + PAGE_OFFSET_BYTES
+            offset = int.from_bytes(data[end_flags:end_offset], ENDIAN)
+            end_length = end_offset + OTHERS_BYTES
+            length = int.from_bytes(data[end_offset:end_length], ENDIAN)
+            page_map.load(read_from_file(self._fd, offset, offset + length),
+                          (offset, length))
+        return page_map
+
+    def _dump_page_map_location(self, extent: Optional[Tuple[int, int]]=None
+                                ) -> bytes:
+        if self._page_map is None:
+            return bytes(PAGE_MAP_LOCATION_LENGTH)
+
+        offset, length = extent or self._page_map.extent
+        return (
+            METADATA_PACKED.to_bytes(OTHERS_BYTES, ENDIAN) +
+            offset.to_bytes(PAGE_OFFSET_BYTES, ENDIAN) +
+            length.to_bytes(OTHERS_BYTES, ENDIAN)
+        )
+
+    def _commit_page_map(self, metadata: Optional[bytes]):
+        """Write the page map of a packed file and the metadata locating it.
+
+        The metadata page is written last, once the pages and the map it
+        points to are synced: it commits them. The end of the file that
+        the new map does not use anymore is then cut.
+        """
+        if metadata is None:
+            if not self._page_map.dirty:
+                return
+            try:
+                metadata = self._read_page(0)
+            except ReachedEndOfFile:
+                # Pages written before the metadata was ever set
+                metadata = self._dump_metadata(self._root_node_page,
+                                               self._tree_conf)
+
+        data = self._page_map.dump()
+        extent = (self._page_map.allocate(len(data)), len(data))
+        self._fd.seek(extent[0])
+        write_to_file(self._fd, self._dir_fd, data, fsync=True)
+
+        end_location = PAGE_MAP_LOCATION_START + PAGE_MAP_LOCATION_LENGTH
+        metadata = (
+            metadata[:PAGE_MAP_LOCATION_START] +
+            self._dump_page_map_location(extent) +
+            metadata[end_location:]
+        )
+        self._write_page_in_tree(0, metadata, fsync=True)
+        self._page_map.commit(extent)
+
+        if os.fstat(self._fd.fileno()).st_size > self._page_map.end:
+            self._fd.truncate(self._page_map.end)
+            fsync_file_and_dir(self._fd.fileno(), self._dir_fd)
+
+    def _move_pages_to_free_space(self):
+        """Move the last pages of a packed file to the free space before them.
+
+        Pages are copied, the space they used is only given back, and the
+        end of the file cut, when the map pointing to the copies is
+        committed. This frees space for the pages that could not be moved
+        yet, so it goes on until the file stops shrinking.
+        """
+        while True:
+            end = self._page_map.end
+            for start, length, page in (
+                    self._page_map.pages_after_used_space()):
+                offset = self._page_map.allocate(length, before=start)
+                if offset is None:
+                    continue
+                data = read_from_file(self._fd, start, start + length)
+                self._fd.seek(offset)
+                write_to_file(self._fd, self._dir_fd, data, fsync=False)
+                self._page_map.set_page(page, offset, length)
+            self._commit_page_map(None)
+            if self._page_map.end >= end:
+                return
+
+    def _get_last_page(self) -> int:
+        if self._page_map is not None:
+            return self._page_map.last_page
+
+        self._fd.seek(0, io.SEEK_END)
+        return math.ceil(self._fd.tell() / self._tree_conf.page_size)
+
+    def _page_extent(self, page: int) -> Tuple[int, int]:
+        """Return the offsets where the data of a page starts and stops."""
+        if self._page_map is None or page == 0:
+            start = page * self._tree_conf.page_size
+            return start, start + self._tree_conf.page_size
+
+        location = self._page_map.get(page)
+        if location is None:
+            raise ReachedEndOfFile('Page {} is not in the file'.format(page))
+        start, length = location
+        return start, start + length
+
     def _read_page(self, page: int) -> bytes:
-        start = page * self._tree_conf.page_size
-        stop = start + self._tree_conf.page_size
-        assert stop - start == self._tree_conf.page_size
-        return read_from_file(self._fd, start, stop)
+        """Read the data of a page from the tree file.
+
+        Only the bytes actually used by compressed pages are read when their
+        length is known. The metadata page is never compressed, its first
+        byte is part of the root page and not a node type.
+        """
+        start, stop = self._page_extent(page)
+        if self._page_map is not None:
+            return read_from_file(self._fd, start, stop)
+
+        length = self._page_lengths.get(page, self._tree_conf.page_size)
+        data = read_from_file(self._fd, start, start + length)
+
+        if page != 0:
+            length = compressed_length(data)
+            if length is not None:
+                self._page_lengths[page] = length
+        return data
 
     def _write_page_in_tree(self, page: int, data: Union[bytes, bytearray],
                             fsync: bool=True):
         """Write a page of data in the tree file itself.
 
-        To be used during checkpoints and other non-standard uses.
+        To be used during checkpoints and other non-standard uses. Pages of
+        a packed file are written on free space and recorded in its map,
+        the map must be committed for them to be found after a reopen.
         """
-        assert len(data) == self._tree_conf.page_size
-        self._fd.seek(page * self._tree_conf.page_size)
+        assert len(data) <= self._tree_conf.page_size
+        if self._page_map is not None and page != 0:
+            start = self._page_map.allocate(len(data))
+            self._page_map.set_page(page, start, len(data))
+        else:
+            start = page * self._tree_conf.page_size
+            if page != 0:
+                self._page_lengths[page] = len(data)
+        self._fd.seek(start)
         write_to_file(self._fd, self._dir_fd, data, fsync=fsync)
 
     def __repr__(self):
@@ -355,8 +1022,10 @@ class WAL:
     __slots__ = ['filename', '_fd', '_dir_fd', '_page_size',
                  '_committed_pages', '_not_committed_pages', 'needs_recovery']
 
+    # Page data of a frame has a variable length since pages can be
+    # compressed
     FRAME_HEADER_LENGTH = (
-        FRAME_TYPE_BYTES + PAGE_REFERENCE_BYTES
+        FRAME_TYPE_BYTES + PAGE_REFERENCE_BYTES + USED_PAGE_LENGTH_BYTES
     )
 
     def __init__(self, filename: str, page_size: int):
@@ -377,20 +1046,26 @@ class WAL:
             self._load_wal()
 
     def checkpoint(self):
-        """Transfer the modified data back to the tree and close the WAL."""
+        """Yield the committed pages to transfer back to the tree.
+
+        The WAL must then be removed, but only once the pages are synced in
+        the tree.
+        """
         if self._not_committed_pages:
             logger.warning('Closing WAL with uncommitted data, discarding it')
 
         fsync_file_and_dir(self._fd.fileno(), self._dir_fd)
 
-        for page, page_start in self._committed_pages.items():
+        for page, (page_start, length) in self._committed_pages.items():
             page_data = read_from_file(
                 self._fd,
                 page_start,
-                page_start + self._page_size
+                page_start + length
             )
             yield page, page_data
 
+    def remove(self):
+        """Close and delete the WAL."""
         self._fd.close()
         os.unlink(self.filename)
         if self._dir_fd is not None:
@@ -403,39 +1078,38 @@ class WAL:
         write_to_file(self._fd, self._dir_fd, data, True)
 
     def _load_wal(self):
-        self._fd.seek(0)
         header_data = read_from_file(self._fd, 0, OTHERS_BYTES)
         assert int.from_bytes(header_data, ENDIAN) == self._page_size
 
+        start = OTHERS_BYTES
         while True:
             try:
-                self._load_next_frame()
+                start = self._load_next_frame(start)
             except ReachedEndOfFile:
                 break
         if self._not_committed_pages:
             logger.warning('WAL has uncommitted data, discarding it')
             self._not_committed_pages = dict()
 
-    def _load_next_frame(self):
-        start = self._fd.tell()
+    def _load_next_frame(self, start: int) -> int:
+        """Index the frame at start and return where the next one starts."""
         stop = start + self.FRAME_HEADER_LENGTH
         data = read_from_file(self._fd, start, stop)
 
         frame_type = int.from_bytes(data[0:FRAME_TYPE_BYTES], ENDIAN)
-        page = int.from_bytes(
-            data[FRAME_TYPE_BYTES:FRAME_TYPE_BYTES+PAGE_REFERENCE_BYTES],
-            ENDIAN
-        )
+        end_page = FRAME_TYPE_BYTES + PAGE_REFERENCE_BYTES
+        page = int.from_bytes(data[FRAME_TYPE_BYTES:end_page], ENDIAN)
+        length = int.from_bytes(data[end_page:self.FRAME_HEADER_LENGTH],
+                                ENDIAN)
 
         frame_type = FrameType(frame_type)
-        if frame_type is FrameType.PAGE:
-            self._fd.seek(stop + self._page_size)
-
-        self._index_frame(frame_type, page, stop)
+        self._index_frame(frame_type, page, stop, length)
+        return stop + length
 
-    def _index_frame(self, frame_type: FrameType, page: int, page_start: int):
+    def _index_frame(self, frame_type: FrameType, page: int, page_start: int,
+                     length: int):
         if frame_type is FrameType.PAGE:
-            self._not_committed_pages[page] = page_start
+            self._not_committed_pages[page] = (page_start, length)
         elif frame_type is FrameType.COMMIT:
             self._committed_pages.update(self._not_committed_pages)
             self._not_committed_pages = dict()
@@ -446,10 +1120,10 @@ class WAL:
 
     def _add_frame(self, frame_type: FrameType, page: Optional[int]=None,
                    page_data: Optional[bytes]=None):
-        if frame_type is FrameType.PAGE and (not page or not page_data):
+        if frame_type is FrameType.PAGE and (page is None or not page_data):
             raise ValueError('PAGE frame without page data')
-        if page_data and len(page_data) != self._page_size:
-            raise ValueError('Page data is different from page size')
+        if page_data and len(page_data) > self._page_size:
+            raise ValueError('Page data is bigger than page size')
         if not page:
             page = 0
         if frame_type is not FrameType.PAGE:
@@ -457,25 +1131,27 @@ class WAL:
         data = (
             frame_type.value.to_bytes(FRAME_TYPE_BYTES, ENDIAN) +
             page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN) +
+            len(page_data).to_bytes(USED_PAGE_LENGTH_BYTES, ENDIAN) +
             page_data
         )
         self._fd.seek(0, io.SEEK_END)
         write_to_file(self._fd, self._dir_fd, data,
                       fsync=frame_type != FrameType.PAGE)
-        self._index_frame(frame_type, page, self._fd.tell() - self._page_size)
+        self._index_frame(frame_type, page,
+                          self._fd.tell() - len(page_data), len(page_data))
 
     def get_page(self, page: int) -> Optional[bytes]:
-        page_start = None
+        frame = None
         for store in (self._not_committed_pages, self._committed_pages):
-            page_start = store.get(page)
-            if page_start:
+            frame = store.get(page)
+            if frame:
                 break
 
-        if not page_start:
+        if not frame:
             return None
 
-        return read_from_file(self._fd, page_start,
-                              page_start + self._page_size)
+        page_start, length = frame
+        return read_from_file(self._fd, page_start, page_start + length)
 
     def set_page(self, page: int, page_data: bytes):
         self._add_frame(FrameType.PAGE, page, page_data)
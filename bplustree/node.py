@@ -1,16 +1,21 @@
 import abc
 import bisect
+import copy
 import math
 from typing import Optional
 
+from . import utils
 from .const import (ENDIAN, NODE_TYPE_BYTES, USED_PAGE_LENGTH_BYTES,
-                    PAGE_REFERENCE_BYTES, TreeConf, USED_HEADER_PAGE_LENGTH)
+                    PAGE_REFERENCE_BYTES, TreeConf, USED_HEADER_PAGE_LENGTH,
+                    USED_KEY_LENGTH_BYTES, SUBTREE_COUNT_BYTES,
+                    UNKNOWN_SUBTREE_COUNT, OVERFLOW_LEVEL_BYTES,
+                    OVERFLOW_LENGTH_BYTES)
 from .entry import Entry, Record, Reference, OpaqueData
 
 
 class Node(metaclass=abc.ABCMeta):
 
-    __slots__ = ['_tree_conf', 'entries', 'page', 'parent', 'next_page', 'prev_page']
+    __slots__ = ['_tree_conf', 'entries', 'page', 'next_page', 'prev_page']
 
     # Attributes to redefine in inherited classes
     _node_type_int = 0
@@ -19,11 +24,10 @@ class Node(metaclass=abc.ABCMeta):
     _entry_class = None
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None, next_page: int=None, prev_page: int=None):
+                 page: int=None, next_page: int=None, prev_page: int=None):
         self._tree_conf = tree_conf
         self.entries = list()
         self.page = page
-        self.parent = parent
         self.next_page = next_page
         self.prev_page = prev_page
         if data:
@@ -52,36 +56,37 @@ class Node(metaclass=abc.ABCMeta):
 
         end_header = end_header + PAGE_REFERENCE_BYTES
 
-
         if self._entry_class is None:
             # For Nodes that cannot hold Entries
             return
 
-        try:
-            # For Nodes that can hold multiple sized Entries
-            entry_length = self._entry_class(self._tree_conf).length
-        except AttributeError:
-            # For Nodes that can hold a single variable sized Entry
-            entry_length = used_page_length - end_header
+        self._load_entries(data, end_header, used_page_length)
 
-        for start_offset in range(end_header, used_page_length, entry_length):
-            entry_data = data[start_offset:start_offset+entry_length]
-            entry = self._entry_class(self._tree_conf, data=entry_data)
-            self.entries.append(entry)
+    def _load_entries(self, data: bytes, start: int, stop: int):
+        """Deserialize the entries stored in data[start:stop].
 
-    def dump(self) -> bytearray:
+        By default a Node holds a single variable sized Entry.
+        """
+        if stop > start:
+            self.entries.append(
+                self._entry_class(self._tree_conf, data=data[start:stop])
+            )
+
+    def _dump_entries(self) -> bytearray:
+        """Serialize the entries to be stored after the page header."""
         data = bytearray()
         for record in self.entries:
             data.extend(record.dump())
+        return data
+
+    def dump(self) -> bytearray:
+        data = self._dump_entries()
 
         # used_page_length = len(header) + len(data), but the header is
         # generated later
         # header = note_type + used_page_length + next_page + prev_page
-        
         used_page_length = USED_HEADER_PAGE_LENGTH + len(data)
-        print("used_page_length", used_page_length)
-        print("self._tree_conf.page_size", self._tree_conf.page_size)
-        assert 0 < used_page_length 
+        assert 0 < used_page_length
         assert used_page_length <= self._tree_conf.page_size
         assert len(data) <= self.max_payload
 
@@ -116,6 +121,17 @@ class Node(metaclass=abc.ABCMeta):
     def can_add_entry(self) -> bool:
         return self.num_children < self.max_children
 
+    @property
+    def must_split(self) -> bool:
+        """Whether the node holds too much to be written in a single page.
+
+        Entries have variable lengths, so the number of entries a page can
+        carry depends on the entries themselves. The order of the tree is
+        only an upper limit.
+        """
+        return (self.num_children > self.max_children or
+                len(self._dump_entries()) > self.max_payload)
+
     @property
     def can_delete_entry(self) -> bool:
         return self.num_children > self.min_children
@@ -145,8 +161,19 @@ class Node(metaclass=abc.ABCMeta):
         """Remove and return the smallest entry."""
         return self.entries.pop(0)
 
-    def insert_entry(self, entry: Entry):
-        bisect.insort(self.entries, entry)
+    def insert_entry(self, entry: Entry) -> int:
+        """Insert an entry in order and return its index."""
+        if self._tree_conf.serializer.order_preserving:
+            i = utils.bisect_key_bytes(self.entries, entry.key_bytes,
+                                       right=True)
+        else:
+            i = bisect.bisect_right(self.entries, entry)
+        self.entries.insert(i, entry)
+        return i
+
+    def replace_entry(self, entry: Entry):
+        """Replace the entry that has the same key."""
+        self.entries[self._find_entry_index(entry.key)] = entry
 
     def insert_entry_at_the_end(self, entry: Entry):
         """Insert an entry at the end of the entry list.
@@ -162,27 +189,72 @@ class Node(metaclass=abc.ABCMeta):
     def get_entry(self, key) -> Entry:
         return self.entries[self._find_entry_index(key)]
 
-    def _find_entry_index(self, key) -> int:
+    def bisect_key(self, key, right: bool=False) -> int:
+        """Index where a key goes in the entries, like `bisect.bisect_left`.
+
+        When the serializer keeps the order of keys their serialized forms
+        are compared: entries read from a page are not deserialized.
+        """
+        serializer = self._tree_conf.serializer
+        if serializer.order_preserving:
+            key_bytes = serializer.serialize_search_key(
+                key, self._tree_conf.key_size
+            )
+            return utils.bisect_key_bytes(self.entries, key_bytes, right)
+
         entry = self._entry_class(
             self._tree_conf,
             key=key  # Hack to compare and order
         )
-        i = bisect.bisect_left(self.entries, entry)
-        if i != len(self.entries) and self.entries[i] == entry:
-            return i
+        if right:
+            return bisect.bisect_right(self.entries, entry)
+        return bisect.bisect_left(self.entries, entry)
+
+    def _find_entry_index(self, key) -> int:
+        serializer = self._tree_conf.serializer
+        if serializer.order_preserving:
+            key_bytes = serializer.serialize_search_key(
+                key, self._tree_conf.key_size
+            )
+            i = utils.bisect_key_bytes(self.entries, key_bytes)
+            if (i != len(self.entries) and
+                    self.entries[i].key_bytes == key_bytes):
+                return i
+        else:
+            entry = self._entry_class(
+                self._tree_conf,
+                key=key  # Hack to compare and order
+            )
+            i = bisect.bisect_left(self.entries, entry)
+            if i != len(self.entries) and self.entries[i] == entry:
+                return i
         raise ValueError('No entry for key {}'.format(key))
 
-    def split_entries(self) -> list:
-        """Split the entries in half.
+    def split_entries(self, index: Optional[int]=None) -> list:
+        """Split the entries at an index, in half by default.
 
         Keep the lower part in the node and return the upper one.
         """
         len_entries = len(self.entries)
-        rv = self.entries[len_entries//2:]
-        self.entries = self.entries[:len_entries//2]
+        if index is None:
+            index = len_entries // 2
+        rv = self.entries[index:]
+        self.entries = self.entries[:index]
         assert len(self.entries) + len(rv) == len_entries
         return rv
 
+    def copy(self) -> 'Node':
+        """Return a copy of the node that can be modified.
+
+        Nodes read from memory may be held by its cache, a writer modifies a
+        copy and gives it back with `set_node`. The copy has its own list of
+        entries but shares the entries themselves, node methods replace
+        entries rather than modifying them.
+        """
+        node = copy.copy(self)
+        node.entries = list(self.entries)
+        return node
+
     @classmethod
     def from_page_data(cls, tree_conf: TreeConf, data: bytes,
                        page: int=None) -> 'Node':
@@ -200,6 +272,8 @@ class Node(metaclass=abc.ABCMeta):
             return OverflowNode(tree_conf, data, page)
         elif node_type_int == 6:
             return FreelistNode(tree_conf, data, page)
+        elif node_type_int == 7:
+            return OverflowDirectoryNode(tree_conf, data, page)
         else:
             assert False, 'No Node with type {} exists'.format(node_type_int)
 
@@ -217,13 +291,61 @@ class Node(metaclass=abc.ABCMeta):
 
 
 class RecordNode(Node):
+    """Node holding records, stored in a slotted page.
+
+    Records have a variable length. The page starts with the number of
+    records and an array of their offsets in the page, followed by the
+    records packed one after the other:
+
+    number of records | offset 1 | offset 2 | ... | record 1 | record 2 | ...
+
+    The page is rebuilt from the entries every time it is written, so
+    the free space of a page is always in a single block at its end.
+    """
 
     __slots__ = ['_entry_class']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None, next_page: int=None, prev_page: int=None):
+                 page: int=None, next_page: int=None, prev_page: int=None):
         self._entry_class = Record
-        super().__init__(tree_conf, data, page, parent, next_page, prev_page)
+        super().__init__(tree_conf, data, page, next_page, prev_page)
+
+    def _load_entries(self, data: bytes, start: int, stop: int):
+        if stop <= start:
+            # Empty node
+            return
+
+        # Offsets within a page are stored like the used page length
+        end_num_records = start + USED_PAGE_LENGTH_BYTES
+        num_records = int.from_bytes(data[start:end_num_records], ENDIAN)
+        end_offsets = end_num_records + num_records * USED_PAGE_LENGTH_BYTES
+        offsets = [
+            int.from_bytes(data[i:i+USED_PAGE_LENGTH_BYTES], ENDIAN)
+            for i in range(end_num_records, end_offsets,
+                           USED_PAGE_LENGTH_BYTES)
+        ]
+        offsets.append(stop)
+
+        for start_offset, stop_offset in utils.pairwise(offsets):
+            self.entries.append(self._entry_class(
+                self._tree_conf, data=data[start_offset:stop_offset]
+            ))
+
+    def _dump_entries(self) -> bytearray:
+        data = bytearray()
+        if not self.entries:
+            return data
+
+        records = [entry.dump() for entry in self.entries]
+        data.extend(len(records).to_bytes(USED_PAGE_LENGTH_BYTES, ENDIAN))
+        offset = (USED_HEADER_PAGE_LENGTH +
+                  (len(records) + 1) * USED_PAGE_LENGTH_BYTES)
+        for record in records:
+            data.extend(offset.to_bytes(USED_PAGE_LENGTH_BYTES, ENDIAN))
+            offset += len(record)
+        for record in records:
+            data.extend(record)
+        return data
 
 
 class LonelyRootNode(RecordNode):
@@ -235,11 +357,11 @@ class LonelyRootNode(RecordNode):
     __slots__ = ['_node_type_int', 'min_children', 'max_children']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None):
+                 page: int=None):
         self._node_type_int = 1
         self.min_children = 0
         self.max_children = tree_conf.order - 1
-        super().__init__(tree_conf, data, page, parent)
+        super().__init__(tree_conf, data, page)
 
     def convert_to_leaf(self):
         leaf = LeafNode(self._tree_conf, page=self.page)
@@ -253,21 +375,32 @@ class LeafNode(RecordNode):
     __slots__ = ['_node_type_int', 'min_children', 'max_children']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None, next_page: int=None, prev_page: int=None):
+                 page: int=None, next_page: int=None, prev_page: int=None):
         self._node_type_int = 4
         self.min_children = math.ceil(tree_conf.order / 2) - 1
         self.max_children = tree_conf.order - 1
-        super().__init__(tree_conf, data, page, parent, next_page, prev_page)
+        super().__init__(tree_conf, data, page, next_page, prev_page)
 
 
 class ReferenceNode(Node):
+    """Node holding references, stored with a prefix compressed layout.
+
+    Keys of references are not stored in fixed size slots. The prefix
+    common to all keys is written once, followed by the first child and then
+    by each key suffix with the child after it:
+
+    prefix length | prefix | first page | first count |
+    suffix length | suffix | after page | after count | ...
+
+    The count of records below a child is None when it is not known.
+    """
 
     __slots__ = ['_entry_class']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None):
+                 page: int=None):
         self._entry_class = Reference
-        super().__init__(tree_conf, data, page, parent)
+        super().__init__(tree_conf, data, page)
 
     @property
     def num_children(self) -> int:
@@ -278,17 +411,123 @@ class ReferenceNode(Node):
 
         Probably very inefficient approach.
         """
-        super().insert_entry(entry)
-        i = self.entries.index(entry)
+        i = super().insert_entry(entry)
         if i > 0:
-            previous_entry = self.entries[i-1]
+            previous_entry = copy.copy(self.entries[i-1])
             previous_entry.after = entry.before
-        try:
-            next_entry = self.entries[i+1]
-        except IndexError:
-            pass
-        else:
+            previous_entry.after_count = entry.before_count
+            self.entries[i-1] = previous_entry
+        if i + 1 < len(self.entries):
+            next_entry = copy.copy(self.entries[i+1])
             next_entry.before = entry.after
+            next_entry.before_count = entry.after_count
+            self.entries[i+1] = next_entry
+        return i
+
+    def _load_entries(self, data: bytes, start: int, stop: int):
+        if stop <= start:
+            # Empty node
+            return
+
+        end_prefix_length = start + USED_KEY_LENGTH_BYTES
+        prefix_length = int.from_bytes(data[start:end_prefix_length], ENDIAN)
+        offset = end_prefix_length + prefix_length
+        prefix = data[end_prefix_length:offset]
+
+        before = int.from_bytes(
+            data[offset:offset+PAGE_REFERENCE_BYTES], ENDIAN
+        )
+        offset += PAGE_REFERENCE_BYTES
+        before_count = self._load_count(
+            data[offset:offset+SUBTREE_COUNT_BYTES]
+        )
+        offset += SUBTREE_COUNT_BYTES
+
+        while offset < stop:
+            suffix_length = int.from_bytes(
+                data[offset:offset+USED_KEY_LENGTH_BYTES], ENDIAN
+            )
+            offset += USED_KEY_LENGTH_BYTES
+            key_bytes = prefix + data[offset:offset+suffix_length]
+            offset += suffix_length
+            after = int.from_bytes(
+                data[offset:offset+PAGE_REFERENCE_BYTES], ENDIAN
+            )
+            offset += PAGE_REFERENCE_BYTES
+            after_count = self._load_count(
+                data[offset:offset+SUBTREE_COUNT_BYTES]
+            )
+            offset += SUBTREE_COUNT_BYTES
+
+            self.entries.append(self._entry_class(
+                self._tree_conf, before=before, after=after,
+                before_count=before_count, after_count=after_count,
+                key_bytes=key_bytes
+            ))
+            before, before_count = after, after_count
+
+    def _dump_entries(self) -> bytearray:
+        data = bytearray()
+        if not self.entries:
+            return data
+
+        keys = [entry.key_bytes for entry in self.entries]
+        prefix = utils.common_prefix(keys)
+        first_entry = self.entries[0]
+        data.extend(len(prefix).to_bytes(USED_KEY_LENGTH_BYTES, ENDIAN))
+        data.extend(prefix)
+        data.extend(first_entry.before.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN))
+        data.extend(self._dump_count(first_entry.before_count))
+
+        for entry, key in zip(self.entries, keys):
+            suffix = key[len(prefix):]
+            data.extend(len(suffix).to_bytes(USED_KEY_LENGTH_BYTES, ENDIAN))
+            data.extend(suffix)
+            data.extend(entry.after.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN))
+            data.extend(self._dump_count(entry.after_count))
+        return data
+
+    @staticmethod
+    def _load_count(data: bytes) -> Optional[int]:
+        count = int.from_bytes(data, ENDIAN)
+        return None if count == UNKNOWN_SUBTREE_COUNT else count
+
+    @staticmethod
+    def _dump_count(count: Optional[int]) -> bytes:
+        if count is None:
+            count = UNKNOWN_SUBTREE_COUNT
+        return count.to_bytes(SUBTREE_COUNT_BYTES, ENDIAN)
+
+    @property
+    def subtree_count(self) -> Optional[int]:
+        """Number of records stored below this node, None if not known."""
+        counts = [self.child_count(i) for i in range(self.num_children)]
+        if None in counts:
+            return None
+        return sum(counts)
+
+    def child_page(self, index: int) -> int:
+        """Return the page of the nth child node."""
+        if index == 0:
+            return self.entries[0].before
+        return self.entries[index - 1].after
+
+    def child_count(self, index: int) -> Optional[int]:
+        """Return the number of records stored below the nth child node."""
+        if index == 0:
+            return self.entries[0].before_count
+        return self.entries[index - 1].after_count
+
+    def set_child_count(self, index: int, count: Optional[int]):
+        """Set the number of records stored below the nth child node."""
+        if index > 0:
+            entry = copy.copy(self.entries[index - 1])
+            entry.after_count = count
+            self.entries[index - 1] = entry
+        if index < len(self.entries):
+            entry = copy.copy(self.entries[index])
+            entry.before_count = count
+            self.entries[index] = entry
 
 
 class RootNode(ReferenceNode):
@@ -297,11 +536,11 @@ class RootNode(ReferenceNode):
     __slots__ = ['_node_type_int', 'min_children', 'max_children']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None):
+                 page: int=None):
         self._node_type_int = 2
         self.min_children = 2
         self.max_children = tree_conf.order
-        super().__init__(tree_conf, data, page, parent)
+        super().__init__(tree_conf, data, page)
 
     def convert_to_internal(self):
         internal = InternalNode(self._tree_conf, page=self.page)
@@ -315,11 +554,11 @@ class InternalNode(ReferenceNode):
     __slots__ = ['_node_type_int', 'min_children', 'max_children']
 
     def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
-                 page: int=None, parent: 'Node'=None):
+                 page: int=None):
         self._node_type_int = 3
         self.min_children = math.ceil(tree_conf.order / 2)
         self.max_children = tree_conf.order
-        super().__init__(tree_conf, data, page, parent)
+        super().__init__(tree_conf, data, page)
 
 
 class OverflowNode(Node):
@@ -339,6 +578,70 @@ class OverflowNode(Node):
         )
 
 
+class OverflowDirectoryNode(Node):
+    """Node listing the pages holding a value too large for its Node.
+
+    The value is cut in slices of `slice_size` bytes stored in
+    OverflowNodes. A directory of level 0 lists these pages, a directory
+    of level n lists full directories of level n-1, except for the last
+    one. The entries of the Node are the page numbers:
+
+    level | length | page 1 | page 2 | ...
+
+    The length of the whole value is only stored in the top directory.
+    """
+
+    __slots__ = ['_node_type_int', '_entry_class', 'min_children',
+                 'max_children', 'level', 'length']
+
+    def __init__(self, tree_conf: TreeConf, data: Optional[bytes]=None,
+                 page: int=None, level: int=0, length: int=0):
+        self._node_type_int = 7
+        self._entry_class = int
+        self.level = level
+        self.length = length
+        self.max_children = (
+            (tree_conf.page_size - USED_HEADER_PAGE_LENGTH -
+             OVERFLOW_LEVEL_BYTES - OVERFLOW_LENGTH_BYTES) //
+            PAGE_REFERENCE_BYTES
+        )
+        self.min_children = 0
+        super().__init__(tree_conf, data, page)
+
+    @property
+    def slice_size(self) -> int:
+        """Number of bytes of the value held by each OverflowNode."""
+        return self.max_payload
+
+    @property
+    def span(self) -> int:
+        """Number of OverflowNodes below each page listed."""
+        return self.max_children ** self.level
+
+    def _load_entries(self, data: bytes, start: int, stop: int):
+        end_level = start + OVERFLOW_LEVEL_BYTES
+        end_length = end_level + OVERFLOW_LENGTH_BYTES
+        self.level = int.from_bytes(data[start:end_level], ENDIAN)
+        self.length = int.from_bytes(data[end_level:end_length], ENDIAN)
+        for offset in range(end_length, stop, PAGE_REFERENCE_BYTES):
+            self.entries.append(int.from_bytes(
+                data[offset:offset + PAGE_REFERENCE_BYTES], ENDIAN
+            ))
+
+    def _dump_entries(self) -> bytearray:
+        data = bytearray(self.level.to_bytes(OVERFLOW_LEVEL_BYTES, ENDIAN))
+        data.extend(self.length.to_bytes(OVERFLOW_LENGTH_BYTES, ENDIAN))
+        for page in self.entries:
+            data.extend(page.to_bytes(PAGE_REFERENCE_BYTES, ENDIAN))
+        return data
+
+    def __repr__(self):
+        return '<{}: page={} level={} length={} entries={}>'.format(
+            self.__class__.__name__, self.page, self.level, self.length,
+            len(self.entries)
+        )
+
+
 class FreelistNode(Node):
     """Node that is a marker for a deallocated page."""
 
@@ -1,44 +1,265 @@
+import array
+from contextlib import ExitStack, contextmanager
 import datetime
+import operator
 import struct
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from bplustree import BPlusTree
-from bplustree import IntSerializer
+from bplustree import BytesSerializer, FloatSerializer, SignedIntSerializer
+
+# struct format of each column type, strings are stored in their own
+# length, padded with null bytes
+STRUCT_FORMATS = {
+    "int": "q",
+    "boolean": "?",
+    "float": "d",
+    "datetime": "q",  # microseconds since the epoch
+}
+
+# python type of the values of each column type
+VALUE_TYPES = {
+    "int": int,
+    "string": str,
+    "boolean": bool,
+    "float": float,
+    "datetime": datetime.datetime,
+}
+
+# array typecode of the columns given as array.array in batches
+ARRAY_TYPECODES = {
+    "int": "q",
+    "boolean": "B",
+    "float": "d",
+}
+
+# numpy dtype of each column type, as stored in rows
+NUMPY_DTYPES = {
+    "int": ">i8",
+    "boolean": "?",
+    "float": ">f8",
+    "datetime": ">i8",
+}
+
+# value stored in the bytes of a column set to NULL
+NULL_VALUES = {
+    "int": 0,
+    "string": b"",
+    "boolean": False,
+    "float": 0.0,
+    "datetime": 0,
+}
+
+COMPARISONS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def datetime_to_micros(value: datetime.datetime) -> int:
+    # aware datetimes are stored in UTC, they are read back as naive ones
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def micros_to_datetime(value: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def encode_string(value: str) -> bytes:
+    return value.encode("utf-8")
+
+
+def decode_string(value: bytes) -> str:
+    return value.rstrip(b"\0").decode("utf-8")
+
+
+def encode_index_value(col, value) -> bytes:
+    # encode a column value to bytes that sort like the values, so that a
+    # secondary index can be walked in order and scanned by prefix
+    length = col.get_length()
+    if col.type == "int":
+        # negative integers sort first
+        return SignedIntSerializer().serialize(value, length)
+    elif col.type == "string":
+        return value.encode("utf-8").ljust(length, b"\0")
+    elif col.type == "boolean":
+        return int(value).to_bytes(length, "big")
+    elif col.type == "float":
+        return FloatSerializer().serialize(value, length)
+    elif col.type == "datetime":
+        # dates before the epoch are negative, they sort first
+        return SignedIntSerializer().serialize(
+            datetime_to_micros(value), length
+        )
+    else:
+        raise ValueError("Data type is not correct")
 
 
 class Schema:
     # custom index is a list of tuple (column_name, index_type)
     # index_type is always btree
-    # the key column will be use for indexing in btree
+    # the key column will be use for indexing in btree, a tuple of columns
+    # makes a composite key. Keys are stored encoded with
+    # encode_index_value, so the tree compares them as raw bytes
     # index col may not unique
+    # the trees are files in /tmp, unless a database is given: they are
+    # then trees of the database, see Database.create_table. Without a
+    # database the table and each index have their own WAL, a crash can
+    # leave them out of sync, tables with indexes should use a database
     def __init__(
-        self, table_name: str, columns: list, key_col: str, custom_index, order
+        self, table_name: str, columns: list, key_col: str, custom_index,
+        order, database=None,
     ):
         if len(columns) == 0:
             raise ValueError("Schema must have at least one column")
 
         if key_col is None:  # by default, the first column is key
             key_col = columns[0].name
+        if not isinstance(key_col, str):
+            key_col = tuple(key_col)
         self.key_col = key_col
+        self.key_cols = (
+            [key_col] if isinstance(key_col, str) else list(key_col)
+        )
         self.table_name = table_name
+        self.database = database
         self.columns = columns
         self.col_dict = {col.name: col for col in columns}
-        self.record_length = sum([col.get_length() for col in columns])
-        key_size = self.col_dict[key_col].get_length()
-        self.tree = BPlusTree(
-            "/tmp/" + table_name + ".db",
-            key_size=key_size,
+        self._compile_codec()
+        self._compile_validators()
+        for col_name in self.key_cols:
+            if col_name not in self.col_dict:
+                raise ValueError(
+                    "Key column {} does not exist".format(col_name)
+                )
+        self.key_length = sum(
+            self.col_dict[col_name].get_length() for col_name in self.key_cols
+        )
+        for col_name, index_type in custom_index or []:
+            if index_type != "btree":
+                raise ValueError(
+                    "Index type {} is not supported".format(index_type)
+                )
+            if col_name not in self.col_dict or col_name in self.key_cols:
+                raise ValueError("Cannot index column {}".format(col_name))
+        self.tree = self._open_tree(
+            table_name, ".db",
+            key_size=self.key_length,
             value_size=self.record_length,
             order=order,
-            serializer=IntSerializer(),
+            serializer=BytesSerializer(),
         )
 
+        # one tree per indexed column, its keys are the encoded column value
+        # followed by the primary key so that values do not need to be unique
+        self.indexes = {}
+        for col_name, _ in custom_index or []:
+            self.indexes[col_name] = self._open_tree(
+                table_name + "_" + col_name, ".idx",
+                key_size=(
+                    self.col_dict[col_name].get_length() + self.key_length
+                ),
+                value_size=self.key_length,
+                order=order,
+                serializer=BytesSerializer(),
+            )
+
     def __repr__(self):
         return "<Schema: table_name={} columns={}>".format(
             self.table_name, self.columns
         )
 
+    def _open_tree(self, name, suffix, **kwargs) -> BPlusTree:
+        if self.database is None:
+            return BPlusTree("/tmp/" + name + suffix, **kwargs)
+        return self.database.open_tree(name, **kwargs)
+
+    def close(self):
+        self.tree.close()
+        for index in self.indexes.values():
+            index.close()
+
+    @contextmanager
+    def transaction(self):
+        # hold the write transactions of the table and of all its indexes:
+        # inserts, updates and deletes made within it are committed together
+        # when it ends, an error rolls all of them back. In a database they
+        # all are the transaction of the database, committed once. Otherwise
+        # each file is committed on its own, one after the other: a crash
+        # in between keeps the changes of some of them only
+        with ExitStack() as stack:
+            for tree in [self.tree] + list(self.indexes.values()):
+                stack.enter_context(tree.transaction())
+            yield self
+
+    def encode_key(self, key, prefix=False) -> bytes:
+        # encode a primary key, a tuple for composite keys. With prefix, the
+        # first values of a composite key are enough
+        values = key if len(self.key_cols) > 1 else (key,)
+        if not isinstance(values, tuple):
+            raise ValueError("Composite keys must be tuples")
+        if len(values) > len(self.key_cols) or (
+            len(values) < len(self.key_cols) and not prefix
+        ):
+            raise ValueError(
+                "Key must have {} values".format(len(self.key_cols))
+            )
+        for value in values:
+            if value is None:
+                raise ValueError("Key value is None")
+        return b"".join(
+            encode_index_value(self.col_dict[col_name], value)
+            for col_name, value in zip(self.key_cols, values)
+        )
+
+    def _key_of(self, data: dict):
+        if len(self.key_cols) == 1:
+            return data[self.key_cols[0]]
+        return tuple(data[col_name] for col_name in self.key_cols)
+
+    def _index_key(self, col_name, data: dict) -> bytes:
+        return encode_index_value(
+            self.col_dict[col_name], data[col_name]
+        ) + self.encode_key(self._key_of(data))
+
+    def _add_to_index(self, col_name, data: dict):
+        # NULL values are not indexed
+        if data[col_name] is not None:
+            self.indexes[col_name]._insert(
+                self._index_key(col_name, data),
+                self.encode_key(self._key_of(data)),
+                replace=False,
+            )
+
+    def _remove_from_index(self, col_name, data: dict):
+        if data[col_name] is not None:
+            self.indexes[col_name]._delete(self._index_key(col_name, data))
+
+    def _compile_validators(self):
+        # checks of each column computed once, instead of for every row
+        self._not_null_columns = [
+            col for col in self.columns if not col.nullable
+        ]
+        self._validators = []
+        for col in self.columns:
+            max_length = col.length if col.type == "string" else None
+            self._validators.append(
+                (col.name, VALUE_TYPES[col.type], max_length)
+            )
+
     def get_not_null_columns(self):
-        return [col for col in self.columns if not col.nullable]
+        return list(self._not_null_columns)
 
     def assign_default_value(self, data: dict):
         for col in self.columns:
@@ -46,81 +267,392 @@ class Schema:
                 data[col.name] = col.default
 
     def validate_not_null_cols(self, data: dict):
-        not_null_cols = self.get_not_null_columns()
-        for col in not_null_cols:
+        for col in self._not_null_columns:
             if col.name not in data or data[col.name] is None:
                 raise ValueError("Column {} is not nullable".format(col.name))
 
     def validate_data_is_valid(self, data: dict):
         # check type
-        for col in self.columns:
-            if col.name not in data:
+        for name, value_type, max_length in self._validators:
+            if name not in data:
                 raise ValueError("Data is not complete")
-            if col.type == "int":
-                if not isinstance(data[col.name], int):
-                    raise ValueError("Data type is not correct")
-            elif col.type == "string":
-                if not isinstance(data[col.name], str):
-                    raise ValueError("Data type is not correct")
-                if len(data[col.name]) > col.length:
-                    raise ValueError("Data length is not correct")
-            elif col.type == "boolean":
-                if not isinstance(data[col.name], bool):
-                    raise ValueError("Data type is not correct")
-            elif col.type == "float":
-                if not isinstance(data[col.name], float):
-                    raise ValueError("Data type is not correct")
-            elif col.type == "datetime":
-                if not isinstance(data[col.name], datetime.datetime):
-                    raise ValueError("Data type is not correct")
-            else:
+            value = data[name]
+            if value is None:
+                # not null columns are checked by validate_not_null_cols
+                continue
+            if not isinstance(value, value_type):
                 raise ValueError("Data type is not correct")
-    def serilize_record(self, data: dict) -> bytes:
-        # data = {"id": 1, "name": "John", "is_active": True, "salary": 1000.0, "created_at": datetime.datetime.now()}
-        # use column length to serilize the data
-        # return b'1JohnTrue1000.0'
-        bytes = b''
-        for col in self.columns: 
-            length = col.get_length() 
-            if col.type == "int":
-                bytes += data[col.name].to_bytes(length, "big")
-            elif col.type == "string":
-                bytes += data[col.name].encode("utf-8")
-                bytes += b' ' * (length - len(data[col.name]))
-            elif col.type == "boolean":
-                bytes += int(data[col.name]).to_bytes(length, "big")
-            elif col.type == "float":
-                  bytes += struct.pack('d', data[col.name])
+            if (max_length is not None and
+                    len(value.encode("utf-8")) > max_length):
+                raise ValueError("Data length is not correct")
+
+    def _compile_codec(self):
+        # rows start with a bitmap of the columns set to NULL, followed by
+        # the columns at fixed offsets. They are packed and unpacked by a
+        # single struct, only strings and datetimes need to be converted
+        # before or after
+        self._col_names = [col.name for col in self.columns]
+        self._bitmap_length = (len(self.columns) + 7) // 8
+        self._encoders = []
+        self._fields = {}
+        offset = self._bitmap_length
+        for i, col in enumerate(self.columns):
+            if col.type == "string":
+                self._encoders.append((i, encode_string))
             elif col.type == "datetime":
-                bytes += data[col.name].strftime("%Y-%m-%d %H:%M:%S").encode("utf-8")
-            else:
-                raise ValueError("Data type is not correct")
-        return bytes
-    def deserialize_record(self, bytes: bytes) -> dict:
-        # byte value b'1JohnTrue1000.0'
-        # reurn data = {"id": 1, "name": "John", "is_active": True, "salary": 1000.0, "created_at": datetime.datetime.now()}
-        data = {}
-        start = 0
-        for col in self.columns:
-            length = col.get_length()
-            if col.type == "int":
-                data[col.name] = int.from_bytes(bytes[start:start+length], "big")
-            elif col.type == "string":
-                data[col.name] = bytes[start:start+length].decode("utf-8").strip()
-            elif col.type == "boolean":
-                data[col.name] = bool.from_bytes(bytes[start:start+length], "big")
-            elif col.type == "float":
-                data[col.name] = struct.unpack('d', bytes[start:start+length])[0]
+                self._encoders.append((i, datetime_to_micros))
+            # offset and struct of the column alone, to read it from a row
+            self._fields[col.name] = (
+                offset, struct.Struct(">" + self._col_format(col))
+            )
+            offset += col.get_length()
+
+        self._projections = {}
+        self._row_struct, _, _, _ = self._get_projection(None)
+        self.record_length = self._row_struct.size
+
+    def _col_format(self, col) -> str:
+        if col.type == "string":
+            return "{}s".format(col.get_length())
+        elif col.type in STRUCT_FORMATS:
+            return STRUCT_FORMATS[col.type]
+        else:
+            raise ValueError("Data type is not correct")
+
+    def _get_projection(self, columns):
+        # struct unpacking only some columns of a row, with the names,
+        # decoders and null bits of these columns, columns=None means all
+        columns = tuple(self._col_names if columns is None else columns)
+        try:
+            return self._projections[columns]
+        except KeyError:
+            pass
+
+        unknown = set(columns).difference(self.col_dict)
+        if unknown:
+            raise ValueError("Unknown columns {}".format(sorted(unknown)))
+
+        formats = ["{}s".format(self._bitmap_length)]
+        names = []
+        decoders = []
+        null_bits = []
+        for i, col in enumerate(self.columns):
+            if col.name not in columns:
+                # the bytes of other columns are skipped without decoding
+                formats.append("{}x".format(col.get_length()))
+                continue
+            formats.append(self._col_format(col))
+            if col.type == "string":
+                decoders.append((len(names), decode_string))
             elif col.type == "datetime":
-                data[col.name] = datetime.datetime.strptime(bytes[start:start+length].decode("utf-8"), "%Y-%m-%d %H:%M:%S")
+                decoders.append((len(names), micros_to_datetime))
+            null_bits.append((len(names), 1 << i))
+            names.append(col.name)
+
+        projection = (
+            struct.Struct(">" + "".join(formats)), names, decoders, null_bits
+        )
+        self._projections[columns] = projection
+        return projection
+
+    def serilize_record(self, data: dict) -> bytes:
+        # data = {"id": 1, "name": "John", "is_active": True,
+        #         "salary": 1000.0, "created_at": datetime.datetime.now()}
+        values = [data[name] for name in self._col_names]
+        for i, encode in self._encoders:
+            if values[i] is not None:
+                values[i] = encode(values[i])
+
+        bitmap = 0
+        for i, value in enumerate(values):
+            if value is None:
+                bitmap |= 1 << i
+                values[i] = NULL_VALUES[self.columns[i].type]
+        try:
+            return self._row_struct.pack(
+                bitmap.to_bytes(self._bitmap_length, "little"), *values
+            )
+        except struct.error as e:
+            raise ValueError("Cannot serialize record: {}".format(e))
+
+    def deserialize_record(self, bytes: bytes, columns=None) -> dict:
+        # reurn data = {"id": 1, "name": "John", "is_active": True, "salary": 1000.0, "created_at": datetime.datetime.now()}
+        # only the given columns are decoded, all of them by default
+        row_struct, names, decoders, null_bits = self._get_projection(columns)
+        bitmap, *values = row_struct.unpack(bytes)
+        for i, decode in decoders:
+            values[i] = decode(values[i])
+        bitmap = int.from_bytes(bitmap, "little")
+        if bitmap:
+            for i, bit in null_bits:
+                if bitmap & bit:
+                    values[i] = None
+        return dict(zip(names, values))
+
+    def scan_batches(self, columns=None, batch_size=1024, conditions=None):
+        # yield the rows matching the conditions, if any, in key order as
+        # batches of columns: dicts of column name -> values of batch_size
+        # rows at most. Rows are copied from the leaves in a single buffer
+        # per batch which is decoded column by column, no dict is created per
+        # row.
+        # With numpy, columns are numpy arrays (strings are lists), NULL
+        # values are masked.
+        # Without numpy, int, float and boolean columns are array.array,
+        # other columns are lists, columns holding NULL values in a batch are
+        # lists with None.
+        if batch_size < 1:
+            raise ValueError("Batch size must be positive")
+        predicate = self.compile_where(conditions) if conditions else None
+        rows = []
+        for row in self.tree.values(where=predicate, raw=True):
+            rows.append(row)
+            if len(rows) == batch_size:
+                yield self._decode_batch(b"".join(rows), columns)
+                rows = []
+        if rows:
+            yield self._decode_batch(b"".join(rows), columns)
+
+    def _decode_batch(self, buffer: bytes, columns) -> dict:
+        row_struct, names, _, null_bits = self._get_projection(columns)
+        if numpy is not None:
+            return self._decode_batch_numpy(buffer, names)
+
+        bitmaps, *values = zip(*row_struct.iter_unpack(buffer))
+        bitmaps = [int.from_bytes(bitmap, "little") for bitmap in bitmaps]
+        has_nulls = any(bitmaps)
+
+        batch = {}
+        for (i, bit), name, column in zip(null_bits, names, values):
+            col_type = self.col_dict[name].type
+            nulls = None
+            if has_nulls and any(bitmap & bit for bitmap in bitmaps):
+                nulls = [bitmap & bit for bitmap in bitmaps]
+
+            if col_type == "string":
+                column = [decode_string(v) for v in column]
+            elif col_type == "datetime":
+                column = [micros_to_datetime(v) for v in column]
+            elif nulls is None:
+                column = array.array(ARRAY_TYPECODES[col_type], column)
+
+            if nulls is not None:
+                column = [
+                    None if null else v for null, v in zip(nulls, column)
+                ]
+            batch[name] = column
+        return batch
+
+    def _decode_batch_numpy(self, buffer: bytes, names) -> dict:
+        # the rows of the batch are viewed as a numpy structured array, only
+        # the columns asked for are converted to native arrays
+        num_rows = len(buffer) // self.record_length
+        raw = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(
+            num_rows, self.record_length
+        )
+        formats = []
+        offsets = []
+        for name in names:
+            col = self.col_dict[name]
+            if col.type == "string":
+                formats.append("S{}".format(col.get_length()))
             else:
-                raise ValueError("Data type is not correct")
-            start += length
-        return data
-    
+                formats.append(NUMPY_DTYPES[col.type])
+            offsets.append(self._fields[name][0])
+        rows = numpy.frombuffer(buffer, dtype=numpy.dtype({
+            "names": names,
+            "formats": formats,
+            "offsets": offsets,
+            "itemsize": self.record_length,
+        }))
+
+        batch = {}
+        for name in names:
+            col = self.col_dict[name]
+            null_byte, null_bit = divmod(self._col_names.index(name), 8)
+            nulls = (raw[:, null_byte] & (1 << null_bit)) != 0
+            column = rows[name]
+            if col.type == "string":
+                column = [v.decode("utf-8") for v in column.tolist()]
+                if nulls.any():
+                    column = [None if null else v
+                              for null, v in zip(nulls.tolist(), column)]
+                batch[name] = column
+                continue
+
+            if col.type == "datetime":
+                column = column.astype(numpy.int64).astype("datetime64[us]")
+            else:
+                column = column.astype(column.dtype.newbyteorder("="))
+            if nulls.any():
+                column = numpy.ma.masked_array(column, mask=nulls)
+            batch[name] = column
+        return batch
+
+    def _compile_condition(self, col_name, operator, value=None):
+        # check of a condition on the raw bytes of a row, the column is
+        # read alone from its offset, never decoded to a str or datetime.
+        # Like in SQL, comparisons with NULL are never true
+        if col_name not in self.col_dict:
+            raise ValueError("Unknown column {}".format(col_name))
+        col = self.col_dict[col_name]
+        null_byte, null_bit = divmod(self._col_names.index(col_name), 8)
+        null_mask = 1 << null_bit
+        if operator == "IS NULL":
+            return lambda row: row[null_byte] & null_mask != 0
+        if operator == "IS NOT NULL":
+            return lambda row: row[null_byte] & null_mask == 0
+
+        offset, field = self._fields[col_name]
+        unpack_from = field.unpack_from
+
+        def to_raw(value):
+            # value as unpacked from the bytes of the column
+            if col.type == "string":
+                return encode_string(value).ljust(col.get_length(), b"\0")
+            elif col.type == "datetime":
+                return datetime_to_micros(value)
+            return value
+
+        if operator == "IN":
+            raw_values = frozenset(to_raw(v) for v in value if v is not None)
+            return lambda row: (
+                row[null_byte] & null_mask == 0 and
+                unpack_from(row, offset)[0] in raw_values
+            )
+
+        if operator not in COMPARISONS:
+            raise ValueError("Not supported operator")
+        compare = COMPARISONS[operator]
+        if value is None:
+            return lambda row: False
+        raw_value = to_raw(value)
+        return lambda row: (
+            row[null_byte] & null_mask == 0 and
+            compare(unpack_from(row, offset)[0], raw_value)
+        )
+
+    def compile_where(self, conditions):
+        # predicate on the raw bytes of a row, true when all the conditions
+        # are. A condition is a tuple (column, operator, value), operators
+        # are =, <, <=, >, >=, IN (with a list of values), IS NULL and
+        # IS NOT NULL (without value)
+        checks = [
+            self._compile_condition(*condition) for condition in conditions
+        ]
+
+        def predicate(row) -> bool:
+            for check in checks:
+                if not check(row):
+                    return False
+            return True
+
+        return predicate
+
+    def where(self, conditions, columns=None) -> list:
+        # records matching all the conditions, checked on raw rows while the
+        # leaves of the table are scanned so rows that do not match are never
+        # decoded
+        predicate = self.compile_where(conditions)
+        return [
+            self.deserialize_record(record_bytes, columns)
+            for record_bytes in self.tree.values(where=predicate)
+        ]
+
     def insert(self, data: dict):
         # data = {"id": 1, "name": "John", "is_active": True, "salary": 1000.0, "created_at": datetime.datetime.now()}
-        # validating 
+        key_bytes, byte_record = self._prepare_row(data)
+        # insert into the tree and its indexes
+        with self.transaction():
+            try:
+                self.tree._insert(key_bytes, byte_record, replace=False)
+            except ValueError:
+                # the tree only knows the encoded key
+                raise ValueError(
+                    "Key {} already exists".format(self._key_of(data))
+                ) from None
+            for col_name in self.indexes:
+                self._add_to_index(col_name, data)
+
+    def insert_many(self, rows, skip_errors=False) -> list:
+        # insert rows in a single write transaction. Rows are validated and
+        # encoded first, then loaded in key order: rows after the biggest key
+        # of the table go through the bulk path of the tree.
+        # An invalid row or an existing key raises a ValueError and nothing
+        # is inserted, unless skip_errors is set: these rows are then left
+        # out and returned as a list of (position of the row, error)
+        errors = []
+        prepared = []
+        for i, data in enumerate(rows):
+            data = dict(data)
+            try:
+                key_bytes, byte_record = self._prepare_row(data)
+            except ValueError as e:
+                if not skip_errors:
+                    raise
+                errors.append((i, e))
+                continue
+            prepared.append((key_bytes, byte_record, i, data))
+        prepared.sort(key=lambda row: row[0])
+
+        def on_error(row, error):
+            if not skip_errors:
+                raise error
+            errors.append((row[2], error))
+
+        def on_existing_key(row, _):
+            # the error of the tree only gives the encoded key of the row
+            on_error(row, ValueError(
+                "Key {} already exists".format(self._key_of(row[3]))
+            ))
+
+        # keys appearing more than once in the batch, only the first is kept
+        unique_rows = []
+        for row in prepared:
+            if unique_rows and unique_rows[-1][0] == row[0]:
+                on_existing_key(row, None)
+            else:
+                unique_rows.append(row)
+
+        with self.transaction():
+            inserted = self._load_sorted(self.tree, unique_rows,
+                                         on_existing_key)
+            for col_name, index in self.indexes.items():
+                index_rows = [
+                    (self._index_key(col_name, data), key_bytes)
+                    for key_bytes, _, _, data in inserted
+                    if data[col_name] is not None
+                ]
+                index_rows.sort()
+                self._load_sorted(index, index_rows)
+
+        errors.sort(key=lambda error: error[0])
+        return errors
+
+    def _load_sorted(self, tree, rows, on_error=None) -> list:
+        # insert rows (key, value, ...) sorted by key within a write
+        # transaction, the ones after the biggest key of the tree are batch
+        # inserted. Return the rows inserted
+        biggest = tree._select(-1) if tree._len() else None
+        inserted = []
+        tail = []
+        for row in rows:
+            if biggest is None or row[0] > biggest:
+                tail.append(row)
+                continue
+            try:
+                tree._insert(row[0], row[1], replace=False)
+            except ValueError as e:
+                if on_error is None:
+                    raise
+                on_error(row, e)
+            else:
+                inserted.append(row)
+
+        tree._batch_insert((row[0], row[1]) for row in tail)
+        return inserted + tail
+
+    def _prepare_row(self, data: dict) -> tuple:
+        # validate a row, return its key and the row encoded
         self.assign_default_value(data)
         self.validate_not_null_cols(data)
         self.validate_data_is_valid(data)
@@ -129,59 +661,119 @@ class Schema:
         if len(byte_record) != self.record_length and len(byte_record)!= self.tree._tree_conf.value_size :
             raise ValueError("Something wrong with the serlization, Data length is not correct")
         # get the key index 
-        key_value = data[self.key_col]
-        if (key_value is None):
-            raise ValueError("Key value is None")
-        if not isinstance(key_value, int):
-            raise ValueError("not supported yet for other key type which is not int")
-        # insert into the tree
-        self.tree.insert(key_value, byte_record)
-        
+        return self.encode_key(self._key_of(data)), byte_record
 
-    def get(self, key) -> dict:
+    def get(self, key, columns=None) -> dict:
         # find the key that match, may hvae scan the whole tree if hte column is not indexed
         
-        record_bytes = self.tree.get(key)
+        record_bytes = self.tree.get(self.encode_key(key))
         if record_bytes is None:
             return None
-        record = self.deserialize_record(record_bytes)
+        record = self.deserialize_record(record_bytes, columns)
         return record
-        
-    # any get function should be block with read access for entire during of transaction
-    def get_by_key(self, operator, value) -> list: # target column, operator, value
-        key_col = self.col_dict[self.key_col]  
 
+    def select(self, columns=None) -> list:
+        # all the records in key order, with only the given columns
+        return [
+            self.deserialize_record(record_bytes, columns)
+            for record_bytes in self.tree.values()
+        ]
+        
+    def _range_slice(self, operator, encoded, rest) -> slice:
+        # slice of the keys starting with the encoded value that compare to
+        # it, keys with a given value sort between value + 0x00... and
+        # value + 0xff... where rest is the length of what follows the value
+        lowest = encoded + bytes(rest)
+        highest = encoded + b"\xff" * rest
         if operator == "=":
-            # just return one value 
-            record = self.tree.get(value)
-            return [self.deserialize_record(record)]
-        elif operator == ">":
-            # start from the left and go to the next node 
-            records = self.tree.get_by_key(">", value)
-            for i, record in enumerate(records): 
-                records[i]= self.deserialize_record(record)
-            return records
-            
+            return slice(lowest, highest + b"\0")
         elif operator == "<":
-            # start from the right node and go to the previous node
-            last_node = self.tree.get_node(value, default=None)
-            if last_node is None: 
-                return []
-            records = []
-            for key, value in last_node.entries: 
-                records.append( self.deserialize_record(value))
-            # while last_node.previous_node is not None:
-            
-        elif operator == "<=": 
-            pass 
+            return slice(None, lowest)
+        elif operator == "<=":
+            return slice(None, highest + b"\0")
+        elif operator == ">":
+            return slice(highest + b"\0", None)
         elif operator == ">=":
-            pass 
+            return slice(lowest, None)
+        else:
+            raise ValueError("Not supported operator")
+
+    # any get function should be block with read access for entire during
+    # of transaction
+    def get_by_key(self, operator, value, columns=None) -> list:
+        # records whose key compares to the value, the first values of a
+        # composite key compare with the keys starting with them
+        encoded = self.encode_key(value, prefix=True)
+        slice_ = self._range_slice(operator, encoded,
+                                   self.key_length - len(encoded))
+        return [
+            self.deserialize_record(record_bytes, columns)
+            for record_bytes in self.tree.values(slice_)
+        ]
+
+    def get_by_column(self, col_name, operator, value, columns=None) -> list:
+        # records whose column compares to the value, found with the index of
+        # the column when there is one, by scanning the whole table otherwise
+        col = self.col_dict[col_name]
+        # NULL values are not indexed, checks of NULL scan the table
+        if (col_name not in self.indexes or
+                operator in ("IS NULL", "IS NOT NULL")):
+            return self.where([(col_name, operator, value)], columns)
+
+        # index keys are the encoded value followed by the primary key, IN
+        # reads one range of the index per value
+        if operator == "IN":
+            encoded_values = sorted(set(
+                encode_index_value(col, v) for v in value if v is not None
+            ))
+            slices = [self._range_slice("=", encoded, self.key_length)
+                      for encoded in encoded_values]
+        elif value is None:
+            return []
+        else:
+            slices = [self._range_slice(
+                operator, encode_index_value(col, value), self.key_length
+            )]
+        records = []
+        for slice_ in slices:
+            for key_bytes in self.indexes[col_name].values(slice_):
+                records.append(
+                    self.deserialize_record(self.tree.get(key_bytes), columns)
+                )
+        return records
 
     def update(self, key, data): # will be set of column and value that need to be updated but not hte index key 
-        pass
+        key_bytes = self.encode_key(key)
+        with self.transaction():
+            record_bytes = self.tree._get(key_bytes)
+            if record_bytes is None:
+                raise KeyError(key)
+            old_data = self.deserialize_record(record_bytes)
+            new_data = dict(old_data, **data)
+            if self._key_of(new_data) != self._key_of(old_data):
+                raise ValueError("Key column cannot be updated")
+            self.validate_not_null_cols(new_data)
+            self.validate_data_is_valid(new_data)
+
+            self.tree._insert(key_bytes, self.serilize_record(new_data),
+                              replace=True)
+            for col_name in self.indexes:
+                if old_data[col_name] == new_data[col_name]:
+                    continue
+                self._remove_from_index(col_name, old_data)
+                self._add_to_index(col_name, new_data)
 
     def delete(self, key):
-        pass
+        key_bytes = self.encode_key(key)
+        with self.transaction():
+            record_bytes = self.tree._get(key_bytes)
+            if record_bytes is None:
+                raise KeyError(key)
+            data = self.deserialize_record(record_bytes)
+
+            self.tree._delete(key_bytes)
+            for col_name in self.indexes:
+                self._remove_from_index(col_name, data)
 
 
 # for example: Schema("employee", [IntCol("id"), StrCol("name", 20), BoolCol("is_active"), FloatCol("salary"), DateTimeCol("created_at")])
@@ -1,5 +1,7 @@
 import abc
 from datetime import datetime, timezone
+import struct
+from typing import Union
 from uuid import UUID
 
 try:
@@ -10,10 +12,22 @@ except ImportError:
 from .const import ENDIAN
 
 
+def _shortest_separator(smaller, bigger):
+    """Shortest prefix of bigger that is still bigger than smaller."""
+    for i in range(1, len(bigger)):
+        if bigger[:i] > smaller:
+            return bigger[:i]
+    return bigger
+
+
 class Serializer(metaclass=abc.ABCMeta):
 
     __slots__ = []
 
+    # Whether serialized keys sort like the keys themselves, nodes then
+    # compare them as bytes without deserializing them
+    order_preserving = False
+
     @abc.abstractmethod
     def serialize(self, obj: object, key_size: int) -> bytes:
         """Serialize a key to bytes."""
@@ -22,6 +36,32 @@ class Serializer(metaclass=abc.ABCMeta):
     def deserialize(self, data: bytes) -> object:
         """Create a key object from bytes."""
 
+    def serialize_search_key(self, obj: object, key_size: int) -> bytes:
+        """Serialize a key only compared to the keys of the tree.
+
+        Used by order preserving serializers, the key may be longer than
+        the keys that can be stored.
+        """
+        return self.serialize(obj, key_size)
+
+    def serialize_prefix(self, prefix: object) -> bytes:
+        """Serialize the beginning of a key to bytes.
+
+        Only serializers producing bytes that sort like the keys they
+        represent can do it.
+        """
+        raise ValueError('{} does not support prefixes'.format(
+            self.__class__.__name__
+        ))
+
+    def shortest_separator(self, smaller: object, bigger: object) -> object:
+        """Return a key s so that smaller < s <= bigger.
+
+        Separators are copied into internal nodes, serializers that can
+        should return a key shorter than bigger.
+        """
+        return bigger
+
     def __repr__(self):
         return '{}()'.format(self.__class__.__name__)
 
@@ -37,10 +77,35 @@ class IntSerializer(Serializer):
         return int.from_bytes(data, ENDIAN)
 
 
+class SignedIntSerializer(Serializer):
+    """Serialize integers, negative ones included, in big-endian.
+
+    The sign bit is flipped so that negative numbers sort before positive
+    ones when compared as bytes.
+    """
+
+    __slots__ = []
+
+    order_preserving = True
+
+    def serialize(self, obj: int, key_size: int) -> bytes:
+        try:
+            return (obj + (1 << (key_size * 8 - 1))).to_bytes(key_size, 'big')
+        except OverflowError:
+            raise ValueError('Integer {} does not fit in {} bytes'.format(
+                obj, key_size
+            ))
+
+    def deserialize(self, data: bytes) -> int:
+        return int.from_bytes(data, 'big') - (1 << (len(data) * 8 - 1))
+
+
 class StrSerializer(Serializer):
 
     __slots__ = []
 
+    order_preserving = True
+
     def serialize(self, obj: str, key_size: int) -> bytes:
         rv = obj.encode(encoding='utf-8')
         assert len(rv) <= key_size
@@ -49,17 +114,59 @@ class StrSerializer(Serializer):
     def deserialize(self, data: bytes) -> str:
         return data.decode(encoding='utf-8')
 
+    def serialize_search_key(self, obj: str, key_size: int) -> bytes:
+        return obj.encode(encoding='utf-8')
+
+    def serialize_prefix(self, prefix: str) -> bytes:
+        return prefix.encode(encoding='utf-8')
+
+    def shortest_separator(self, smaller: str, bigger: str) -> str:
+        return _shortest_separator(smaller, bigger)
+
+
+class BytesSerializer(Serializer):
+
+    __slots__ = []
+
+    order_preserving = True
+
+    def serialize(self, obj: bytes, key_size: int) -> bytes:
+        assert len(obj) <= key_size
+        return bytes(obj)
+
+    def deserialize(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def serialize_search_key(self, obj: bytes, key_size: int) -> bytes:
+        return bytes(obj)
+
+    def serialize_prefix(self, prefix: bytes) -> bytes:
+        return bytes(prefix)
+
+    def shortest_separator(self, smaller: bytes, bigger: bytes) -> bytes:
+        return _shortest_separator(smaller, bigger)
+
 
 class UUIDSerializer(Serializer):
 
     __slots__ = []
 
+    order_preserving = True
+
     def serialize(self, obj: UUID, key_size: int) -> bytes:
         return obj.bytes
 
     def deserialize(self, data: bytes) -> UUID:
         return UUID(bytes=data)
 
+    def serialize_prefix(self, prefix: Union[bytes, str]) -> bytes:
+        """Serialize the beginning of a UUID given as bytes or hex digits."""
+        if isinstance(prefix, str):
+            prefix = bytes.fromhex(prefix.replace('-', ''))
+        if len(prefix) > 16:
+            raise ValueError('UUID prefix is longer than a UUID')
+        return bytes(prefix)
+
 
 class DatetimeUTCSerializer(Serializer):
 
@@ -81,16 +188,37 @@ class DatetimeUTCSerializer(Serializer):
         rv = rv.replace(tzinfo=timezone.utc)
         return rv
 
+
 class FloatSerializer(Serializer):
+    """Serialize floats as 8 bytes following the IEEE 754 total order.
+
+    The sign bit of positive numbers and all the bits of negative ones are
+    flipped, doubles then sort as unsigned big-endian integers: -0.0 comes
+    just before 0.0 and NaNs come after the infinities of their sign.
+    """
 
     __slots__ = []
 
+    order_preserving = True
+
     def serialize(self, obj: float, key_size: int) -> bytes:
-        return obj.to_bytes(key_size, ENDIAN)
+        if key_size < 8:
+            raise ValueError('Floats need a key size of at least 8 bytes')
+        bits = struct.unpack('>Q', struct.pack('>d', obj))[0]
+        if bits & (1 << 63):
+            bits ^= (1 << 64) - 1
+        else:
+            bits |= 1 << 63
+        return bits.to_bytes(8, 'big')
 
     def deserialize(self, data: bytes) -> float:
-        return float.from_bytes(data, ENDIAN)
-    
+        bits = int.from_bytes(data, 'big')
+        if bits & (1 << 63):
+            bits ^= 1 << 63
+        else:
+            bits ^= (1 << 64) - 1
+        return struct.unpack('>d', bits.to_bytes(8, 'big'))[0]
+
 
 class BooleanSerializer(Serializer):
     __slots__ = []
@@ -0,0 +1,216 @@
+from collections import defaultdict
+import io
+import itertools
+from typing import Callable, List, Optional, Sequence
+
+from .const import TreeConf
+from .entry import OpaqueData
+from .memory import FileMemory
+from .node import Node, OverflowNode, OverflowDirectoryNode
+
+
+class OverflowReader(io.RawIOBase):
+    """Read-only binary file object over the pages of an overflowing value.
+
+    The directory of the value gives the page holding any offset without
+    reading the pages before it, so seeking is cheap. Only the pages needed
+    to fill the buffer given to `readinto` are read, in a single batch.
+    """
+
+    def __init__(self, mem: FileMemory, directory_page: int):
+        super().__init__()
+        self._mem = mem
+        with self._mem.read_transaction:
+            self._directory = self._mem.get_node(directory_page)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self) -> int:
+        self._check_closed()
+        return self._position
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        self._check_closed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._directory.length + offset
+        else:
+            raise ValueError('Invalid whence {}'.format(whence))
+
+        if position < 0:
+            raise ValueError('Negative seek position {}'.format(position))
+        self._position = position
+        return position
+
+    def readinto(self, buffer) -> int:
+        """Read into the buffer, it is only partially filled at the end."""
+        self._check_closed()
+        buffer = memoryview(buffer).cast('B')
+        stop = min(self._position + len(buffer), self._directory.length)
+        if stop <= self._position:
+            return 0
+
+        slice_size = self._directory.slice_size
+        read = 0
+        with self._mem.read_transaction:
+            pages = [self._find_page(i) for i in
+                     range(self._position // slice_size,
+                           (stop - 1) // slice_size + 1)]
+            for overflow_node in self._mem.get_nodes(pages):
+                start = self._position % slice_size
+                data = overflow_node.smallest_entry.data[
+                    start:start + stop - self._position
+                ]
+                buffer[read:read + len(data)] = data
+                read += len(data)
+                self._position += len(data)
+        return read
+
+    def _find_page(self, index: int) -> int:
+        """Return the page of the OverflowNode holding the nth slice."""
+        directory = self._directory
+        while directory.level > 0:
+            span = directory.span
+            directory = self._mem.get_node(directory.entries[index // span])
+            index %= span
+        return directory.entries[index]
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+
+def count_overflow_pages(tree_conf: TreeConf, length: int) -> int:
+    """Number of pages used to store a value of a given length.
+
+    This counts the OverflowNodes holding the value and the directories
+    listing them, as written by OverflowWriter.
+    """
+    directory = OverflowDirectoryNode(tree_conf)
+    pages = -(-length // directory.slice_size)
+    rv = pages
+    while True:
+        pages = -(-pages // directory.max_children)
+        rv += pages
+        if pages <= 1:
+            return rv
+
+
+class OverflowWriter:
+    """Write the slices of a value to OverflowNodes listed in directories.
+
+    Directories are written as soon as they are full, so only the pages of
+    the directories being filled are kept in memory.
+
+    Nodes are written with `write_node`, `FileMemory.set_node` by default.
+
+    When the directories and pages of a value already stored are given,
+    the new value is written over them: slices and directories identical
+    to the ones already stored are not written again, pages that are not
+    needed anymore are freed.
+    """
+
+    def __init__(self, mem: FileMemory, tree_conf: TreeConf,
+                 old_directories: Sequence[OverflowDirectoryNode]=(),
+                 old_pages: Sequence[int]=(),
+                 write_node: Optional[Callable[[Node], None]]=None):
+        self._mem = mem
+        self._tree_conf = tree_conf
+        self._write_node = write_node or mem.set_node
+        self._max_children = OverflowDirectoryNode(tree_conf).max_children
+        self._old_pages = old_pages
+        self._old_directories = defaultdict(list)
+        for directory in old_directories:
+            self._old_directories[directory.level].append(directory)
+
+        # Pages waiting to be listed in a directory, by level
+        self._pending = [[]]
+        self._num_directories = defaultdict(int)
+        self._num_pages = 0
+        self._length = 0
+
+    def write_slice(self, data: bytes):
+        if self._num_pages < len(self._old_pages):
+            page = self._old_pages[self._num_pages]
+            if self._mem.get_node(page).smallest_entry.data != data:
+                self._write_overflow_node(page, data)
+        else:
+            page = self._mem.next_available_page
+            self._write_overflow_node(page, data)
+
+        self._num_pages += 1
+        self._length += len(data)
+        self._add_to_directory(0, page)
+
+    def finish(self) -> int:
+        """Write the remaining directories and return the top one."""
+        for page in self._old_pages[self._num_pages:]:
+            self._mem.del_page(page)
+
+        for level in itertools.count():
+            if level == len(self._pending) - 1:
+                top_page = self._write_directory(level, self._pending[level],
+                                                 self._length)
+                break
+            if self._pending[level]:
+                self._add_to_directory(
+                    level + 1,
+                    self._write_directory(level, self._pending[level])
+                )
+
+        for level, directories in self._old_directories.items():
+            for directory in directories[self._num_directories[level]:]:
+                self._mem.del_node(directory)
+
+        return top_page
+
+    def _write_overflow_node(self, page: int, data: bytes):
+        overflow_node = OverflowNode(self._tree_conf, page=page)
+        overflow_node.insert_entry_at_the_end(OpaqueData(data=data))
+        self._write_node(overflow_node)
+
+    def _add_to_directory(self, level: int, page: int):
+        """Add a page to the pending directory of a level.
+
+        A directory is written once it is full, its page then goes to the
+        pending directory of the level above.
+        """
+        if level == len(self._pending):
+            self._pending.append(list())
+
+        if len(self._pending[level]) == self._max_children:
+            directory_page = self._write_directory(level, self._pending[level])
+            self._pending[level] = list()
+            self._add_to_directory(level + 1, directory_page)
+
+        self._pending[level].append(page)
+
+    def _write_directory(self, level: int, pages: List[int],
+                         length: int=0) -> int:
+        """Write a directory, over the one at the same place if any."""
+        index = self._num_directories[level]
+        self._num_directories[level] += 1
+
+        old_directories = self._old_directories[level]
+        if index < len(old_directories):
+            old_directory = old_directories[index]
+            if (old_directory.entries == pages and
+                    old_directory.length == length):
+                return old_directory.page
+            page = old_directory.page
+        else:
+            page = self._mem.next_available_page
+
+        directory = OverflowDirectoryNode(self._tree_conf, page=page,
+                                          level=level, length=length)
+        directory.entries = list(pages)
+        self._write_node(directory)
+        return page
@@ -1,15 +1,25 @@
+import bisect
+from contextlib import closing, contextmanager
 from functools import partial
+import io
+import itertools
 from logging import getLogger
-from typing import Optional, Union, Iterator, Iterable
+import os
+from typing import (
+    Callable, Optional, Union, Iterator, Iterable, Tuple, List, Dict
+)
 
 from . import utils
+from .builder import TreeBuilder
 from .const import TreeConf
-from .entry import Record, Reference, OpaqueData
+from .entry import Record, Reference
 from .memory import FileMemory
 from .node import (
-    Node, LonelyRootNode, RootNode, InternalNode, LeafNode, OverflowNode
+    Node, LonelyRootNode, RootNode, InternalNode, LeafNode, OverflowNode,
+    OverflowDirectoryNode
 )
 from .serializer import Serializer, IntSerializer
+from .stream import OverflowReader, OverflowWriter, count_overflow_pages
 
 
 logger = getLogger(__name__)
@@ -19,21 +29,53 @@ class BPlusTree:
 
     __slots__ = ['_filename', '_tree_conf', '_mem', '_root_node_page',
                  '_is_open', 'LonelyRootNode', 'RootNode', 'InternalNode',
-                 'LeafNode', 'OverflowNode', 'Record', 'Reference']
+                 'LeafNode', 'OverflowNode', 'OverflowDirectoryNode', 'Record',
+                 'Reference', '_split_policy', '_fill_factor', '_last_leaf',
+                 '_counts']
+
+    SPLIT_POLICIES = ('balanced', 'append', 'adaptive')
 
     # ######################### Public API ################################
 
     def __init__(self, filename: str, page_size: int= 4096, order: int=100,
                  key_size: int=8, value_size: int=32, cache_size: int=64,
-                 serializer: Optional[Serializer]=None):
+                 serializer: Optional[Serializer]=None,
+                 compression: Optional[str]=None, read_ahead: int=8,
+                 split_policy: str='balanced', fill_factor: float=0.9,
+                 database=None):
+        if split_policy not in self.SPLIT_POLICIES:
+            raise ValueError('Split policy must be one of {}'.format(
+                ', '.join(self.SPLIT_POLICIES)
+            ))
+        if not 0.5 <= fill_factor <= 1:
+            raise ValueError('Fill factor must be between 0.5 and 1')
+        self._split_policy = split_policy
+        self._fill_factor = fill_factor
+
+        # Bounds, path and page of the leaf that received the last insert,
+        # see _find_leaf
+        self._last_leaf = None  # type: Optional[tuple]
+
+        # Counts of records computed below the internal nodes that do not
+        # know them, with the node they were computed from, see
+        # _subtree_count
+        self._counts = dict()
+
         self._filename = filename
         self._tree_conf = TreeConf(
             page_size, order, key_size, value_size,
             serializer or IntSerializer()
         )
         self._create_partials()
-        self._mem = FileMemory(filename, self._tree_conf,
-                               cache_size=cache_size)
+        if database is None:
+            self._mem = FileMemory(filename, self._tree_conf,
+                                   cache_size=cache_size,
+                                   compression=compression,
+                                   read_ahead=read_ahead)
+        else:
+            # The tree is hosted in the file of a Database under the name
+            # given as filename, its memory is the one of the database
+            self._mem = database.tree_memory(filename, self._tree_conf)
         try:
             metadata = self._mem.get_metadata()
         except ValueError:
@@ -48,6 +90,10 @@ class BPlusTree:
                 logger.info('Tree is already closed')
                 return
 
+            # Committed before the memory is closed and checkpointed
+            self._write_counts()
+
+        with self._mem.write_transaction:
             self._mem.close()
             self._is_open = False
 
@@ -58,9 +104,132 @@ class BPlusTree:
         self.close()
 
     def checkpoint(self):
+        if self._mem.in_write_transaction:
+            raise ValueError('Cannot checkpoint within a transaction')
+        with self._mem.write_transaction:
+            self._write_counts()
         with self._mem.write_transaction:
             self._mem.perform_checkpoint(reopen_wal=True)
 
+    @contextmanager
+    def transaction(self):
+        """Group many operations in a single write transaction.
+
+        Operations made by the thread within it are committed together, with
+        a single fsync, when it ends. An error escaping it rolls all of them
+        back. Other threads cannot use the tree in the meantime.
+        """
+        if self._mem.in_write_transaction:
+            yield self
+            return
+
+        root_node_page = self._root_node_page
+        try:
+            with self._mem.write_transaction:
+                yield self
+        except BaseException:
+            self._root_node_page = root_node_page
+            self._last_leaf = None
+            raise
+
+    def compact(self) -> int:
+        """Rewrite the tree to make its file as small as possible.
+
+        Leaves are rewritten in key order on the lowest pages that do not
+        hold overflowing values, and internal nodes are rebuilt above them.
+        Pages of overflowing values found after the end of the tree are
+        moved to the pages still free, then the end of the file is cut.
+
+        All records are loaded in memory while the tree is rewritten.
+        Return the number of bytes removed from the file.
+        """
+        self._check_alone_in_file()
+        if self._mem.in_write_transaction:
+            raise ValueError('Cannot compact within a transaction')
+        with self._mem.write_transaction:
+            self._last_leaf = None
+            self._counts.clear()
+            self._mem.perform_checkpoint(reopen_wal=True)
+            size = os.path.getsize(self._filename)
+            records = list(self._iter_slice(slice(None)))
+            last_page = self._mem.last_page
+            tree_pages = self._get_tree_pages()
+            free_pages = set(tree_pages).union(self._mem.get_free_pages())
+            overflow_pages = set(range(1, last_page + 1)) - free_pages
+
+            pages = itertools.chain(sorted(free_pages),
+                                    itertools.count(last_page + 1))
+            used_pages = list()
+
+            def allocate_page():
+                used_pages.append(next(pages))
+                return used_pages[-1]
+
+            builder = TreeBuilder(self._tree_conf, allocate_page,
+                                  self._mem.set_node)
+            for record in records:
+                builder.add(record)
+            self._root_node_page = builder.finish()
+            self._mem.set_metadata(self._root_node_page, self._tree_conf)
+
+            # Fill the pages left free with the overflow pages at the end
+            holes = sorted(free_pages.difference(used_pages), reverse=True)
+            moved_pages = dict()
+            for page in sorted(overflow_pages, reverse=True):
+                if not holes or holes[-1] > page:
+                    break
+                moved_pages[page] = holes.pop()
+            if moved_pages:
+                self._move_overflow_pages(records, moved_pages)
+
+            new_last_page = max(
+                itertools.chain(used_pages, moved_pages.values(),
+                                overflow_pages.difference(moved_pages))
+            )
+            self._mem.truncate(new_last_page)
+
+        return size - os.path.getsize(self._filename)
+
+    def vacuum(self) -> int:
+        """Rebuild the tree in a new file that replaces the current one.
+
+        Leaves are scanned in key order and packed in a new file, written
+        directly without going through the WAL: first the pages of the
+        overflowing values, then the leaves, each internal node being
+        written as soon as its children are. Only the nodes being filled
+        are kept in memory, a few per level of the tree. The new file
+        replaces the current one atomically once it is complete, the tree
+        cannot be used in the meantime.
+
+        Return the number of bytes removed from the file.
+        """
+        self._check_alone_in_file()
+        if self._mem.in_write_transaction:
+            raise ValueError('Cannot vacuum within a transaction')
+        vacuum_filename = self._filename + '-vacuum'
+        with self._mem.write_transaction:
+            self._last_leaf = None
+            self._counts.clear()
+            self._mem.perform_checkpoint(reopen_wal=True)
+            size = os.path.getsize(self._filename)
+            for path in (vacuum_filename, vacuum_filename + '-wal'):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+            new_mem = FileMemory(vacuum_filename, self._tree_conf,
+                                 cache_size=0,
+                                 compression=self._mem.compression)
+            try:
+                root_node_page = self._vacuum_into(new_mem)
+                new_mem.set_metadata(root_node_page, self._tree_conf)
+            finally:
+                new_mem.close()
+
+            self._mem.replace_file(vacuum_filename)
+            self._root_node_page = root_node_page
+
+        return size - os.path.getsize(self._filename)
+
     def insert(self, key, value: bytes, replace=False):
         """Insert a value in the tree.
 
@@ -74,46 +243,40 @@ class BPlusTree:
             ValueError('Values must be bytes objects')
 
         with self._mem.write_transaction:
-            node = self._search_in_tree(key, self._root_node)
+            self._insert(key, value, replace)
 
-            # Check if a record with the key already exists
-            try:
-                existing_record = node.get_entry(key)
-            except ValueError:
-                pass
-            else:
-                if not replace:
-                    raise ValueError('Key {} already exists'.format(key))
-
-                if existing_record.overflow_page:
-                    self._delete_overflow(existing_record.overflow_page)
-
-                if len(value) <= self._tree_conf.value_size:
-                    existing_record.value = value
-                    existing_record.overflow_page = None
-                else:
-                    existing_record.value = None
-                    existing_record.overflow_page = self._create_overflow(
-                        value
-                    )
-                self._mem.set_node(node)
-                return
+    def insert_stream(self, key, fileobj, replace=False):
+        """Insert a value read from a binary file object.
 
-            if len(value) <= self._tree_conf.value_size:
-                record = self.Record(key, value=value)
-            else:
-                # Record values exceeding the max value_size must be placed
-                # into overflow pages
-                first_overflow_page = self._create_overflow(value)
-                record = self.Record(key, value=None,
-                                     overflow_page=first_overflow_page)
-
-            if node.can_add_entry:
-                node.insert_entry(record)
-                self._mem.set_node(node)
-            else:
-                node.insert_entry(record)
-                self._split_leaf(node)
+        Large values are written to overflow pages as they are read, so the
+        whole value never needs to be in memory.
+
+        :param key: The key at which the value will be recorded
+        :param fileobj: The file object to read the value from until its end
+        :param replace: If True, already existing value will be overridden,
+                        otherwise a ValueError is raised.
+        """
+        head = utils.read_exactly(fileobj, self._tree_conf.value_size + 1)
+        if len(head) <= self._tree_conf.value_size:
+            value = head
+        else:
+            value = utils.iter_stream_slice(
+                fileobj, self.OverflowNode().max_payload, head
+            )
+
+        with self._mem.write_transaction:
+            self._insert(key, value, replace)
+
+    def delete(self, key):
+        """Remove a key and its value from the tree.
+
+        Leaves are not merged when records are removed, even when they
+        become empty. Their space is reclaimed by `compact` or `vacuum`.
+
+        Raise KeyError when the key is not in the tree.
+        """
+        with self._mem.write_transaction:
+            self._delete(key)
 
     def batch_insert(self, iterable: Iterable):
         """Insert many elements in the tree at once.
@@ -123,52 +286,68 @@ class BPlusTree:
         All inserts happen in a single transaction. This is way faster than
         manually inserting in a loop.
         """
-        node = None
         with self._mem.write_transaction:
+            self._batch_insert(iterable)
 
-            for key, value in iterable:
-
-                if node is None:
-                    node = self._search_in_tree(key, self._root_node)
-
-                try:
-                    biggest_entry = node.biggest_entry
-                except IndexError:
-                    biggest_entry = None
-                if biggest_entry and key <= biggest_entry.key:
-                    raise ValueError('Keys to batch insert must be sorted and '
-                                     'bigger than keys currently in the tree')
-
-                if len(value) <= self._tree_conf.value_size:
-                    record = self.Record(key, value=value)
-                else:
-                    # Record values exceeding the max value_size must be placed
-                    # into overflow pages
-                    first_overflow_page = self._create_overflow(value)
-                    record = self.Record(key, value=None,
-                                         overflow_page=first_overflow_page)
-
-                if node.can_add_entry:
-                    node.insert_entry_at_the_end(record)
-                else:
-                    node.insert_entry_at_the_end(record)
-                    self._split_leaf(node)
-                    node = None
-
-            if node is not None:
-                self._mem.set_node(node)
+    def open_value(self, key) -> io.RawIOBase:
+        """Open the value of a key as a read-only binary file object.
 
-    def get(self, key, default=None) -> bytes:
+        Values stored in overflow pages are read page by page when
+        requested, memory usage does not depend on the size of the value.
+        The value must not be modified while it is being read.
+        """
         with self._mem.read_transaction:
             node = self._search_in_tree(key, self._root_node)
             try:
                 record = node.get_entry(key)
             except ValueError:
-                return default
-            else:
-                rv = self._get_value_from_record(record)
-                assert isinstance(rv, bytes)
-                return rv
+                raise KeyError(key)
+
+            if record.overflow_page:
+                return OverflowReader(self._mem, record.overflow_page)
+            return io.BytesIO(record.value)
+
+    def get(self, key, default=None) -> bytes:
+        with self._mem.read_transaction:
+            return self._get(key, default)
+
+    def get_many(self, keys: Iterable, default=None) -> list:
+        """Get the values of many keys at once.
+
+        Keys are sorted and looked up in a single walk of the tree: internal
+        nodes and leaves shared by neighbouring keys are only visited once.
+        Values are returned in the same order as the keys given, missing keys
+        get the default value.
+        """
+        keys = list(keys)
+        rv = [default] * len(keys)
+        positions = sorted(range(len(keys)), key=keys.__getitem__)
+        sorted_keys = [keys[i] for i in positions]
+
+        with self._mem.read_transaction:
+            overflowing = list()
+            leaves = self._search_many_in_tree(sorted_keys, 0,
+                                               len(sorted_keys),
+                                               self._root_node)
+            for start, stop, node in leaves:
+                for i in range(start, stop):
+                    try:
+                        record = node.get_entry(sorted_keys[i])
+                    except ValueError:
+                        continue
+                    if record.overflow_page:
+                        overflowing.append((record.overflow_page,
+                                            positions[i]))
+                    else:
+                        rv[positions[i]] = record.value
+
+            # Overflow chains are read last and in page order to keep
+            # seeks in the file going forward
+            overflowing.sort()
+            for overflow_page, position in overflowing:
+                rv[position] = self._read_from_overflow(overflow_page)
+
+        return rv
 
     def get_node (self, key, default=None) -> Node:
         with self._mem.read_transaction:
@@ -183,15 +362,14 @@ class BPlusTree:
             elif operator == ">": 
                 node = self._search_in_tree(value, self._root_node)
                 records = []
-                for record in node.entries:
-                    if record.key > value: 
-                        records.append( self._get_value_from_record(record))
-                while node.next_page is not None:
-                    node = self._mem.get_node(node.next_page)
-                    for record in node.entries:
-                        if record.key > value: 
-                            records.append( self._get_value_from_record(record))
-                return records                
+                with closing(self._mem.iter_chain(node)) as nodes:
+                    for node in nodes:
+                        for record in node.entries:
+                            if record.key > value:
+                                records.append(
+                                    self._get_value_from_record(record)
+                                )
+                return records
             else: 
                 raise ValueError("Not supported operator")
         
@@ -200,6 +378,9 @@ class BPlusTree:
             o = object()
             return False if self.get(item, default=o) is o else True
 
+    def __delitem__(self, key):
+        self.delete(key)
+
     def __setitem__(self, key, value):
         self.insert(key, value, replace=True)
 
@@ -223,29 +404,41 @@ class BPlusTree:
 
     def __len__(self):
         with self._mem.read_transaction:
-            node = self._left_record_node
-            rv = 0
-            while True:
-                rv += len(node.entries)
-                if not node.next_page:
-                    return rv
-                node = self._mem.get_node(node.next_page)
+            return self._len()
 
     def __length_hint__(self):
+        return len(self)
+
+    def rank(self, key) -> int:
+        """Return the number of keys in the tree smaller than key."""
         with self._mem.read_transaction:
+            rv = 0
             node = self._root_node
-            if isinstance(node, LonelyRootNode):
-                # Assume that the lonely root node is half full
-                return node.max_children // 2
-            # Assume that there are no holes in pages
-            last_page = self._mem.last_page
-            # Assume that 70% of nodes in a tree carry values
-            num_leaf_nodes = int(last_page * 0.70)
-            # Assume that every leaf node is half full
-            num_records_per_leaf_node = int(
-                (node.max_children + node.min_children) / 2
-            )
-            return num_leaf_nodes * num_records_per_leaf_node
+            while not isinstance(node, (LonelyRootNode, LeafNode)):
+                child_index = node.bisect_key(key, right=True)
+                rv += sum(self._child_count(node, i)
+                          for i in range(child_index))
+                node = self._mem.get_node(node.child_page(child_index))
+
+            return rv + node.bisect_key(key)
+
+    def count_range(self, start=None, stop=None) -> int:
+        """Return the number of keys k in the tree with start <= k < stop.
+
+        Like slices, a bound left to None is unbounded.
+        """
+        with self._mem.read_transaction:
+            start_rank = 0 if start is None else self.rank(start)
+            stop_rank = len(self) if stop is None else self.rank(stop)
+            return max(0, stop_rank - start_rank)
+
+    def select(self, index: int):
+        """Return the key at a position in the ordered tree.
+
+        Like lists, negative indexes count from the end of the tree.
+        """
+        with self._mem.read_transaction:
+            return self._select(index)
 
     def __iter__(self, slice_: Optional[slice]=None):
         if not slice_:
@@ -256,19 +449,49 @@ class BPlusTree:
 
     keys = __iter__
 
-    def items(self, slice_: Optional[slice]=None) -> Iterator[tuple]:
+    def items(self, slice_: Optional[slice]=None,
+              where: Optional[Callable[[bytes], bool]]=None
+              ) -> Iterator[tuple]:
         if not slice_:
             slice_ = slice(None)
         with self._mem.read_transaction:
-            for record in self._iter_slice(slice_):
+            for record in self._iter_slice(slice_, where):
                 yield record.key, self._get_value_from_record(record)
 
-    def values(self, slice_: Optional[slice]=None) -> Iterator[bytes]:
+    def prefix_scan(self, prefix) -> Iterator[tuple]:
+        """Iterate over the items whose key starts with prefix.
+
+        Only serializers storing keys as bytes that sort like the keys
+        themselves support it: StrSerializer, BytesSerializer and
+        UUIDSerializer. Keys are compared as raw bytes, only the records
+        yielded get deserialized.
+        """
+        start = self._tree_conf.serializer.serialize_prefix(prefix)
+        stop = utils.prefix_successor(start)
+        with self._mem.read_transaction:
+            for record in self._iter_key_bytes(start, stop):
+                yield record.key, self._get_value_from_record(record)
+
+    def values(self, slice_: Optional[slice]=None,
+               where: Optional[Callable[[bytes], bool]]=None,
+               raw: bool=False) -> Iterator[bytes]:
+        """Iterate over the values of the tree in key order.
+
+        When given, `where` is called with the raw bytes of each value
+        during the scan and values for which it returns False are skipped.
+        Inline values are given as memoryviews over the leaf, records that
+        are skipped are neither copied nor deserialized.
+
+        With `raw`, inline values are yielded the same way, as memoryviews.
+        """
         if not slice_:
             slice_ = slice(None)
         with self._mem.read_transaction:
-            for record in self._iter_slice(slice_):
-                yield self._get_value_from_record(record)
+            for record in self._iter_slice(slice_, where):
+                value = record.value_bytes if raw else None
+                if value is None:
+                    value = self._get_value_from_record(record)
+                yield value
 
     def __bool__(self):
         with self._mem.read_transaction:
@@ -281,11 +504,16 @@ class BPlusTree:
 
     # ####################### Implementation ##############################
 
+    def _check_alone_in_file(self):
+        if not isinstance(self._mem, FileMemory):
+            raise ValueError('Cannot rewrite the file of a Database '
+                             'from one of its trees')
+
     def _initialize_empty_tree(self):
         self._root_node_page = self._mem.next_available_page
         with self._mem.write_transaction:
             self._mem.set_node(self.LonelyRootNode(page=self._root_node_page))
-        self._mem.set_metadata(self._root_node_page, self._tree_conf)
+            self._mem.set_metadata(self._root_node_page, self._tree_conf)
 
     def _create_partials(self):
         self.LonelyRootNode = partial(LonelyRootNode, self._tree_conf)
@@ -293,6 +521,8 @@ class BPlusTree:
         self.InternalNode = partial(InternalNode, self._tree_conf)
         self.LeafNode = partial(LeafNode, self._tree_conf)
         self.OverflowNode = partial(OverflowNode, self._tree_conf)
+        self.OverflowDirectoryNode = partial(OverflowDirectoryNode,
+                                             self._tree_conf)
         self.Record = partial(Record, self._tree_conf)
         self.Reference = partial(Reference, self._tree_conf)
 
@@ -309,7 +539,9 @@ class BPlusTree:
             node = self._mem.get_node(node.smallest_entry.before)
         return node
 
-    def _iter_slice(self, slice_: slice) -> Iterator[Record]:
+    def _iter_slice(self, slice_: slice,
+                    where: Optional[Callable[[bytes], bool]]=None
+                    ) -> Iterator[Record]:
         if slice_.step is not None:
             raise ValueError('Cannot iterate with a custom step')
 
@@ -322,95 +554,482 @@ class BPlusTree:
         else:
             node = self._search_in_tree(slice_.start, self._root_node)
 
-        while True:
-            for entry in node.entries:
-                if slice_.start is not None and entry.key < slice_.start:
-                    continue
+        with closing(self._mem.iter_chain(node)) as nodes:
+            for node in nodes:
+                for entry in node.entries:
+                    if slice_.start is not None and entry.key < slice_.start:
+                        continue
 
-                if slice_.stop is not None and entry.key >= slice_.stop:
-                    return
+                    if slice_.stop is not None and entry.key >= slice_.stop:
+                        return
+
+                    if where is not None:
+                        value = entry.value_bytes
+                        if value is None:
+                            value = self._get_value_from_record(entry)
+                        if not where(value):
+                            continue
+
+                    yield entry
+
+    def _iter_key_bytes(self, start: bytes,
+                        stop: Optional[bytes]) -> Iterator[Record]:
+        """Iterate over records with start <= serialized key < stop.
+
+        The tree is walked comparing serialized keys, which is only correct
+        for serializers whose bytes sort like the keys.
+        """
+        node = self._root_node
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            child_index = utils.bisect_key_bytes(node.entries, start,
+                                                 right=True)
+            if child_index == 0:
+                page = node.entries[0].before
+            else:
+                page = node.entries[child_index - 1].after
+            node = self._mem.get_node(page)
 
+        first_index = utils.bisect_key_bytes(node.entries, start)
+        while True:
+            for entry in node.entries[first_index:]:
+                if stop is not None and entry.key_bytes >= stop:
+                    return
                 yield entry
 
             if node.next_page:
                 node = self._mem.get_node(node.next_page)
+                first_index = 0
             else:
                 return
 
-    def _search_in_tree(self, key, node) -> 'Node':
-        if isinstance(node, (LonelyRootNode, LeafNode)):
-            return node
+    def _insert(self, key, value, replace: bool):
+        """Insert a value in the tree within a write transaction.
 
-        page = None
+        The value is either bytes or an iterator of slices of the value as
+        yielded by `utils.iter_slice`.
+        """
+        path, node = self._find_leaf(key)
 
-        if key < node.smallest_key:
-            page = node.smallest_entry.before
+        # Check if a record with the key already exists
+        try:
+            existing_record = node.get_entry(key)
+        except ValueError:
+            pass
+        else:
+            if not replace:
+                raise ValueError('Key {} already exists'.format(key))
 
-        elif node.biggest_key <= key:
-            page = node.biggest_entry.after
+            old_overflow_page = existing_record.overflow_page
+            value, overflow_page = self._store_value(value, old_overflow_page)
+            if overflow_page and overflow_page == old_overflow_page:
+                # The value was updated in place, the record is unchanged
+                return
 
+            node.replace_entry(self.Record(key, value=value,
+                                           overflow_page=overflow_page))
+            if node.must_split:
+                # Records have the length of their value, a bigger one may
+                # not fit in the page anymore
+                self._split_leaf(path, node, node.bisect_key(key),
+                                 'balanced')
+            else:
+                self._mem.set_node(node)
+            return
+
+        value, overflow_page = self._store_value(value)
+        record = self.Record(key, value=value, overflow_page=overflow_page)
+
+        self._forget_counts(path)
+        inserted_index = node.insert_entry(record)
+        if node.must_split:
+            self._split_leaf(path, node, inserted_index)
+        else:
+            self._mem.set_node(node)
+
+    def _get(self, key, default=None) -> bytes:
+        """Get a value within a read or write transaction."""
+        node = self._search_in_tree(key, self._root_node)
+        try:
+            record = node.get_entry(key)
+        except ValueError:
+            return default
         else:
-            for ref_a, ref_b in utils.pairwise(node.entries):
-                if ref_a.key <= key < ref_b.key:
-                    page = ref_a.after
+            rv = self._get_value_from_record(record)
+            assert isinstance(rv, bytes)
+            return rv
+
+    def _delete(self, key):
+        """Remove a record from the tree within a write transaction."""
+        path, node = self._find_leaf(key)
+        try:
+            record = node.get_entry(key)
+        except ValueError:
+            raise KeyError(key)
+
+        node.remove_entry(key)
+        if record.overflow_page:
+            self._delete_overflow(record.overflow_page)
+        self._forget_counts(path)
+        self._mem.set_node(node)
+
+    def _batch_insert(self, iterable: Iterable):
+        """Insert sorted elements within a write transaction."""
+        node = None
+        for key, value in iterable:
+
+            if node is not None and high is not None and key >= high:
+                # Leaves emptied by deletes can leave the next keys out
+                # of the bounds of the current leaf
+                self._forget_counts(path)
+                self._mem.set_node(node)
+                node = None
+
+            if node is None:
+                path, node = self._find_leaf(key)
+                high = self._last_leaf[1]
+
+            try:
+                biggest_entry = node.biggest_entry
+            except IndexError:
+                biggest_entry = None
+            if biggest_entry and key <= biggest_entry.key:
+                raise ValueError('Keys to batch insert must be sorted and '
+                                 'bigger than keys currently in the tree')
+
+            value, overflow_page = self._store_value(value)
+            record = self.Record(key, value=value,
+                                 overflow_page=overflow_page)
+
+            node.insert_entry_at_the_end(record)
+            if node.must_split:
+                # Keys are sorted, leaves are left as full as possible
+                self._forget_counts(path)
+                self._split_leaf(path, node, len(node.entries) - 1,
+                                 policy='append')
+                node = None
+
+        if node is not None:
+            self._forget_counts(path)
+            self._mem.set_node(node)
+
+    def _len(self) -> int:
+        return self._subtree_count(self._root_node)
+
+    def _select(self, index: int):
+        """Return the key at a position within a read or write transaction."""
+        length = self._len()
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('Tree index out of range')
+
+        node = self._root_node
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            for child_index in range(node.num_children):
+                count = self._child_count(node, child_index)
+                if index < count:
                     break
+                index -= count
+            node = self._mem.get_node(node.child_page(child_index))
+
+        return node.entries[index].key
+
+    def _store_value(self, value,
+                     overflow_page: Optional[int]=None) -> tuple:
+        """Prepare a value to be put in a record.
+
+        Return a tuple (value, overflow_page), values exceeding the max
+        value_size are written into overflow pages. The overflow pages of
+        the value being replaced, if any, are reused or freed.
+        """
+        if isinstance(value, bytes):
+            if len(value) <= self._tree_conf.value_size:
+                if overflow_page:
+                    self._delete_overflow(overflow_page)
+                return value, None
+            value = utils.iter_slice(value, self.OverflowNode().max_payload)
 
-        assert page is not None
+        return None, self._create_overflow_from_slices(value, overflow_page)
+
+    def _search_in_tree(self, key, node) -> 'Node':
+        if isinstance(node, (LonelyRootNode, LeafNode)):
+            return node
+
+        child_index = node.bisect_key(key, right=True)
+        if child_index == 0:
+            page = node.entries[0].before
+        else:
+            page = node.entries[child_index - 1].after
 
         child_node = self._mem.get_node(page)
-        child_node.parent = node
         return self._search_in_tree(key, child_node)
 
-    def _split_leaf(self, old_node: 'Node'):
-        """Split a leaf Node to allow the tree to grow."""
-        parent = old_node.parent
+    def _find_leaf(self, key) -> Tuple[list, Node]:
+        """Find the leaf where a key belongs and the path leading to it.
+
+        The path lists the ancestors of the leaf from the root as tuples
+        (page, child_index), child_index being the position of the next
+        node of the path among the children of the ancestor. Nodes are not
+        linked to their parents, they may be shared with readers through
+        the cache: the leaf returned is a copy that the caller can modify.
+
+        The leaf receiving an insert is remembered with the bounds of the
+        keys it can hold, so that following inserts of keys within these
+        bounds, like ascending keys landing in the rightmost leaf, do not
+        walk down the tree. The leaf is forgotten as soon as a split or a
+        rewrite of the tree changes the bounds.
+        """
+        if self._last_leaf is not None:
+            low, high, path, page = self._last_leaf
+            if (low is None or low <= key) and (high is None or key < high):
+                return path, self._mem.get_node(page).copy()
+
+        low = high = None
+        path = list()
+        node = self._root_node
+        while not isinstance(node, (LonelyRootNode, LeafNode)):
+            entries = node.entries
+            child_index = node.bisect_key(key, right=True)
+            if child_index == 0:
+                page = entries[0].before
+            else:
+                page = entries[child_index - 1].after
+                low = entries[child_index - 1].key
+            if child_index < len(entries):
+                high = entries[child_index].key
+
+            path.append((node.page, child_index))
+            node = self._mem.get_node(page)
+
+        self._last_leaf = (low, high, path, node.page)
+        return path, node.copy()
+
+    def _search_many_in_tree(self, keys: list, start: int, stop: int,
+                             node: 'Node') -> Iterator[tuple]:
+        """Find the leaves holding a sorted list of keys.
+
+        Yield tuples (start, stop, leaf) meaning that keys[start:stop] belong
+        to leaf. Each node is fetched once no matter how many keys go
+        through it.
+        """
+        if isinstance(node, (LonelyRootNode, LeafNode)):
+            yield start, stop, node
+            return
+
+        entries = node.entries
+        while start < stop:
+            child_index = node.bisect_key(keys[start], right=True)
+            if child_index == 0:
+                page = entries[0].before
+            else:
+                page = entries[child_index - 1].after
+
+            if child_index == len(entries):
+                child_stop = stop
+            else:
+                child_stop = bisect.bisect_left(
+                    keys, entries[child_index].key, start, stop
+                )
+
+            child_node = self._mem.get_node(page)
+            yield from self._search_many_in_tree(keys, start, child_stop,
+                                                 child_node)
+            start = child_stop
+
+    def _forget_counts(self, path: list):
+        """Forget the record counts kept by the ancestors of a leaf.
+
+        Called before records are added to or removed from the leaf. An
+        ancestor that does not know the count below a child does not know
+        its own count either, so once the parent of the leaf forgets it the
+        next changes in the leaf do not rewrite any ancestor. Counts are
+        recomputed when needed and written back by `_write_counts`.
+        """
+        for page, _ in path:
+            self._counts.pop(page, None)
+
+        for page, child_index in reversed(path):
+            node = self._mem.get_node(page)
+            if node.child_count(child_index) is None:
+                break
+            node = node.copy()
+            node.set_child_count(child_index, None)
+            self._mem.set_node(node)
+
+    def _subtree_count(self, node: Node) -> int:
+        """Return the number of records below a node.
+
+        Records are counted in the subtrees whose count is not known, the
+        result is kept until the node changes.
+        """
+        if isinstance(node, (LonelyRootNode, LeafNode)):
+            return len(node.entries)
+
+        count = node.subtree_count
+        if count is not None:
+            return count
+
+        counted_node, count = self._counts.get(node.page, (None, None))
+        if counted_node is not node:
+            count = sum(self._child_count(node, i)
+                        for i in range(node.num_children))
+            self._counts[node.page] = (node, count)
+        return count
+
+    def _child_count(self, node: Node, index: int) -> int:
+        count = node.child_count(index)
+        if count is None:
+            count = self._subtree_count(
+                self._mem.get_node(node.child_page(index))
+            )
+        return count
+
+    def _write_counts(self):
+        """Write the record counts that internal nodes do not know.
+
+        Must be called within a write transaction, before a checkpoint.
+        """
+        self._write_subtree_counts(self._root_node)
+        self._counts.clear()
+
+    def _write_subtree_counts(self, node: Node) -> int:
+        if isinstance(node, (LonelyRootNode, LeafNode)):
+            return len(node.entries)
+
+        counts = [node.child_count(i) for i in range(node.num_children)]
+        if None not in counts:
+            return sum(counts)
+
+        node = node.copy()
+        for child_index, count in enumerate(counts):
+            if count is None:
+                counts[child_index] = self._write_subtree_counts(
+                    self._mem.get_node(node.child_page(child_index))
+                )
+                node.set_child_count(child_index, counts[child_index])
+        self._mem.set_node(node)
+        return sum(counts)
+
+    def _split_index(self, node: Node, inserted_index: int,
+                     policy: Optional[str]=None) -> int:
+        """Choose where to split the entries of a node that must split.
+
+        The entry at inserted_index is the one that made the node overflow.
+        Return the number of entries kept in the node.
+        """
+        num_entries = len(node.entries)
+        policy = policy or self._split_policy
+        if policy == 'adaptive':
+            # Inserting at the end of a node is the sign of ascending keys,
+            # at its beginning of descending keys
+            if inserted_index == num_entries - 1:
+                policy = 'append'
+            elif inserted_index == 0:
+                policy = 'prepend'
+            else:
+                policy = 'balanced'
+
+        if policy == 'append':
+            index = round(num_entries * self._fill_factor)
+        elif policy == 'prepend':
+            index = round(num_entries * (1 - self._fill_factor))
+        else:
+            index = num_entries // 2
+
+        # Both nodes must keep at least one entry, the first entry of the
+        # upper half of references is promoted to the parent
+        lowest = 1
+        highest = num_entries - 1
+        if isinstance(node, (RootNode, InternalNode)):
+            highest -= 1
+        index = min(max(index, lowest), highest)
+
+        # Entries have variable lengths, both halves must fit in a page
+        half = node.__class__(self._tree_conf)
+        while index > lowest:
+            half.entries = node.entries[:index]
+            if not half.must_split:
+                break
+            index -= 1
+        while index < highest:
+            half.entries = node.entries[index:]
+            if not half.must_split:
+                break
+            index += 1
+        return index
+
+    def _split_leaf(self, path: list, old_node: 'Node', inserted_index: int,
+                    policy: Optional[str]=None):
+        """Split a leaf Node to allow the tree to grow.
+
+        The path leading to the leaf is the one given by `_find_leaf`.
+        """
+        self._last_leaf = None
+        for page, _ in path:
+            self._counts.pop(page, None)
         new_node = self.LeafNode(page=self._mem.next_available_page,
                                  next_page=old_node.next_page)
-        new_entries = old_node.split_entries()
+        new_entries = old_node.split_entries(
+            self._split_index(old_node, inserted_index, policy)
+        )
         new_node.entries = new_entries
-        ref = self.Reference(new_node.smallest_key,
-                             old_node.page, new_node.page)
+        # Promote the shortest key separating both leaves, it keeps
+        # internal nodes small
+        separator = self._tree_conf.serializer.shortest_separator(
+            old_node.biggest_key, new_node.smallest_key
+        )
+        ref = self.Reference(separator,
+                             old_node.page, new_node.page,
+                             before_count=len(old_node.entries),
+                             after_count=len(new_node.entries))
 
         if isinstance(old_node, LonelyRootNode):
             # Convert the LonelyRoot into a Leaf
             old_node = old_node.convert_to_leaf()
             self._create_new_root(ref)
-        elif parent.can_add_entry:
-            parent.insert_entry(ref)
-            self._mem.set_node(parent)
         else:
-            parent.insert_entry(ref)
-            self._split_parent(parent)
+            self._insert_in_parent(path, ref, policy)
 
         old_node.next_page = new_node.page
 
         self._mem.set_node(old_node)
         self._mem.set_node(new_node)
 
-    def _split_parent(self, old_node: Node):
-        parent = old_node.parent
+    def _split_parent(self, path: list, old_node: Node, inserted_index: int,
+                      policy: Optional[str]=None):
         new_node = self.InternalNode(page=self._mem.next_available_page)
-        new_entries = old_node.split_entries()
+        new_entries = old_node.split_entries(
+            self._split_index(old_node, inserted_index, policy)
+        )
         new_node.entries = new_entries
 
-        ref = new_node.pop_smallest()
-        ref.before = old_node.page
-        ref.after = new_node.page
+        smallest = new_node.pop_smallest()
+        ref = self.Reference(before=old_node.page, after=new_node.page,
+                             before_count=old_node.subtree_count,
+                             after_count=new_node.subtree_count,
+                             key_bytes=smallest.key_bytes)
 
         if isinstance(old_node, RootNode):
             # Convert the Root into an Internal
             old_node = old_node.convert_to_internal()
             self._create_new_root(ref)
-        elif parent.can_add_entry:
-            parent.insert_entry(ref)
-            self._mem.set_node(parent)
         else:
-            parent.insert_entry(ref)
-            self._split_parent(parent)
+            self._insert_in_parent(path, ref, policy)
 
         self._mem.set_node(old_node)
         self._mem.set_node(new_node)
 
+    def _insert_in_parent(self, path: list, ref: Reference,
+                          policy: Optional[str]=None):
+        """Insert the reference to a new node in the last node of a path."""
+        parent_page, _ = path[-1]
+        parent = self._mem.get_node(parent_page).copy()
+        inserted_index = parent.insert_entry(ref)
+        if parent.must_split:
+            self._split_parent(path[:-1], parent, inserted_index, policy)
+        else:
+            self._mem.set_node(parent)
+
     def _create_new_root(self, reference: Reference):
         new_root = self.RootNode(page=self._mem.next_available_page)
         new_root.insert_entry(reference)
@@ -419,49 +1038,145 @@ class BPlusTree:
         self._mem.set_node(new_root)
 
     def _create_overflow(self, value: bytes) -> int:
-        first_overflow_page = self._mem.next_available_page
-        next_overflow_page = first_overflow_page
+        return self._create_overflow_from_slices(
+            utils.iter_slice(value, self.OverflowNode().max_payload)
+        )
 
-        iterator = utils.iter_slice(value, self.OverflowNode().max_payload)
-        for slice_value, is_last in iterator:
-            current_overflow_page = next_overflow_page
+    def _create_overflow_from_slices(
+            self, iterator: Iterator[tuple],
+            directory_page: Optional[int]=None) -> int:
+        """Write slices of a value to OverflowNodes listed in directories.
 
-            if is_last:
-                next_overflow_page = None
-            else:
-                next_overflow_page = self._mem.next_available_page
+        Slices are consumed one at a time, as yielded by `utils.iter_slice`.
+        When the directory of a value already stored is given, the new value
+        is written over its pages. Return the page of the top directory.
+        """
+        if directory_page is None:
+            writer = OverflowWriter(self._mem, self._tree_conf)
+        else:
+            writer = OverflowWriter(self._mem, self._tree_conf,
+                                    *self._traverse_overflow(directory_page))
 
-            overflow_node = self.OverflowNode(
-                page=current_overflow_page, next_page=next_overflow_page
-            )
-            overflow_node.insert_entry_at_the_end(OpaqueData(data=slice_value))
-            self._mem.set_node(overflow_node)
+        for slice_value, _ in iterator:
+            writer.write_slice(slice_value)
+        return writer.finish()
 
-        return first_overflow_page
+    def _vacuum_into(self, new_mem: FileMemory) -> int:
+        """Write the tree in an empty file and return its root page.
 
-    def _traverse_overflow(self, first_overflow_page: int):
-        """Yield all Nodes of an overflow chain."""
-        next_overflow_page = first_overflow_page
-        while True:
-            overflow_node = self._mem.get_node(next_overflow_page)
-            yield overflow_node
+        Leaves are scanned twice, first to count the pages needed by
+        overflowing values, they are placed at the beginning of the file.
+        """
+        overflow_pages = 0
+        for record in self._iter_slice(slice(None)):
+            if record.overflow_page:
+                length = self._mem.get_node(record.overflow_page).length
+                overflow_pages += count_overflow_pages(self._tree_conf,
+                                                       length)
+
+        builder = TreeBuilder(self._tree_conf,
+                              itertools.count(overflow_pages + 1).__next__,
+                              new_mem.write_node)
+        for record in self._iter_slice(slice(None)):
+            if record.overflow_page:
+                writer = OverflowWriter(new_mem, self._tree_conf,
+                                        write_node=new_mem.write_node)
+                _, pages = self._traverse_overflow(record.overflow_page)
+                for page in pages:
+                    writer.write_slice(
+                        self._mem.get_node(page).smallest_entry.data
+                    )
+                record = self.Record(record.key, overflow_page=writer.finish())
+            builder.add(record)
+
+        assert new_mem.last_page == overflow_pages
+        return builder.finish()
+
+    def _get_tree_pages(self) -> List[int]:
+        """Return the pages of all nodes of the tree, level by level."""
+        pages = [self._root_node_page]
+        level = [self._root_node]
+        while isinstance(level[0], (RootNode, InternalNode)):
+            children = list()
+            for node in level:
+                children.append(node.entries[0].before)
+                children.extend(entry.after for entry in node.entries)
+            pages.extend(children)
+            level = self._mem.get_nodes(children)
+        return pages
+
+    def _move_overflow_pages(self, records: List[Record],
+                             moved_pages: Dict[int, int]):
+        """Move pages of overflowing values and update what refers to them.
+
+        Records given must be the ones in the leaves of the tree.
+        """
+        for record in records:
+            if not record.overflow_page:
+                continue
+
+            directories, pages = self._traverse_overflow(record.overflow_page)
+            for page in pages:
+                if page in moved_pages:
+                    overflow_node = self.OverflowNode(page=moved_pages[page])
+                    overflow_node.entries = self._mem.get_node(page).entries
+                    self._mem.set_node(overflow_node)
+
+            for directory in directories:
+                if (directory.page not in moved_pages and
+                        not moved_pages.keys() & set(directory.entries)):
+                    continue
+                new_directory = self.OverflowDirectoryNode(
+                    page=moved_pages.get(directory.page, directory.page),
+                    level=directory.level, length=directory.length
+                )
+                new_directory.entries = [moved_pages.get(page, page)
+                                         for page in directory.entries]
+                self._mem.set_node(new_directory)
+
+            if record.overflow_page in moved_pages:
+                leaf = self._search_in_tree(record.key,
+                                            self._root_node).copy()
+                leaf.replace_entry(self.Record(
+                    record.key, value=record.value,
+                    overflow_page=moved_pages[record.overflow_page]
+                ))
+                self._mem.set_node(leaf)
+
+    def _traverse_overflow(self, directory_page: int) -> Tuple[list, list]:
+        """Return the directories and the OverflowNode pages of a value.
+
+        All directories of a level are fetched in a single batch.
+        """
+        directories = [self._mem.get_node(directory_page)]
+        level_directories = directories
+        while level_directories[0].level > 0:
+            level_directories = self._mem.get_nodes(
+                page for directory in level_directories
+                for page in directory.entries
+            )
+            directories.extend(level_directories)
 
-            next_overflow_page = overflow_node.next_page
-            if next_overflow_page is None:
-                break
+        pages = [page for directory in level_directories
+                 for page in directory.entries]
+        return directories, pages
 
-    def _read_from_overflow(self, first_overflow_page: int) -> bytes:
-        """Collect all values of an overflow chain."""
+    def _read_from_overflow(self, directory_page: int) -> bytes:
+        """Collect all slices of an overflowing value."""
+        _, pages = self._traverse_overflow(directory_page)
         rv = bytearray()
-        for overflow_node in self._traverse_overflow(first_overflow_page):
+        for overflow_node in self._mem.get_nodes(pages):
             rv.extend(overflow_node.smallest_entry.data)
 
         return bytes(rv)
 
-    def _delete_overflow(self, first_overflow_page: int):
-        """Delete all Nodes in an overflow chain."""
-        for overflow_node in self._traverse_overflow(first_overflow_page):
-            self._mem.del_node(overflow_node)
+    def _delete_overflow(self, directory_page: int):
+        """Delete all Nodes of an overflowing value."""
+        directories, pages = self._traverse_overflow(directory_page)
+        for page in pages:
+            self._mem.del_page(page)
+        for directory in reversed(directories):
+            self._mem.del_node(directory)
 
     def _get_value_from_record(self, record: Record) -> bytes:
         if record.value is not None:
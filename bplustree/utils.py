@@ -1,5 +1,5 @@
 import itertools
-from typing import Iterable
+from typing import Iterable, Optional
 
 
 def pairwise(iterable: Iterable):
@@ -29,3 +29,74 @@ def iter_slice(iterable: bytes, n: int):
         start = stop
         stop = start + n
         yield rv, start >= final_offset
+
+
+def read_exactly(fileobj, n: int) -> bytes:
+    """Read n bytes from a file object, fewer only at the end of the file."""
+    chunks = list()
+    remaining = n
+    while remaining > 0:
+        data = fileobj.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+def iter_stream_slice(fileobj, n: int, head: bytes=b''):
+    """Yield slices of size n read from a file object like `iter_slice`.
+
+    head is data already read from the file object. At most two slices
+    are kept in memory at once.
+    """
+    current = head
+    while True:
+        if len(current) < n:
+            current += read_exactly(fileobj, n - len(current))
+        rv, current = current[:n], current[n:]
+        if not current:
+            current = read_exactly(fileobj, n)
+        is_last = not current
+        yield rv, is_last
+        if is_last:
+            return
+
+
+def prefix_successor(prefix: bytes) -> Optional[bytes]:
+    """Return the smallest bytes bigger than any bytes starting with prefix.
+
+    b'ab' -> b'ac', b'a\xff' -> b'b', b'\xff' -> None (no upper bound)
+    """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+def bisect_key_bytes(entries: list, key_bytes: bytes, right=False) -> int:
+    """Bisect a sorted list of entries comparing their serialized keys.
+
+    Same as `bisect.bisect_left` (or `bisect_right`) but keys are compared
+    as bytes, without deserializing them.
+    """
+    lo, hi = 0, len(entries)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        mid_key_bytes = entries[mid].key_bytes
+        if mid_key_bytes < key_bytes or (right and mid_key_bytes == key_bytes):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def common_prefix(items: list) -> bytes:
+    """Return the longest prefix shared by all bytes in items."""
+    if not items:
+        return b''
+    smallest, biggest = min(items), max(items)
+    for i, byte in enumerate(smallest):
+        if byte != biggest[i]:
+            return smallest[:i]
+    return smallest
@@ -56,5 +56,8 @@ setup(
         'datetime': [
             'temporenc',
         ],
+        'numpy': [
+            'numpy',
+        ],
     },
 )
@@ -0,0 +1,83 @@
+import itertools
+
+import pytest
+
+from bplustree.builder import TreeBuilder
+from bplustree.const import TreeConf
+from bplustree.entry import Record
+from bplustree.memory import FileMemory
+from bplustree.node import LonelyRootNode, RootNode, LeafNode
+from bplustree.serializer import IntSerializer
+from .conftest import filename
+
+tree_conf = TreeConf(4096, 4, 16, 16, IntSerializer())
+
+
+@pytest.fixture
+def mem():
+    mem = FileMemory(filename, tree_conf)
+    yield mem
+    mem.close()
+
+
+def build(mem, num_records):
+    builder = TreeBuilder(tree_conf, itertools.count(1).__next__,
+                          mem.set_node)
+    for i in range(num_records):
+        builder.add(Record(tree_conf, i, str(i).encode()))
+    return builder.finish()
+
+
+def test_build_empty(mem):
+    root = mem.get_node(build(mem, 0))
+    assert isinstance(root, LonelyRootNode)
+    assert root.page == 1
+    assert root.entries == []
+
+
+def test_build_lonely_root(mem):
+    root = mem.get_node(build(mem, 3))
+    assert isinstance(root, LonelyRootNode)
+    assert [r.key for r in root.entries] == [0, 1, 2]
+
+
+@pytest.mark.parametrize('num_records', [4, 5, 6, 7, 100, 1000])
+def test_build_tree(mem, num_records):
+    root = mem.get_node(build(mem, num_records))
+    assert isinstance(root, RootNode)
+    assert root.subtree_count == num_records
+
+    # Leaves are on ascending pages, in key order, and are as full as
+    # possible
+    page = 1
+    keys = list()
+    while page:
+        leaf = mem.get_node(page)
+        assert isinstance(leaf, LeafNode)
+        assert len(leaf.entries) == 3 or not leaf.next_page
+        keys.extend(r.key for r in leaf.entries)
+        assert leaf.next_page is None or leaf.next_page > page
+        page = leaf.next_page
+    assert keys == list(range(num_records))
+
+    # Every internal node has at least two children
+    level = [root]
+    while not isinstance(level[0], LeafNode):
+        assert all(node.num_children >= 2 for node in level)
+        level = [mem.get_node(page) for node in level
+                 for page in [node.entries[0].before] +
+                 [entry.after for entry in node.entries]]
+
+
+def test_build_keeps_few_nodes_in_memory(mem):
+    builder = TreeBuilder(tree_conf, itertools.count(1).__next__,
+                          mem.set_node)
+    for i in range(5000):
+        builder.add(Record(tree_conf, i, str(i).encode()))
+        assert len(builder._levels) <= 8
+        for level in builder._levels:
+            assert len(level.node.entries) < tree_conf.order
+            assert level.full is None or len(level.full[1]) < tree_conf.order
+
+    root = mem.get_node(builder.finish())
+    assert root.subtree_count == 5000
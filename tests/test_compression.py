@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from bplustree.compression import (
+    get_codec, register_codec, compress_page, decompress_page,
+    compressed_length, COMPRESSED_HEADER_LENGTH
+)
+
+
+@pytest.mark.parametrize('name', ['zlib', 'lzma'])
+def test_compress_decompress_page(name):
+    codec = get_codec(name)
+    data = b'{"foo": "bar"}' * 100 + bytes(2696)
+    compressed = compress_page(data, codec, 4096)
+    assert len(compressed) < 4096
+    assert compressed_length(compressed) == len(compressed)
+
+    # Garbage after a compressed page is ignored
+    assert decompress_page(compressed + b'garbage') == data
+
+
+def test_incompressible_page_stays_raw():
+    data = bytes([4]) + os.urandom(511)
+    assert compress_page(data, get_codec('zlib'), len(data)) == data
+    assert compressed_length(data) is None
+    assert decompress_page(data) == data
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec('foo')
+
+    data = bytes([0x80 | 0x7f]) + (1).to_bytes(3, 'little') + b'f'
+    assert compressed_length(data) == COMPRESSED_HEADER_LENGTH + 1
+    with pytest.raises(ValueError):
+        decompress_page(data)
+
+
+def test_register_codec():
+    with pytest.raises(ValueError):
+        register_codec(0x80, 'foo', bytes, bytes)
+
+    register_codec(0x7e, 'reverse', lambda d: d[::-1], lambda d: d[::-1])
+    data = bytes(100)
+    compressed = compress_page(data, get_codec('reverse'), 4096)
+    assert compressed[0] == 0x80 | 0x7e
+    assert decompress_page(compressed) == data
@@ -0,0 +1,142 @@
+import datetime
+from unittest import mock
+
+import pytest
+
+from bplustree.column import IntCol, StrCol, DateTimeCol
+from bplustree.database import Database, TreeMemory
+from bplustree.serializer import StrSerializer
+from .conftest import filename
+
+
+@pytest.fixture
+def db():
+    db = Database(filename)
+    yield db
+    db.close()
+
+
+def test_trees_share_the_file(db):
+    first = db.open_tree('first', order=4)
+    second = db.open_tree('second', key_size=16, serializer=StrSerializer())
+    assert isinstance(first._mem, TreeMemory)
+    assert db.open_tree('first') is first
+
+    for i in range(200):
+        first.insert(i, str(i).encode())
+        second.insert(str(i), b'second')
+    db.close()
+
+    db = Database(filename)
+    first = db.open_tree('first')
+    second = db.open_tree('second', serializer=StrSerializer())
+    assert first._tree_conf.order == 4
+    assert second._tree_conf.key_size == 16
+    assert list(first.keys()) == list(range(200))
+    assert first[150] == b'150'
+    assert second['42'] == b'second'
+    assert db.tree_names() == ['first', 'second']
+    db.close()
+
+
+def test_transaction_commits_once(db):
+    first = db.open_tree('first')
+    second = db.open_tree('second')
+    with mock.patch('bplustree.memory.fsync_file_and_dir') as fsync:
+        with db.write_transaction:
+            first.insert(1, b'foo')
+            second.insert(1, b'bar')
+            assert first[1] == b'foo'
+    assert fsync.call_count == 1
+
+
+def test_transaction_rollback(db):
+    first = db.open_tree('first', order=4)
+    second = db.open_tree('second', order=4)
+    first.batch_insert((i, b'foo') for i in range(10))
+
+    with pytest.raises(ValueError):
+        with db.write_transaction:
+            first.batch_insert((i, b'bar') for i in range(10, 100))
+            second.insert(1, b'bar')
+            db.open_tree('third')
+            raise ValueError()
+
+    assert list(first.keys()) == list(range(10))
+    assert len(second) == 0
+    assert db.tree_names() == ['first', 'second']
+
+    first.insert(10, b'baz')
+    assert first[10] == b'baz'
+
+
+def test_trees_cannot_rewrite_the_file(db):
+    tree = db.open_tree('first')
+    with pytest.raises(ValueError):
+        tree.compact()
+    with pytest.raises(ValueError):
+        tree.vacuum()
+
+
+def test_names_too_long(db):
+    db.open_tree('t' * 59)
+    with pytest.raises(ValueError):
+        db.open_tree('t' * 60)
+
+    columns = [IntCol('id', nullable=False),
+               StrCol('primary_contact_name', 20)]
+    with pytest.raises(ValueError):
+        db.create_table('customer_accounts_by_region_and_segment', columns,
+                        'id', [('primary_contact_name', 'btree')])
+    assert db.table_names() == []
+    assert db.tree_names() == ['t' * 59]
+
+
+def test_open_tree_with_other_page_size(db):
+    with pytest.raises(ValueError):
+        db.tree_memory('first', db._mem._tree_conf._replace(page_size=512))
+
+
+def test_tables(db):
+    columns = [
+        IntCol('id', nullable=False),
+        StrCol('name', 20, default='unknown'),
+        DateTimeCol('created_at'),
+    ]
+    table = db.create_table('users', columns, 'id', [('name', 'btree')],
+                            order=10)
+    with pytest.raises(ValueError):
+        db.create_table('users', columns, 'id', None, order=10)
+
+    table.insert_many([{'id': i, 'name': 'user'} for i in range(50)])
+    table.insert({'id': 50})
+    db.close()
+
+    db = Database(filename)
+    assert db.table_names() == ['users']
+    assert db.tree_names() == ['users', 'users_name']
+    table = db.open_table('users')
+    assert [col.name for col in table.columns] == ['id', 'name',
+                                                   'created_at']
+    assert len(table.get_by_column('name', '=', 'user')) == 50
+    assert table.get(50, ['name']) == {'name': 'unknown'}
+    with pytest.raises(ValueError):
+        db.open_table('groups')
+
+    created_at = datetime.datetime(2020, 1, 1)
+    table.update(3, {'created_at': created_at})
+    assert table.get(3)['created_at'] == created_at
+    db.close()
+
+
+def test_table_with_composite_key(db):
+    columns = [IntCol('tenant_id', nullable=False), StrCol('name', 10)]
+    db.create_table('tenants', columns, ('tenant_id', 'name'), order=10)
+    db.close()
+
+    db = Database(filename)
+    table = db.open_table('tenants')
+    assert table.key_cols == ['tenant_id', 'name']
+    table.insert({'tenant_id': 1, 'name': 'foo'})
+    assert table.get((1, 'foo')) == {'tenant_id': 1, 'name': 'foo'}
+    db.close()
@@ -28,6 +28,13 @@ def test_record_str_serialization():
     assert r1.overflow_page == r2.overflow_page
 
 
+def test_record_variable_length():
+    tree_conf = TreeConf(4096, 4, 16, 512, IntSerializer())
+    data = Record(tree_conf, 42, b'foo').dump()
+    assert len(data) == 2 + 16 + 2 + 3 + 4
+    assert Record(tree_conf, data=data).value == b'foo'
+
+
 def test_record_int_serialization_overflow_value():
     r1 = Record(tree_conf, 42, overflow_page=5)
     data = r1.dump()
@@ -75,50 +82,54 @@ def test_record_lazy_load():
     assert r._data is None
 
 
-def test_reference_int_serialization():
-    r1 = Reference(tree_conf, 42, 1, 2)
-    data = r1.dump()
-
-    r2 = Reference(tree_conf, data=data)
-    assert r1 == r2
-    assert r1.before == r2.before
-    assert r1.after == r2.after
+def test_record_modify_lazy_loaded():
+    data = Record(tree_conf, 42, b'foo').dump()
+    r = Record(tree_conf, data=data)
+    r.value = None
+    r.overflow_page = 3
+    assert r._data is None
+    assert Record(tree_conf, data=r.dump()).key == 42
+    assert Record(tree_conf, data=r.dump()).overflow_page == 3
 
 
-def test_reference_str_serialization():
+def test_reference_key_bytes():
     tree_conf = TreeConf(4096, 4, 40, 40, StrSerializer())
-    r1 = Reference(tree_conf, 'foo', 1, 2)
-    data = r1.dump()
+    r = Reference(tree_conf, before=1, after=2, before_count=10,
+                  after_count=20, key_bytes=b'foo')
+    assert r._key == NOT_LOADED
+    assert r.key == 'foo'
+    assert r == Reference(tree_conf, 'foo', 1, 2)
+    assert (r.before, r.after, r.before_count, r.after_count) == (1, 2, 10, 20)
 
-    r2 = Reference(tree_conf, data=data)
-    assert r1 == r2
-    assert r1.before == r2.before
-    assert r1.after == r2.after
+    r.key = 'bar'
+    assert r.key_bytes == b'bar'
 
 
-def test_reference_repr():
-    r1 = Reference(tree_conf, 42, 1, 2)
-    assert repr(r1) == '<Reference: key=42 before=1 after=2>'
+def test_entries_key_bytes():
+    tree_conf = TreeConf(4096, 4, 40, 40, StrSerializer())
+    assert Reference(tree_conf, 'foo', 1, 2).key_bytes == b'foo'
+    entry = Record(tree_conf, 'foo', b'bar')
+    assert entry.key_bytes == b'foo'
+    loaded = Record(tree_conf, data=entry.dump())
+    assert loaded.key_bytes == b'foo'
+    assert loaded._key == NOT_LOADED
 
 
-def test_reference_lazy_load():
-    data = Reference(tree_conf, 42, 1, 2).dump()
-    r = Reference(tree_conf, data=data)
+def test_record_value_bytes():
+    r = Record(tree_conf, 42, b'foo')
+    assert r.value_bytes == b'foo'
+    loaded = Record(tree_conf, data=r.dump())
+    assert loaded.value_bytes == b'foo'
+    assert loaded._value == NOT_LOADED
 
-    assert r._data == data
-    assert r._key == NOT_LOADED
-    assert r._before == NOT_LOADED
-    assert r._after == NOT_LOADED
+    r = Record(tree_conf, 42, overflow_page=5)
+    assert r.value_bytes is None
+    assert Record(tree_conf, data=r.dump()).value_bytes is None
 
-    _ = r.key
-    assert r._key == 42
-    assert r._before == 1
-    assert r._after == 2
-    assert r._data == data
 
-    r.key = 27
-    assert r._key == 27
-    assert r._data is None
+def test_reference_repr():
+    r1 = Reference(tree_conf, 42, 1, 2)
+    assert repr(r1) == '<Reference: key=42 before=1 after=2>'
 
 
 def test_opaque_data():
@@ -1,13 +1,17 @@
 import io
 import os
 import platform
+import threading
 from unittest import mock
 
 import pytest
 
-from bplustree.node import LeafNode, FreelistNode
+from bplustree.node import LeafNode, FreelistNode, OverflowNode
+from bplustree.entry import OpaqueData
+from bplustree import memory
 from bplustree.memory import (
-    FileMemory, open_file_in_dir, WAL, ReachedEndOfFile, write_to_file
+    FileMemory, open_file_in_dir, WAL, ReachedEndOfFile, UnsupportedFormat,
+    write_to_file
 )
 from bplustree.const import TreeConf
 from .conftest import filename
@@ -37,6 +41,37 @@ def test_file_memory_metadata():
     assert mem.get_metadata() == (6, tree_conf)
 
 
+def test_file_memory_metadata_format_version():
+    mem = FileMemory(filename, tree_conf)
+    mem.set_metadata(6, tree_conf)
+    mem.close()
+
+    # Files of earlier versions have no format version
+    with open(filename, 'r+b') as f:
+        f.seek(24)
+        f.write(bytes(4))
+
+    mem = FileMemory(filename, tree_conf)
+    with pytest.raises(UnsupportedFormat):
+        mem.get_metadata()
+    mem.close()
+
+
+@pytest.mark.parametrize('root_node_page', [216, 0x8080])
+def test_file_memory_metadata_not_compressed(root_node_page):
+    # The first byte of the metadata is not a node type, it may look like
+    # the flag of compressed pages
+    mem = FileMemory(filename, tree_conf)
+    mem.set_metadata(root_node_page, tree_conf)
+    mem.close()
+
+    mem = FileMemory(filename, tree_conf)
+    for _ in range(2):
+        assert mem.get_metadata() == (root_node_page, tree_conf)
+    assert 0 not in mem._page_lengths
+    mem.close()
+
+
 def test_file_memory_next_available_page():
     mem = FileMemory(filename, tree_conf)
     for i in range(1, 100):
@@ -73,6 +108,231 @@ def test_file_memory_freelist():
     assert mem._pop_from_freelist() is None
 
 
+def test_file_memory_compression():
+    mem = FileMemory(filename, tree_conf, compression='zlib')
+    leaf = LeafNode(tree_conf, page=3)
+    overflow = OverflowNode(tree_conf, page=4)
+    overflow.insert_entry_at_the_end(OpaqueData(data=b'foo' * 1000))
+
+    with mem.write_transaction:
+        mem.set_node(leaf)
+        mem.set_node(overflow)
+    # Frames in the WAL are compressed
+    assert mem._wal._committed_pages[3][1] < 100
+    assert mem._wal._committed_pages[4][1] < 100
+
+    # Pages are packed in the file after the metadata page
+    mem.perform_checkpoint(reopen_wal=True)
+    assert os.path.getsize(filename) < 4096 + 200
+    assert mem._page_map.get(4)[1] < 100
+    mem._cache.clear()
+    assert mem.get_node(3) == leaf
+    assert mem.get_node(4).smallest_entry.data == b'foo' * 1000
+    mem.close()
+
+    # Pages are read back without knowing the codec
+    mem = FileMemory(filename, tree_conf)
+    assert mem.last_page == 4
+    assert mem.get_node(4).smallest_entry.data == b'foo' * 1000
+    mem.close()
+
+
+def test_file_memory_compression_in_page_slots():
+    # Files created without compression keep a slot of page_size bytes for
+    # each page
+    mem = FileMemory(filename, tree_conf)
+    mem.set_metadata(1, tree_conf)
+    mem.close()
+    mem = FileMemory(filename, tree_conf, compression='zlib')
+    overflow = OverflowNode(tree_conf, page=4)
+    overflow.insert_entry_at_the_end(OpaqueData(data=b'foo' * 1000))
+    with mem.write_transaction:
+        mem.set_node(overflow)
+
+    mem.perform_checkpoint(reopen_wal=True)
+    assert mem._page_map is None
+    assert os.path.getsize(filename) == 5 * 4096
+    assert mem._page_lengths[4] < 100
+    mem.close()
+
+    mem = FileMemory(filename, tree_conf)
+    assert mem.get_node(4).smallest_entry.data == b'foo' * 1000
+    assert mem._page_lengths[4] < 100
+    mem.close()
+
+
+def test_file_memory_packed_reuses_space():
+    mem = FileMemory(filename, tree_conf, compression='zlib')
+    mem.set_metadata(1, tree_conf)
+    for i in range(20):
+        with mem.write_transaction:
+            for page in range(1, 11):
+                node = OverflowNode(tree_conf, page=page)
+                node.insert_entry_at_the_end(
+                    OpaqueData(data=bytes([i]) * (10 * page))
+                )
+                mem.set_node(node)
+        mem.perform_checkpoint(reopen_wal=True)
+        if i == 1:
+            size = os.path.getsize(filename)
+
+    # Space of the pages rewritten by a checkpoint is reused by the next ones
+    assert os.path.getsize(filename) <= size
+    mem.close()
+
+    mem = FileMemory(filename, tree_conf)
+    for page in range(1, 11):
+        data = mem.get_node(page).smallest_entry.data
+        assert data == bytes([19]) * (10 * page)
+    mem.close()
+
+
+def test_file_memory_packed_wal_recovery():
+    mem = FileMemory(filename, tree_conf, compression='zlib')
+    mem.set_metadata(1, tree_conf)
+    leaf = LeafNode(tree_conf, page=1)
+    with mem.write_transaction:
+        mem.set_node(leaf)
+    # Simulate a crash, the checkpoint happens when the file is reopened
+    mem._fd.close()
+
+    mem = FileMemory(filename, tree_conf)
+    assert mem._page_map is not None
+    assert not mem._wal.needs_recovery
+    assert mem.get_metadata() == (1, tree_conf)
+    assert mem.get_node(1) == leaf
+    assert os.path.getsize(filename) < 2 * 4096
+    mem.close()
+
+
+def test_file_memory_packed_truncate():
+    mem = FileMemory(filename, tree_conf, compression='zlib')
+    mem.set_metadata(1, tree_conf)
+    with mem.write_transaction:
+        for page in range(1, 11):
+            mem.set_node(LeafNode(tree_conf, page=page))
+    mem.perform_checkpoint(reopen_wal=True)
+    size = os.path.getsize(filename)
+
+    with mem.write_transaction:
+        mem.truncate(5)
+    assert mem.last_page == 5
+    assert os.path.getsize(filename) < size
+    mem.close()
+
+    mem = FileMemory(filename, tree_conf)
+    assert mem.last_page == 5
+    assert mem.get_node(5) == LeafNode(tree_conf, page=5)
+    with pytest.raises(ReachedEndOfFile):
+        mem.get_node(6)
+    mem.close()
+
+
+@mock.patch('bplustree.memory.read_from_file',
+            side_effect=memory.read_from_file)
+def test_file_memory_get_nodes(mock_read):
+    mem = FileMemory(filename, tree_conf, compression='zlib')
+    nodes = list()
+    with mem.write_transaction:
+        for page in range(1, 8):
+            n = OverflowNode(tree_conf, page=page)
+            n.insert_entry_at_the_end(OpaqueData(data=bytes([page]) * 10))
+            mem.set_node(n)
+            nodes.append(n)
+    mem.perform_checkpoint(reopen_wal=True)
+    mem._cache.clear()
+
+    with mem.write_transaction:
+        mem.set_node(nodes[3])
+    mem.get_node(5)
+
+    # Pages 1 to 3 and 6 to 7 are read at once, 4 comes from the WAL and
+    # 5 from the cache
+    mock_read.reset_mock()
+    pages = [7, 1, 4, 2, 6, 3, 5, 1]
+    assert [n.smallest_entry.data for n in mem.get_nodes(pages)] == [
+        bytes([page]) * 10 for page in pages
+    ]
+    assert mock_read.call_count == 2
+    assert mem._page_map.get(2)[1] < 100
+    mem.close()
+
+
+@pytest.mark.parametrize('read_ahead', [0, 1, 8])
+@mock.patch('bplustree.memory.advise_will_need')
+def test_file_memory_iter_chain(mock_advise, read_ahead):
+    mem = FileMemory(filename, tree_conf, read_ahead=read_ahead)
+    with mem.write_transaction:
+        for page in range(1, 21):
+            mem.set_node(LeafNode(tree_conf, page=page,
+                                  next_page=page + 1 if page < 20 else None))
+    mem.perform_checkpoint(reopen_wal=True)
+    mem._cache.clear()
+
+    pages = [n.page for n in mem.iter_chain(mem.get_node(1))]
+    assert pages == list(range(1, 21))
+    if read_ahead:
+        # Pages after the ones followed to detect the scan are advised
+        assert mock_advise.call_count == 16
+    else:
+        assert mock_advise.call_count == 0
+
+    # Stopping in the middle of a scan stops the worker
+    threads = threading.active_count()
+    nodes = mem.iter_chain(mem.get_node(1))
+    for node in nodes:
+        if node.page == 10:
+            break
+    nodes.close()
+    assert threading.active_count() == threads
+    mem.close()
+
+
+@mock.patch('bplustree.memory.HAS_PREAD', False)
+def test_file_memory_no_read_ahead_without_pread():
+    mem = FileMemory(filename, tree_conf, read_ahead=8)
+    assert mem._read_ahead == 0
+    mem.close()
+
+
+@mock.patch('bplustree.memory.FileMemory._read_node',
+            side_effect=ValueError('Corrupted'))
+def test_file_memory_iter_chain_error(_):
+    mem = FileMemory(filename, tree_conf)
+    first = LeafNode(tree_conf, page=1, next_page=2)
+    with mem.write_transaction:
+        for page in range(1, 4):
+            mem.set_node(LeafNode(tree_conf, page=page, next_page=page + 1))
+
+    with pytest.raises(ValueError):
+        list(mem.iter_chain(first))
+    mem.close()
+
+
+def test_file_memory_replace_file():
+    other_filename = filename + '-other'
+    other = FileMemory(other_filename, tree_conf, compression='zlib')
+    assert other.compression == 'zlib'
+    leaf = LeafNode(tree_conf, page=2)
+    other.write_node(leaf)
+    other.set_metadata(2, tree_conf)
+    other.close()
+    assert not os.path.exists(other_filename + '-wal')
+
+    mem = FileMemory(filename, tree_conf)
+    assert mem.compression is None
+    with mem.write_transaction:
+        mem.set_node(LeafNode(tree_conf, page=5))
+    with mem.write_transaction:
+        mem.replace_file(other_filename)
+    assert not os.path.exists(other_filename)
+    assert os.path.getsize(filename) < 2 * 4096
+    assert mem._page_map is not None
+    assert mem.get_metadata() == (2, tree_conf)
+    assert mem.get_node(2) == leaf
+    mem.close()
+
+
 def test_open_file_in_dir():
     with pytest.raises(ValueError):
         open_file_in_dir('/foo/bar/does/not/exist')
@@ -123,12 +383,12 @@ def test_file_memory_write_transaction():
 
     with mem.write_transaction:
         mem.set_node(node)
-        assert mem._wal._not_committed_pages == {3: 9}
+        assert mem._wal._not_committed_pages == {3: (12, 4096)}
         assert mem._wal._committed_pages == {}
         assert mem._lock.writer_lock.acquire.call_count == 1
 
     assert mem._wal._not_committed_pages == {}
-    assert mem._wal._committed_pages == {3: 9}
+    assert mem._wal._committed_pages == {3: (12, 4096)}
     assert mem._lock.writer_lock.release.call_count == 1
     assert mem._lock.reader_lock.acquire.call_count == 0
 
@@ -148,7 +408,7 @@ def test_file_memory_write_transaction_error():
     with pytest.raises(ValueError):
         with mem.write_transaction:
             mem.set_node(node)
-            assert mem._wal._not_committed_pages == {3: 9}
+            assert mem._wal._not_committed_pages == {3: (12, 4096)}
             assert mem._wal._committed_pages == {}
             assert mem._lock.writer_lock.acquire.call_count == 1
             raise ValueError('Foo')
@@ -159,6 +419,43 @@ def test_file_memory_write_transaction_error():
     assert mem._cache.get(424242) is None
 
 
+def test_file_memory_nested_write_transaction():
+    mem = FileMemory(filename, tree_conf)
+    mem._lock = mock.Mock()
+
+    with mem.write_transaction:
+        assert mem.in_write_transaction
+        with mem.write_transaction:
+            mem.set_node(node)
+        with mem.read_transaction:
+            assert node == mem.get_node(3)
+        assert mem._wal._not_committed_pages == {3: (12, 4096)}
+
+    assert not mem.in_write_transaction
+    assert mem._wal._committed_pages == {3: (12, 4096)}
+    assert mem._lock.writer_lock.acquire.call_count == 1
+    assert mem._lock.writer_lock.release.call_count == 1
+    assert mem._lock.reader_lock.acquire.call_count == 0
+    mem.close()
+
+
+def test_file_memory_metadata_rollback():
+    mem = FileMemory(filename, tree_conf)
+    mem.set_metadata(1, tree_conf)
+    last_page = mem.last_page
+
+    with pytest.raises(ValueError):
+        with mem.write_transaction:
+            mem.next_available_page
+            mem.set_metadata(2, tree_conf)
+            assert mem.get_metadata() == (2, tree_conf)
+            raise ValueError('Foo')
+
+    assert mem.get_metadata() == (1, tree_conf)
+    assert mem.last_page == last_page
+    mem.close()
+
+
 def test_file_memory_repr():
     mem = FileMemory(filename, tree_conf)
     assert repr(mem) == '<FileMemory: {}>'.format(filename)
@@ -206,7 +503,9 @@ def test_wal_checkpoint():
 
     rv = wal.checkpoint()
     assert list(rv) == [(1, b'1' * 64)]
+    assert os.path.isfile(filename + '-wal') is True
 
+    wal.remove()
     with pytest.raises(ValueError):
         wal.set_page(3, b'3' * 64)
 
@@ -1,10 +1,15 @@
+from unittest import mock
+
 import pytest
 
 from bplustree.const import TreeConf, ENDIAN
 from bplustree.entry import Record, Reference, OpaqueData
 from bplustree.node import (Node, LonelyRootNode, RootNode, InternalNode,
-                            LeafNode, FreelistNode, OverflowNode)
-from bplustree.serializer import IntSerializer
+                            LeafNode, FreelistNode, OverflowNode,
+                            OverflowDirectoryNode)
+from bplustree.serializer import (
+    IntSerializer, SignedIntSerializer, StrSerializer
+)
 
 tree_conf = TreeConf(4096, 7, 16, 16, IntSerializer())
 
@@ -53,6 +58,23 @@ def test_leaf_node_serialization():
     assert n1.next_page == n2.next_page == 66
 
 
+def test_leaf_node_variable_length_records():
+    tree_conf = TreeConf(4096, 1000, 8, 512, IntSerializer())
+    n1 = LeafNode(tree_conf)
+    i = 0
+    while not n1.must_split:
+        n1.insert_entry_at_the_end(Record(tree_conf, i, b'v' * (i % 40)))
+        i += 1
+    # The page was filled by bytes, well beyond what fixed size records
+    # padded to value_size would allow
+    assert 4096 // Record(tree_conf).length < n1.num_children < 999
+    n1.entries.pop()
+
+    n2 = LeafNode(tree_conf, data=n1.dump())
+    assert n1.entries == n2.entries
+    assert [r.value for r in n1.entries] == [r.value for r in n2.entries]
+
+
 def test_leaf_node_serialization_no_next_page():
     n1 = LeafNode(tree_conf)
     data = n1.dump()
@@ -74,10 +96,46 @@ def test_root_node_serialization():
     assert n1.next_page is n2.next_page is None
 
 
+def test_reference_node_prefix_compression():
+    tree_conf = TreeConf(4096, 100, 64, 16, StrSerializer())
+    n1 = InternalNode(tree_conf)
+    for i in range(50):
+        n1.insert_entry(Reference(tree_conf, 'tenant42/{:04d}'.format(i),
+                                  i + 1, i + 2, i, i + 1))
+    data = n1.dump()
+
+    # Keys are not stored in fixed size slots and their prefix only once
+    fixed_size = len(n1.entries) * (tree_conf.key_size + 16)
+    assert len(n1._dump_entries()) < fixed_size / 5
+
+    n2 = InternalNode(tree_conf, data=data)
+    assert n1.entries == n2.entries
+    for r1, r2 in zip(n1.entries, n2.entries):
+        assert (r1.before, r1.after, r1.before_count, r1.after_count) == (
+            r2.before, r2.after, r2.before_count, r2.after_count
+        )
+    assert n2.entries[3].key_bytes == b'tenant42/0003'
+
+
+def test_reference_node_must_split():
+    tree_conf = TreeConf(512, 100, 64, 16, StrSerializer())
+    node = InternalNode(tree_conf)
+    i = 0
+    while not node.must_split:
+        node.insert_entry(Reference(tree_conf, '{:064d}'.format(i), i, i + 1))
+        i += 1
+    # The page was filled by bytes before reaching the order
+    assert node.num_children < node.max_children
+    node.entries.pop()
+    assert len(node.dump()) == 512
+
+
 def test_node_slots():
     n1 = RootNode(tree_conf)
     with pytest.raises(AttributeError):
         n1.foo = True
+    with pytest.raises(AttributeError):
+        n1.parent = None
 
 
 def test_get_node_from_page_data():
@@ -103,7 +161,7 @@ def test_insert_find_get_remove_entries():
     # Test insert_entry
     r42, r43 = Reference(tree_conf, 42, 1, 2), Reference(tree_conf, 43, 2, 3)
     node.insert_entry_at_the_end(r43)
-    node.insert_entry(r42)
+    assert node.insert_entry(r42) == 0
     assert sorted(node.entries) == node.entries
 
     # Test _find_entry_index
@@ -120,6 +178,72 @@ def test_insert_find_get_remove_entries():
     assert node.entries == []
 
 
+@pytest.mark.parametrize('serializer', [IntSerializer(),
+                                        SignedIntSerializer()])
+def test_bisect_key(serializer):
+    conf = TreeConf(4096, 7, 8, 16, serializer)
+    node = LeafNode(conf)
+    for key in (10, 20, 30):
+        node.insert_entry(Record(conf, key, b'foo'))
+
+    assert [node.bisect_key(key) for key in (5, 10, 15, 30, 35)] == [
+        0, 0, 1, 2, 3
+    ]
+    assert node.bisect_key(10, right=True) == 1
+    assert node.bisect_key(30, right=True) == 3
+
+
+def test_find_entries_without_deserializing():
+    conf = TreeConf(4096, 7, 8, 16, SignedIntSerializer())
+    node = LeafNode(conf)
+    for key in (-20, 0, 20):
+        node.insert_entry(Record(conf, key, str(key).encode()))
+    node = LeafNode(conf, data=node.dump())
+
+    with mock.patch.object(SignedIntSerializer, 'deserialize') as deserialize:
+        assert node.get_entry(-20).value == b'-20'
+        assert node.bisect_key(10) == 2
+        with pytest.raises(ValueError):
+            node.get_entry(10)
+        assert node.insert_entry(Record(conf, -10, b'-10')) == 1
+    assert deserialize.call_count == 1
+
+
+def test_split_entries():
+    node = LeafNode(tree_conf)
+    records = [Record(tree_conf, i, b'') for i in range(10)]
+    node.entries = list(records)
+    assert node.split_entries() == records[5:]
+    assert node.entries == records[:5]
+
+    node.entries = list(records)
+    assert node.split_entries(9) == records[9:]
+    assert node.entries == records[:9]
+
+
+def test_reference_node_counts():
+    node = RootNode(tree_conf)
+    assert node.subtree_count == 0
+
+    node.insert_entry(Reference(tree_conf, 43, 2, 3, 5, 6))
+    node.insert_entry(Reference(tree_conf, 42, 1, 2, 4, 7))
+    assert node.entries[1].before_count == 7
+    assert node.subtree_count == 4 + 7 + 6
+
+    assert [node.child_page(i) for i in range(3)] == [1, 2, 3]
+    assert [node.child_count(i) for i in range(3)] == [4, 7, 6]
+
+    node.set_child_count(1, 8)
+    assert node.entries[0].after_count == node.entries[1].before_count == 8
+    assert node.subtree_count == 4 + 8 + 6
+
+    # Unknown counts are kept when the node is dumped
+    node.set_child_count(2, None)
+    assert node.subtree_count is None
+    node = RootNode(tree_conf, data=node.dump())
+    assert [node.child_count(i) for i in range(3)] == [4, 8, None]
+
+
 def test_smallest_biggest():
     node = RootNode(tree_conf)
 
@@ -174,3 +298,18 @@ def test_overflow_node_serialization_no_next_page():
 
     n2 = OverflowNode(tree_conf, data=data)
     assert n1.next_page is n2.next_page is None
+
+
+def test_overflow_directory_node_serialization():
+    n1 = OverflowDirectoryNode(tree_conf, page=4, level=2, length=2 ** 40)
+    n1.entries = [5, 7, 6]
+    data = n1.dump()
+
+    n2 = Node.from_page_data(tree_conf, data=data, page=4)
+    assert isinstance(n2, OverflowDirectoryNode)
+    assert n2.level == 2
+    assert n2.length == 2 ** 40
+    assert n2.entries == [5, 7, 6]
+    assert n2.max_children == 1018
+    assert n2.span == 1018 ** 2
+    assert n2.slice_size == OverflowNode(tree_conf).max_payload
@@ -0,0 +1,444 @@
+import array
+import datetime
+import os
+from unittest import mock
+
+import pytest
+
+from bplustree.column import IntCol, StrCol, BoolCol, FloatCol, DateTimeCol
+from bplustree.schema import Schema, encode_index_value
+
+table_name = 'bplustree-test-table'
+filenames = [
+    '/tmp/' + table_name + suffix
+    for suffix in ('.db', '_name.idx', '_salary.idx')
+]
+
+
+@pytest.fixture(autouse=True)
+def clean_table_files():
+    def clean():
+        for filename in filenames:
+            for path in (filename, filename + '-wal'):
+                if os.path.isfile(path):
+                    os.unlink(path)
+
+    clean()
+    yield
+    clean()
+
+
+@pytest.fixture
+def schema():
+    columns = [
+        IntCol('id', nullable=False),
+        StrCol('name', 20),
+        BoolCol('is_active', nullable=False),
+        FloatCol('salary', nullable=False),
+        DateTimeCol('created_at', nullable=False),
+    ]
+    schema = Schema(table_name, columns, 'id',
+                    [('name', 'btree'), ('salary', 'btree')], order=6)
+    yield schema
+    schema.close()
+
+
+def employee(id_, name, salary):
+    return {
+        'id': id_,
+        'name': name,
+        'is_active': True,
+        'salary': salary,
+        'created_at': datetime.datetime(2020, 1, 1),
+    }
+
+
+@pytest.mark.parametrize('col,values', [
+    (IntCol('i'), [-2 ** 40, -1, 0, 1, 255, 256, 2 ** 40]),
+    (StrCol('s', 5), ['', 'a', 'ab', 'abc', 'b']),
+    (BoolCol('b'), [False, True]),
+    (FloatCol('f'), [float('-inf'), -2.5, -1.0, 0.0, 0.5, 3.0, 1e300]),
+    (DateTimeCol('d'), [datetime.datetime(1999, 12, 31, 23, 59, 59),
+                        datetime.datetime(2000, 1, 1)]),
+])
+def test_encode_index_value(col, values):
+    encoded = [encode_index_value(col, value) for value in values]
+    assert sorted(encoded) == encoded
+    assert all(len(e) == col.get_length() for e in encoded)
+
+
+def test_schema_negative_keys(schema):
+    for i in (3, -1, 0, -300, 2 ** 40):
+        schema.insert(employee(i, 'john', float(i)))
+
+    assert [r['id'] for r in schema.select(['id'])] == [
+        -300, -1, 0, 3, 2 ** 40
+    ]
+    assert schema.get(-1)['salary'] == -1.0
+    assert schema.get(-2) is None
+    assert [r['id'] for r in schema.get_by_key('<', 0)] == [-300, -1]
+
+
+def test_schema_serialization(schema):
+    data = employee(1, 'Zoë ', 1234.5)
+    data['created_at'] = datetime.datetime(1960, 2, 3, 4, 5, 6, 789)
+    record = schema.serilize_record(data)
+    assert len(record) == schema.record_length == 1 + 8 + 20 + 1 + 8 + 8
+    assert schema.deserialize_record(record) == data
+
+    with pytest.raises(ValueError):
+        schema.insert(employee(2, 'é' * 11, 0.0))
+    with pytest.raises(ValueError):
+        schema.serilize_record(employee(2 ** 63, 'john', 0.0))
+
+
+def test_schema_aware_datetime(schema):
+    data = employee(1, 'john', 1000.0)
+    tz = datetime.timezone(datetime.timedelta(hours=2))
+    data['created_at'] = datetime.datetime(2020, 1, 1, 2, 30, tzinfo=tz)
+    schema.insert(data)
+    utc = datetime.datetime(2020, 1, 1, 0, 30)
+    assert schema.get(1)['created_at'] == utc
+    assert len(schema.where([('created_at', '=', data['created_at'])])) == 1
+    assert encode_index_value(schema.col_dict['created_at'],
+                              data['created_at']) == \
+        encode_index_value(schema.col_dict['created_at'], utc)
+
+
+def test_schema_projection(schema):
+    for i in range(5):
+        schema.insert(employee(i, 'name{}'.format(i), 1000.0 + i))
+
+    assert schema.get(3, columns=['salary', 'name']) == {
+        'name': 'name3', 'salary': 1003.0
+    }
+    assert schema.select(['id']) == [{'id': i} for i in range(5)]
+    assert schema.select()[4] == employee(4, 'name4', 1004.0)
+    assert schema.get_by_key('>', 2, columns=['id']) == [{'id': 3}, {'id': 4}]
+    assert schema.get_by_column('salary', '>=', 1003.0, ['name']) == [
+        {'name': 'name3'}, {'name': 'name4'}
+    ]
+    assert schema.get_by_column('is_active', '=', True, ['id'])[0] == {
+        'id': 0
+    }
+
+    # Datetimes and strings not asked for are never decoded
+    with mock.patch('bplustree.schema.micros_to_datetime') as mock_micros, \
+            mock.patch('bplustree.schema.decode_string') as mock_string:
+        schema._projections.clear()
+        assert schema.select(['salary'])[0] == {'salary': 1000.0}
+    assert not mock_micros.called
+    assert not mock_string.called
+
+    with pytest.raises(ValueError):
+        schema.get(1, columns=['foo'])
+
+
+def test_schema_null_values(schema):
+    data = employee(1, None, 1000.0)
+    schema.insert(data)
+    assert schema.get(1) == data
+    assert schema.get(1, ['name', 'salary']) == {'name': None,
+                                                 'salary': 1000.0}
+    assert schema.get_by_column('name', '=', '') == []
+
+    with pytest.raises(ValueError):
+        schema.insert(employee(2, 'john', None))
+
+
+def test_schema_where(schema):
+    for i in range(20):
+        name = None if i % 5 == 0 else 'name{}'.format(i % 3)
+        data = employee(i, name, 1000.0 - 100 * i)
+        data['created_at'] = datetime.datetime(1969, 12, 31) + \
+            datetime.timedelta(hours=3 * i)
+        schema.insert(data)
+
+    def ids(conditions):
+        return [r['id'] for r in schema.where(conditions, ['id'])]
+
+    assert ids([('name', '=', 'name1')]) == [1, 4, 7, 13, 16, 19]
+    assert ids([('name', '<', 'name1')]) == [3, 6, 9, 12, 18]
+    assert ids([('name', 'IN', ['name2', 'name0', None])]) == [
+        2, 3, 6, 8, 9, 11, 12, 14, 17, 18
+    ]
+    assert ids([('name', 'IS NULL')]) == [0, 5, 10, 15]
+    assert len(ids([('name', 'IS NOT NULL')])) == 16
+    assert ids([('salary', '<', -500.0), ('name', '>=', 'name1')]) == [
+        16, 17, 19
+    ]
+    assert ids([('salary', '>', 0.0)]) == list(range(10))
+    assert ids([('created_at', '<', datetime.datetime(1970, 1, 1))]) == list(
+        range(8)
+    )
+    assert ids([('created_at', '>=', datetime.datetime(1970, 1, 1, 18))]) == (
+        list(range(14, 20))
+    )
+    assert ids([('id', '>', 17), ('is_active', '=', True)]) == [18, 19]
+    assert ids([]) == list(range(20))
+
+    # Rows that do not match are never decoded
+    with mock.patch.object(schema, 'deserialize_record',
+                           wraps=schema.deserialize_record) as mock_decode:
+        schema.where([('name', '=', 'name1')])
+    assert mock_decode.call_count == 6
+
+    with pytest.raises(ValueError):
+        schema.where([('foo', '=', 1)])
+    with pytest.raises(ValueError):
+        schema.where([('name', 'LIKE', 'n%')])
+
+
+@pytest.fixture
+def filled_schema(schema):
+    for i in range(10):
+        data = employee(i, 'name{}'.format(i), 1000.0 + i)
+        data['is_active'] = i % 2 == 0
+        data['created_at'] = datetime.datetime(2020, 1, 1, i)
+        schema.insert(data)
+    schema.update(3, {'name': None})
+    return schema
+
+
+@mock.patch('bplustree.schema.numpy', None)
+def test_schema_scan_batches(filled_schema):
+    batches = list(filled_schema.scan_batches(batch_size=4))
+    assert [len(batch['id']) for batch in batches] == [4, 4, 2]
+
+    first = batches[0]
+    assert isinstance(first['id'], array.array)
+    assert list(first['id']) == [0, 1, 2, 3]
+    assert list(first['salary']) == [1000.0, 1001.0, 1002.0, 1003.0]
+    assert list(first['is_active']) == [1, 0, 1, 0]
+    assert first['created_at'][1] == datetime.datetime(2020, 1, 1, 1)
+    assert first['name'] == ['name0', 'name1', 'name2', None]
+    assert batches[1]['name'] == ['name4', 'name5', 'name6', 'name7']
+
+    batches = list(filled_schema.scan_batches(
+        ['salary'], conditions=[('id', '>=', 5)]
+    ))
+    assert batches == [{'salary': array.array('d', [1005.0, 1006.0, 1007.0,
+                                                    1008.0, 1009.0])}]
+
+    with pytest.raises(ValueError):
+        list(filled_schema.scan_batches(batch_size=0))
+
+
+def test_schema_scan_batches_numpy(filled_schema):
+    numpy = pytest.importorskip('numpy')
+    batches = list(filled_schema.scan_batches(batch_size=4))
+    assert [len(batch['id']) for batch in batches] == [4, 4, 2]
+
+    first = batches[0]
+    assert first['id'].tolist() == [0, 1, 2, 3]
+    assert first['salary'].sum() == 4006.0
+    assert first['is_active'].tolist() == [True, False, True, False]
+    assert first['created_at'][1] == numpy.datetime64('2020-01-01T01:00')
+    assert first['name'] == ['name0', 'name1', 'name2', None]
+
+
+def test_schema_indexes(schema):
+    for i in range(20):
+        schema.insert(employee(i, 'name{}'.format(i % 4), 1000.0 + i))
+
+    records = schema.get_by_column('name', '=', 'name1')
+    assert [r['id'] for r in records] == [1, 5, 9, 13, 17]
+    assert all(r['name'] == 'name1' for r in records)
+
+    assert [r['id'] for r in schema.get_by_column('salary', '<', 1003.0)] == [
+        0, 1, 2
+    ]
+    assert [r['id'] for r in schema.get_by_column('salary', '>=', 1018.0)] == [
+        18, 19
+    ]
+    assert len(schema.get_by_column('name', '<=', 'name1')) == 10
+    assert len(schema.get_by_column('name', '>', 'name1')) == 10
+
+    # Columns without index are scanned
+    assert len(schema.get_by_column('is_active', '=', True)) == 20
+
+
+def test_schema_indexes_other_operators(schema):
+    for i in range(12):
+        schema.insert(employee(i, 'name{}'.format(i % 4) if i % 3 else None,
+                               1000.0 + i))
+
+    records = schema.get_by_column('name', 'IN', ['name2', 'name1', None])
+    assert [r['id'] for r in records] == [1, 5, 2, 10]
+    assert schema.get_by_column('name', 'IN', []) == []
+    records = schema.get_by_column('name', 'IS NULL', None)
+    assert [r['id'] for r in records] == [0, 3, 6, 9]
+    assert len(schema.get_by_column('name', 'IS NOT NULL', None)) == 8
+    assert schema.get_by_column('name', '=', None) == []
+    assert [r['id'] for r in schema.get_by_column('salary', 'IN', [
+        1004.0, 1001.0
+    ])] == [1, 4]
+
+
+def test_schema_update_delete(schema):
+    for i in range(10):
+        schema.insert(employee(i, 'john', 1000.0))
+
+    schema.update(3, {'name': 'jane', 'salary': 2000.0})
+    assert schema.get(3)['name'] == 'jane'
+    assert [r['id'] for r in schema.get_by_column('name', '=', 'jane')] == [3]
+    assert len(schema.get_by_column('name', '=', 'john')) == 9
+    assert [r['id'] for r in schema.get_by_column('salary', '>', 1000.0)] == [
+        3
+    ]
+
+    schema.delete(5)
+    assert schema.get(5) is None
+    records = schema.get_by_column('name', '=', 'john')
+    assert 5 not in [r['id'] for r in records]
+    assert len(schema.indexes['salary']) == 9
+
+    with pytest.raises(KeyError):
+        schema.delete(5)
+    with pytest.raises(KeyError):
+        schema.update(5, {'name': 'jane'})
+    with pytest.raises(ValueError):
+        schema.update(3, {'id': 4})
+
+
+def test_schema_string_key():
+    columns = [StrCol('name', 10, nullable=False), IntCol('age')]
+    schema = Schema(table_name, columns, 'name', None, order=6)
+    for name in ['bob', 'alice', 'bo', 'carol']:
+        schema.insert({'name': name, 'age': len(name)})
+
+    assert [r['name'] for r in schema.select(['name'])] == [
+        'alice', 'bo', 'bob', 'carol'
+    ]
+    assert schema.get('bob') == {'name': 'bob', 'age': 3}
+    assert schema.get_by_key('>', 'bo', ['name']) == [
+        {'name': 'bob'}, {'name': 'carol'}
+    ]
+    with pytest.raises(ValueError):
+        schema.insert({'age': 1})
+    schema.close()
+
+
+def test_schema_composite_key():
+    columns = [
+        IntCol('tenant_id', nullable=False),
+        DateTimeCol('ts', nullable=False),
+        StrCol('name', 20),
+    ]
+    schema = Schema(table_name, columns, ('tenant_id', 'ts'),
+                    [('name', 'btree')], order=6)
+    day = datetime.timedelta(days=1)
+    start = datetime.datetime(1960, 1, 1)
+    schema.insert_many(
+        {'tenant_id': tenant, 'ts': start + i * day, 'name': 'n{}'.format(i)}
+        for tenant in (2, 1) for i in range(5, -1, -1)
+    )
+
+    keys = [(r['tenant_id'], r['ts']) for r in schema.select()]
+    assert keys == sorted(keys)
+    assert schema.get((1, start + day), ['name']) == {'name': 'n1'}
+    assert len(schema.get_by_key('=', (2,))) == 6
+    assert schema.get_by_key('>=', (2, start + 4 * day), ['name']) == [
+        {'name': 'n4'}, {'name': 'n5'}
+    ]
+    assert schema.get_by_key('<', (2,), ['tenant_id'])[-1] == {'tenant_id': 1}
+    records = schema.get_by_column('name', '=', 'n3')
+    assert [r['tenant_id'] for r in records] == [1, 2]
+
+    schema.update((1, start), {'name': 'first'})
+    assert schema.get_by_column('name', '=', 'first')[0]['ts'] == start
+    with pytest.raises(ValueError):
+        schema.update((1, start), {'tenant_id': 3})
+    schema.delete((2, start))
+    assert schema.get((2, start)) is None
+    with pytest.raises(ValueError):
+        schema.get(1)
+    with pytest.raises(ValueError):
+        schema.get((1, start, 'n0'))
+    schema.close()
+
+
+def test_schema_insert_many(schema):
+    schema.insert_many(employee(i, 'name{}'.format(i % 3), 1000.0 + i)
+                       for i in range(0, 100, 2))
+    errors = schema.insert_many(
+        [employee(i, 'name{}'.format(i % 3), 1000.0 + i)
+         for i in range(99, 0, -2)] +
+        [employee(200, 'name0', 1.0)]
+    )
+    assert errors == []
+    assert [r['id'] for r in schema.select(['id'])] == list(range(100)) + [
+        200
+    ]
+    assert len(schema.get_by_column('name', '=', 'name0')) == 35
+    assert len(schema.indexes['salary']) == 101
+
+
+def test_schema_insert_many_errors(schema):
+    schema.insert(employee(1, 'john', 1.0))
+    rows = [
+        employee(5, 'jane', 5.0),
+        employee(1, 'john', 1.0),  # Existing key
+        employee(3, 'jane', 'foo'),  # Invalid value
+        employee(0, 'jane', 0.0),
+        employee(5, 'jane', 5.0),  # Duplicate key
+    ]
+    with pytest.raises(ValueError):
+        schema.insert_many(rows)
+    assert len(schema.tree) == 1
+
+    with pytest.raises(ValueError):
+        schema.insert_many([rows[0], rows[1]])
+    assert len(schema.tree) == 1
+    assert len(schema.indexes['name']) == 1
+
+    errors = schema.insert_many(rows, skip_errors=True)
+    assert [i for i, _ in errors] == [1, 2, 4]
+    assert all(isinstance(e, ValueError) for _, e in errors)
+    assert str(errors[0][1]) == 'Key 1 already exists'
+    assert str(errors[2][1]) == 'Key 5 already exists'
+    assert [r['id'] for r in schema.get_by_column('name', '=', 'jane')] == [
+        0, 5
+    ]
+
+
+def test_schema_insert_rollback(schema):
+    schema.insert(employee(1, 'john', 1000.0))
+    with pytest.raises(ValueError) as exc_info:
+        schema.insert(employee(1, 'jane', 2000.0))
+    assert str(exc_info.value) == 'Key 1 already exists'
+
+    assert schema.get_by_column('name', '=', 'jane') == []
+    assert len(schema.indexes['name']) == 1
+    assert len(schema.indexes['salary']) == 1
+
+
+def test_schema_transaction(schema):
+    schema.insert(employee(1, 'john', 1000.0))
+    with schema.transaction():
+        schema.insert(employee(2, 'jane', 2000.0))
+        schema.update(1, {'name': 'jack'})
+        schema.delete(2)
+        assert schema.get(1, ['name']) == {'name': 'jack'}
+
+    assert [r['id'] for r in schema.select()] == [1]
+    assert schema.get_by_column('name', '=', 'jack')[0]['id'] == 1
+
+    with pytest.raises(ValueError):
+        with schema.transaction():
+            schema.insert(employee(3, 'joe', 3000.0))
+            schema.update(1, {'name': 'jim'})
+            raise ValueError()
+
+    assert [r['id'] for r in schema.select()] == [1]
+    assert schema.get_by_column('name', '=', 'jim') == []
+    assert len(schema.indexes['name']) == 1
+    assert len(schema.indexes['salary']) == 1
+
+
+def test_schema_invalid_index():
+    columns = [IntCol('id'), StrCol('name', 20)]
+    with pytest.raises(ValueError):
+        Schema(table_name, columns, 'id', [('name', 'hash')], order=6)
+    with pytest.raises(ValueError):
+        Schema(table_name, columns, 'id', [('foo', 'btree')], order=6)
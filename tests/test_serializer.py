@@ -5,7 +5,8 @@ import uuid
 import pytest
 
 from bplustree.serializer import (
-    IntSerializer, StrSerializer, UUIDSerializer, DatetimeUTCSerializer
+    IntSerializer, SignedIntSerializer, FloatSerializer, StrSerializer,
+    BytesSerializer, UUIDSerializer, DatetimeUTCSerializer
 )
 
 
@@ -16,6 +17,39 @@ def test_int_serializer():
     assert repr(s) == 'IntSerializer()'
 
 
+def test_signed_int_serializer():
+    s = SignedIntSerializer()
+    assert s.serialize(0, 2) == b'\x80\x00'
+    assert s.serialize(-1, 2) == b'\x7f\xff'
+    values = [-2 ** 63, -256, -1, 0, 1, 255, 2 ** 63 - 1]
+    serialized = [s.serialize(v, 8) for v in values]
+    assert sorted(serialized) == serialized
+    assert [s.deserialize(data) for data in serialized] == values
+    with pytest.raises(ValueError):
+        s.serialize(2 ** 15, 2)
+    assert s.order_preserving
+    assert not IntSerializer().order_preserving
+
+
+def test_float_serializer():
+    s = FloatSerializer()
+    values = [float('-inf'), -1e300, -2.5, -0.0, 0.0, 1e-300, 3.0,
+              float('inf')]
+    serialized = [s.serialize(v, 8) for v in values]
+    assert sorted(serialized) == serialized
+    assert [s.deserialize(data) for data in serialized] == values
+    assert str(s.deserialize(s.serialize(-0.0, 8))) == '-0.0'
+    assert s.serialize(float('nan'), 8) > s.serialize(float('inf'), 8)
+    with pytest.raises(ValueError):
+        s.serialize(1.0, 4)
+
+
+def test_serialize_search_key():
+    assert BytesSerializer().serialize_search_key(b'foobar', 3) == b'foobar'
+    assert StrSerializer().serialize_search_key('foobar', 3) == b'foobar'
+    assert SignedIntSerializer().serialize_search_key(0, 1) == b'\x80'
+
+
 def test_serializer_slots():
     s = IntSerializer()
     with pytest.raises(AttributeError):
@@ -29,6 +63,32 @@ def test_str_serializer():
     assert repr(s) == 'StrSerializer()'
 
 
+def test_bytes_serializer():
+    s = BytesSerializer()
+    assert s.serialize(b'foo', 3) == b'foo'
+    assert s.deserialize(b'foo') == b'foo'
+    assert s.serialize_prefix(b'fo') == b'fo'
+    assert repr(s) == 'BytesSerializer()'
+
+
+def test_serialize_prefix():
+    assert StrSerializer().serialize_prefix('fé') == 'fé'.encode()
+    assert UUIDSerializer().serialize_prefix(b'\x01') == b'\x01'
+    assert UUIDSerializer().serialize_prefix('0102-03') == b'\x01\x02\x03'
+    with pytest.raises(ValueError):
+        UUIDSerializer().serialize_prefix(bytes(17))
+    with pytest.raises(ValueError):
+        IntSerializer().serialize_prefix(1)
+
+
+def test_shortest_separator():
+    assert StrSerializer().shortest_separator('abc', 'abzzz') == 'abz'
+    assert StrSerializer().shortest_separator('a', 'bcd') == 'b'
+    assert StrSerializer().shortest_separator('ab', 'abc') == 'abc'
+    assert BytesSerializer().shortest_separator(b'a\xff', b'b\x00') == b'b'
+    assert IntSerializer().shortest_separator(1, 1000) == 1000
+
+
 def test_uuid_serializer():
     s = UUIDSerializer()
     id_ = uuid.uuid4()
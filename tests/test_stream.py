@@ -0,0 +1,88 @@
+import io
+
+import pytest
+
+from bplustree.tree import BPlusTree
+from bplustree.stream import OverflowReader, count_overflow_pages
+from .conftest import filename
+
+
+@pytest.fixture
+def data():
+    return bytes(i % 251 for i in range(20000))
+
+
+@pytest.fixture
+def reader(data):
+    b = BPlusTree(filename, page_size=512, value_size=16)
+    with b._mem.write_transaction:
+        first_overflow_page = b._create_overflow(data)
+    yield OverflowReader(b._mem, first_overflow_page)
+    b.close()
+
+
+def test_overflow_reader_read(reader, data):
+    assert reader.readable()
+    assert reader.seekable()
+    assert not reader.writable()
+    assert reader.read(10) == data[:10]
+    assert reader.tell() == 10
+    assert reader.read(1000) == data[10:1010]
+    assert reader.read() == data[1010:]
+    assert reader.read() == b''
+    assert reader.tell() == len(data)
+
+
+def test_overflow_reader_readinto(reader, data):
+    buffer = bytearray(700)
+    assert reader.readinto(buffer) > 0
+    reader.seek(0)
+    assert io.BufferedReader(reader).read() == data
+
+
+def test_overflow_reader_seek(reader, data):
+    assert reader.seek(15000) == 15000
+    assert reader.read(10) == data[15000:15010]
+    assert reader.seek(-10, io.SEEK_CUR) == 15000
+    assert reader.read(10) == data[15000:15010]
+    assert reader.seek(5) == 5
+    assert reader.read(600) == data[5:605]
+    assert reader.seek(-3, io.SEEK_END) == len(data) - 3
+    assert reader.read() == data[-3:]
+    assert reader.seek(30000) == 30000
+    assert reader.read() == b''
+
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+    with pytest.raises(ValueError):
+        reader.seek(0, 42)
+
+
+def test_overflow_reader_closed(reader):
+    reader.close()
+    with pytest.raises(ValueError):
+        reader.read()
+    with pytest.raises(ValueError):
+        reader.seek(0)
+
+
+def test_overflow_reader_directory_levels(data):
+    b = BPlusTree(filename, page_size=64, value_size=16)
+    with b._mem.write_transaction:
+        directory_page = b._create_overflow(data)
+        assert b._mem.get_node(directory_page).level == 2
+
+    reader = OverflowReader(b._mem, directory_page)
+    for offset in (19000, 0, 52 * 100 - 3, 52 * 1000 + 1):
+        reader.seek(offset)
+        assert reader.read(100) == data[offset:offset + 100]
+    b.close()
+
+
+@pytest.mark.parametrize('length', [1, 52, 53, 520, 521, 5200, 5201, 20000])
+def test_count_overflow_pages(length):
+    b = BPlusTree(filename, page_size=64, value_size=16)
+    with b._mem.write_transaction:
+        b._create_overflow(b'a' * length)
+    assert count_overflow_pages(b._tree_conf, length) == b._mem.last_page - 1
+    b.close()
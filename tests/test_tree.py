@@ -1,15 +1,19 @@
 from datetime import datetime, timezone, timedelta
+import io
 import itertools
+import os
+import random
 from unittest import mock
 import uuid
 
 import pytest
 
-from bplustree.memory import FileMemory
-from bplustree.node import LonelyRootNode, LeafNode
+from bplustree.memory import FileMemory, UnsupportedFormat
+from bplustree.node import LonelyRootNode, LeafNode, OverflowNode
 from bplustree.tree import BPlusTree
 from bplustree.serializer import (
-    IntSerializer, StrSerializer, UUIDSerializer, DatetimeUTCSerializer
+    IntSerializer, SignedIntSerializer, FloatSerializer, StrSerializer,
+    BytesSerializer, UUIDSerializer, DatetimeUTCSerializer
 )
 from .conftest import filename
 
@@ -33,6 +37,21 @@ def test_create_and_load_file():
     b.close()
 
 
+def test_open_file_of_other_format():
+    b = BPlusTree(filename)
+    b.insert(1, b'foo')
+    b.close()
+    with open(filename, 'r+b') as f:
+        f.seek(24)
+        f.write(bytes(4))
+    size = os.path.getsize(filename)
+
+    # The file is not mistaken for an empty one and overwritten
+    with pytest.raises(UnsupportedFormat):
+        BPlusTree(filename)
+    assert os.path.getsize(filename) == size
+
+
 @mock.patch('bplustree.tree.BPlusTree.close')
 def test_closing_context_manager(mock_close):
     with BPlusTree(filename, page_size=512, value_size=128) as b:
@@ -77,6 +96,100 @@ def test_get_tree(b):
     assert b.get(2, 'bar') == 'bar'
 
 
+def test_get_many_tree(b):
+    assert b.get_many([]) == []
+    assert b.get_many([1, 2]) == [None, None]
+
+    for i in range(0, 200, 2):
+        b.insert(i, str(i).encode())
+    b.insert(201, b'x' * 5000)
+
+    keys = [150, 3, 201, 0, 198, 150, 77, 42]
+    expected = [b'150', None, b'x' * 5000, b'0', b'198', b'150', None, b'42']
+    assert b.get_many(keys) == expected
+    assert b.get_many(keys, default=b'') == [v or b'' for v in expected]
+    assert b.get_many(keys) == [b.get(k) for k in keys]
+
+
+def test_open_value(b):
+    b.insert(1, b'foo')
+    b.insert(2, b'x' * 5000)
+
+    with b.open_value(1) as f:
+        assert f.read() == b'foo'
+
+    with b.open_value(2) as f:
+        f.seek(4000)
+        assert f.read() == b'x' * 1000
+
+    with pytest.raises(KeyError):
+        b.open_value(3)
+
+
+def test_insert_stream(b):
+    value = bytes(i % 251 for i in range(50000))
+    b.insert_stream(1, io.BytesIO(b'foo'))
+    b.insert_stream(2, io.BytesIO(value))
+    assert b.get(1) == b'foo'
+    assert b.get(2) == value
+
+    with pytest.raises(ValueError):
+        b.insert_stream(2, io.BytesIO(b'bar'))
+
+    b.insert_stream(2, io.BytesIO(value[::-1]), replace=True)
+    b.insert_stream(1, io.BytesIO(value), replace=True)
+    with b.open_value(1) as f:
+        assert f.read() == value
+    assert b.get(2) == value[::-1]
+    assert len(b) == 2
+
+
+def test_replace_with_bigger_values():
+    b = BPlusTree(filename, page_size=512, order=50)
+    for i in range(40):
+        b.insert(i, b'')
+    num_leaves = len(leaf_pages(b))
+
+    # Values growing in place end up splitting their leaves
+    for i in range(40):
+        b.insert(i, b'x' * 32, replace=True)
+    assert len(leaf_pages(b)) > num_leaves
+    assert len(b) == 40
+    assert dict(b.items()) == {i: b'x' * 32 for i in range(40)}
+    b.close()
+
+
+def test_replace_overflow_in_place(b):
+    slice_size = b.OverflowNode().max_payload
+    value = bytearray(os.urandom(slice_size * 10))
+    b.insert(1, bytes(value))
+    _, pages = b._traverse_overflow(b._root_node.get_entry(1).overflow_page)
+
+    value[slice_size * 4 + 2] ^= 0xff
+    with mock.patch('bplustree.memory.FileMemory.set_node', autospec=True,
+                    side_effect=FileMemory.set_node) as mock_set_node:
+        b.insert(1, bytes(value), replace=True)
+    assert [c[0][1].page for c in mock_set_node.call_args_list] == [pages[4]]
+    assert b.get(1) == value
+
+    # Growing and shrinking only change the tail of the value
+    last_page = b._mem.last_page
+    b.insert(1, bytes(value * 2), replace=True)
+    assert b.get(1) == value * 2
+    assert b._mem.last_page == last_page + 10
+    b.insert(1, bytes(value[:slice_size * 3]), replace=True)
+    assert b.get(1) == value[:slice_size * 3]
+    assert b._mem.last_page == last_page + 10
+    directory_page = b._root_node.get_entry(1).overflow_page
+    assert b._traverse_overflow(directory_page)[1] == pages[:3]
+
+    b.insert(1, b'foo', replace=True)
+    assert b.get(1) == b'foo'
+    b.insert(1, bytes(value), replace=True)
+    assert b.get(1) == value
+    assert b._mem.last_page == last_page + 10
+
+
 def test_getitem_tree(b):
     b.insert(1, b'foo')
     b.insert(2, b'bar')
@@ -107,12 +220,87 @@ def test_len_tree(b):
 
 def test_length_hint_tree():
     b = BPlusTree(filename, key_size=16, value_size=16, order=100)
-    assert b.__length_hint__() == 49
+    assert b.__length_hint__() == 0
     b.insert(1, b'foo')
-    assert b.__length_hint__() == 49
+    assert b.__length_hint__() == 1
     for i in range(2, 10001):
         b.insert(i, str(i).encode())
-    assert b.__length_hint__() == 7242
+    assert b.__length_hint__() == 10000
+    b.close()
+
+
+@pytest.mark.parametrize('order', [3, 4, 20])
+def test_order_statistics_tree(order):
+    b = BPlusTree(filename, key_size=16, value_size=16, order=order)
+    keys = list(range(0, 1000, 2))
+    shuffled = keys[1::2] + keys[::2][::-1]
+    for key in shuffled[:100]:
+        b.insert(key, b'')
+    b.batch_insert((k, b'') for k in range(1000, 1100))
+    for key in shuffled[100:]:
+        b.insert(key, b'')
+    b.insert(4, b'replaced', replace=True)
+    keys.extend(range(1000, 1100))
+
+    b.close()
+    b = BPlusTree(filename, key_size=16, value_size=16, order=order)
+
+    assert len(b) == len(keys) == 600
+    for i, key in enumerate(keys):
+        assert b.rank(key) == i
+        assert b.rank(key + 0.5) == i + 1
+        assert b.select(i) == key
+    assert b.rank(-1) == 0
+    assert b.select(-1) == 1099
+    with pytest.raises(IndexError):
+        b.select(600)
+    with pytest.raises(IndexError):
+        b.select(-601)
+
+    assert b.count_range() == 600
+    assert b.count_range(10, 20) == 5
+    assert b.count_range(None, 20) == 10
+    assert b.count_range(999) == 100
+    assert b.count_range(20, 10) == 0
+    b.close()
+
+
+def test_order_statistics_unknown_counts():
+    b = BPlusTree(filename, order=4)
+    keys = list(range(300))
+    random.Random(7).shuffle(keys)
+    for key in keys[:200]:
+        b.insert(key, b'')
+    for key in keys[:50]:
+        del b[key]
+    keys = sorted(keys[50:200])
+
+    # Ancestors of modified leaves forget their counts instead of being
+    # rewritten at every insert
+    assert b._root_node.subtree_count is None
+    b.insert(500, b'')
+    b.insert(501, b'')
+    with mock.patch.object(FileMemory, 'set_node', autospec=True,
+                           side_effect=FileMemory.set_node) as set_node:
+        del b[500]
+        del b[501]
+    assert set_node.call_count == 2
+
+    assert len(b) == 150
+    assert [b.select(i) for i in range(150)] == keys
+    assert [b.rank(key) for key in keys] == list(range(150))
+
+    # Counts are written back when the tree is checkpointed
+    b.checkpoint()
+    assert b._root_node.subtree_count == 150
+    b.insert(1000, b'')
+    b._mem._wal._fd.close()
+    b._mem._fd.close()
+
+    # Counts not written are recomputed after a crash
+    b = BPlusTree(filename, order=4)
+    assert len(b) == 151
+    assert b.select(-1) == 1000
     b.close()
 
 
@@ -221,6 +409,447 @@ def test_iter_slice(b):
         next(iter)
 
 
+def test_prefix_scan_str():
+    b = BPlusTree(filename, key_size=16, value_size=16, order=4,
+                  serializer=StrSerializer())
+    for tenant in (4, 41, 42, 420, 43):
+        for i in range(10):
+            key = 'tenant{}/{}'.format(tenant, i)
+            b.insert(key, key.encode())
+
+    expected = [('tenant42/{}'.format(i), 'tenant42/{}'.format(i).encode())
+                for i in range(10)]
+    assert list(b.prefix_scan('tenant42/')) == expected
+    assert len(list(b.prefix_scan('tenant42'))) == 20
+    assert len(list(b.prefix_scan(''))) == 50
+    assert list(b.prefix_scan('tenant5')) == []
+    assert list(b.prefix_scan('a')) == []
+    assert list(b.prefix_scan('z')) == []
+    b.close()
+
+
+def test_prefix_scan_bytes():
+    b = BPlusTree(filename, key_size=16, value_size=16, order=4,
+                  serializer=BytesSerializer())
+    keys = [b'\x00', b'a\xff', b'a\xff\x00', b'a\xff\xff', b'b', b'\xff\xff']
+    for key in keys:
+        b.insert(key, key)
+    assert [k for k, _ in b.prefix_scan(b'a\xff')] == keys[1:4]
+    assert [k for k, _ in b.prefix_scan(b'\xff')] == [b'\xff\xff']
+    b.close()
+
+
+def test_prefix_scan_uuid():
+    b = BPlusTree(filename, key_size=16, value_size=16, order=4,
+                  serializer=UUIDSerializer())
+    ids = sorted(uuid.UUID(int=(i << 120) + i) for i in range(20))
+    for id_ in ids:
+        b.insert(id_, b'')
+    assert [k for k, _ in b.prefix_scan(b'\x05')] == [ids[5]]
+    assert [k for k, _ in b.prefix_scan('05')] == [ids[5]]
+    assert len(list(b.prefix_scan(b''))) == 20
+    b.close()
+
+
+@pytest.mark.parametrize('serializer,keys', [
+    (SignedIntSerializer(), list(range(-500, 500, 3))),
+    (FloatSerializer(), [i / 7 for i in range(-500, 500, 3)]),
+])
+def test_order_preserving_serializers(serializer, keys):
+    b = BPlusTree(filename, order=5, serializer=serializer)
+    shuffled = list(keys)
+    random.Random(42).shuffle(shuffled)
+    for key in shuffled:
+        b.insert(key, str(key).encode())
+
+    assert list(b.keys()) == keys
+    assert b[keys[10]] == str(keys[10]).encode()
+    assert keys[10] + 1 not in b
+    assert b.rank(keys[100]) == 100
+    assert list(b.keys(slice(keys[5], keys[8]))) == keys[5:8]
+    del b[keys[0]]
+    assert b.select(0) == keys[1]
+    b.close()
+
+
+def test_prefix_scan_unsupported_serializer(b):
+    with pytest.raises(ValueError):
+        list(b.prefix_scan(1))
+
+
+def test_split_promotes_shortest_separator():
+    b = BPlusTree(filename, key_size=64, value_size=16, order=4,
+                  serializer=StrSerializer())
+    keys = ['{}/{}'.format(c * 30, i) for c in 'abcdef' for i in range(3)]
+    for key in keys:
+        b.insert(key, b'')
+
+    root = b._root_node
+    assert all(len(ref.key) == 1 for ref in root.entries)
+    assert list(b.keys()) == keys
+    for key in keys:
+        assert b.get(key) == b''
+    b.close()
+
+
+def test_leaves_filled_by_bytes():
+    b = BPlusTree(filename, key_size=8, value_size=512, order=1000)
+    for i in range(2000):
+        b.insert(i, b'v' * (i % 50))
+    b.insert(2000, b'x' * 600)
+    b.close()
+
+    b = BPlusTree(filename, key_size=8, value_size=512, order=1000)
+    node = b._left_record_node
+    assert len(node.entries) > 4096 // 528
+    for i in range(2000):
+        assert b.get(i) == b'v' * (i % 50)
+    assert b.get(2000) == b'x' * 600
+    assert len(b) == 2001
+    b.close()
+
+
+def data_frames(b):
+    """Frames of the WAL holding leaves and values."""
+    for page, frame in b._mem._wal._committed_pages.items():
+        # Page 0 holds the metadata, it is not a node
+        if page and isinstance(b._mem.get_node(page),
+                               (LeafNode, OverflowNode)):
+            yield frame
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma'])
+def test_compression_tree(compression):
+    value = b'{"name": "foo", "tags": ["bar", "baz"]}' * 200
+    b = BPlusTree(filename, compression=compression)
+    for i in range(100):
+        b.insert(i, value[:i])
+    b.insert(100, value)
+    assert all(length < 4096 for _, length in data_frames(b))
+    b.close()
+
+    b = BPlusTree(filename)
+    for i in range(100):
+        assert b.get(i) == value[:i]
+    assert b.get(100) == value
+    b.close()
+
+    # Without a codec, pages are written uncompressed
+    b = BPlusTree(filename)
+    for i in range(100):
+        b.insert(i, value[::-1][:i], replace=True)
+    b.insert(100, value[::-1], replace=True)
+    assert all(length == 4096 for _, length in data_frames(b))
+    b.close()
+
+
+def test_compression_tree_file_size():
+    sizes = dict()
+    for compression in (None, 'zlib'):
+        b = BPlusTree(filename, value_size=64, compression=compression)
+        b.batch_insert((i, b'value %d' % (i % 10) * 8) for i in range(5000))
+        b.close()
+        sizes[compression] = os.path.getsize(filename)
+        os.unlink(filename)
+
+    # Compressed pages are packed in the file instead of using a whole page
+    assert sizes['zlib'] < sizes[None] / 4
+
+
+def test_compact_compressed():
+    b = BPlusTree(filename, value_size=16, compression='zlib')
+    for key in range(2000):
+        b.insert(key, str(key).encode() if key % 50 else os.urandom(5000))
+    for key in range(0, 2000, 3):
+        del b[key]
+    expected = dict(b.items())
+    b.checkpoint()
+    size = os.path.getsize(filename)
+
+    reclaimed = b.compact()
+    assert reclaimed > 0
+    assert os.path.getsize(filename) == size - reclaimed
+    assert dict(b.items()) == expected
+    b.close()
+
+    b = BPlusTree(filename, value_size=16)
+    assert dict(b.items()) == expected
+    b.close()
+
+
+def leaf_pages(b):
+    node = b._left_record_node
+    pages = [node.page]
+    while node.next_page:
+        node = b._mem.get_node(node.next_page)
+        pages.append(node.page)
+    return pages
+
+
+@pytest.mark.parametrize('order', [3, 20])
+def test_compact(order):
+    b = BPlusTree(filename, order=order, value_size=16)
+    keys = list(range(0, 2000))
+    keys = keys[1::2] + keys[::2][::-1]
+    for key in keys:
+        b.insert(key, str(key).encode() if key % 50 else os.urandom(5000))
+    for key in range(0, 2000, 7):
+        b.insert(key, b'foo', replace=True)
+    expected = dict(b.items())
+    b.checkpoint()
+    size = os.path.getsize(filename)
+    assert b._mem.get_free_pages()
+    assert leaf_pages(b) != sorted(leaf_pages(b))
+
+    reclaimed = b.compact()
+    assert reclaimed > 0
+    assert os.path.getsize(filename) == size - reclaimed
+    assert os.path.getsize(filename) == (b._mem.last_page + 1) * 4096
+    assert b._mem.get_free_pages() == []
+    assert leaf_pages(b) == sorted(leaf_pages(b))
+    assert dict(b.items()) == expected
+    assert [b.select(i) for i in range(0, 2000, 100)] == list(range(0, 2000,
+                                                                    100))
+    b.close()
+
+    b = BPlusTree(filename, order=order, value_size=16)
+    assert dict(b.items()) == expected
+    b.insert(2000, b'bar')
+    assert len(b) == 2001
+    b.close()
+
+
+def test_compact_order_preserving_serializer():
+    b = BPlusTree(filename, order=4, key_size=16, value_size=16,
+                  serializer=StrSerializer())
+    keys = ['{:04}'.format(i) for i in range(300)]
+    random.Random(42).shuffle(keys)
+    for i, key in enumerate(keys):
+        b.insert(key, os.urandom(5000) if i % 20 == 0 else key.encode())
+    for key in keys[::9]:
+        del b[key]
+    expected = dict(b.items())
+
+    assert b.compact() > 0
+    assert dict(b.items()) == expected
+    b.close()
+
+
+def test_compact_small_tree(b):
+    assert b.compact() == 0
+    assert list(b.items()) == []
+
+    b.insert(1, b'foo')
+    b.insert(2, b'x' * 5000)
+    b.insert(2, b'bar', replace=True)
+    # Two pages of data and their directory
+    assert b.compact() == 3 * 4096
+    assert dict(b.items()) == {1: b'foo', 2: b'bar'}
+    assert isinstance(b._root_node, LonelyRootNode)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_vacuum(compression):
+    b = BPlusTree(filename, order=20, value_size=16, compression=compression)
+    keys = list(range(0, 2000))
+    keys = keys[1::2] + keys[::2][::-1]
+    for key in keys:
+        b.insert(key, str(key).encode() if key % 50 else os.urandom(5000))
+    for key in range(0, 2000, 7):
+        b.insert(key, b'foo', replace=True)
+    expected = dict(b.items())
+    b.checkpoint()
+    size = os.path.getsize(filename)
+
+    # Leftovers of an interrupted vacuum are ignored
+    with open(filename + '-vacuum', 'wb') as f:
+        f.write(b'garbage')
+
+    reclaimed = b.vacuum()
+    assert reclaimed > 0
+    assert os.path.getsize(filename) == size - reclaimed
+    assert not os.path.exists(filename + '-vacuum')
+    assert not os.path.exists(filename + '-vacuum-wal')
+    assert b._mem.get_free_pages() == []
+    assert leaf_pages(b) == sorted(leaf_pages(b))
+    assert dict(b.items()) == expected
+    b.insert(2000, b'bar')
+    b.close()
+
+    b = BPlusTree(filename, order=20, value_size=16)
+    expected[2000] = b'bar'
+    assert dict(b.items()) == expected
+    assert len(b) == 2001
+    b.close()
+
+
+def test_vacuum_small_tree():
+    b = BPlusTree(filename, compression='zlib')
+    b.vacuum()
+    assert list(b.items()) == []
+    b.insert(1, b'foo')
+    b.vacuum()
+    b.close()
+
+    b = BPlusTree(filename)
+    assert dict(b.items()) == {1: b'foo'}
+    assert isinstance(b._root_node, LonelyRootNode)
+    b.close()
+
+
+def leaf_sizes(b):
+    return [len(b._mem.get_node(page).entries) for page in leaf_pages(b)]
+
+
+@pytest.mark.parametrize('split_policy,keys,min_fill', [
+    ('balanced', range(1000), 0.5),
+    ('append', range(1000), 0.9),
+    ('adaptive', range(1000), 0.9),
+    ('adaptive', range(1000, 0, -1), 0.9),
+])
+def test_split_policy(split_policy, keys, min_fill):
+    b = BPlusTree(filename, order=20, split_policy=split_policy)
+    for key in keys:
+        b.insert(key, str(key).encode())
+    assert list(b.keys()) == sorted(keys)
+    assert len(b) == 1000
+    assert [b.select(i) for i in range(0, 1000, 100)] == sorted(keys)[::100]
+
+    # All leaves but the last one written are at least filled as expected
+    sizes = leaf_sizes(b)
+    filled = sum(size >= round(19 * min_fill) for size in sizes)
+    assert filled >= len(sizes) - 1
+    if min_fill < 0.9:
+        assert max(sizes[:-1]) < round(19 * 0.9)
+    b.close()
+
+
+@pytest.mark.parametrize('split_policy', ['balanced', 'append', 'adaptive'])
+def test_split_policy_random_inserts(split_policy):
+    keys = list(range(1000))
+    keys = keys[1::2] + keys[::2][::-1]
+    b = BPlusTree(filename, order=5, split_policy=split_policy,
+                  fill_factor=1)
+    for key in keys:
+        b.insert(key, str(key).encode())
+    b.close()
+
+    b = BPlusTree(filename, order=5)
+    assert list(b.keys()) == list(range(1000))
+    assert b.count_range(100, 200) == 100
+    b.close()
+
+
+def test_split_policy_variable_length():
+    b = BPlusTree(filename, order=100, value_size=1000,
+                  split_policy='append', fill_factor=1)
+    for key in range(200):
+        b.insert(key, b'x' * (1000 if key % 10 == 0 else 10))
+    b.close()
+
+    b = BPlusTree(filename, order=100, value_size=1000)
+    assert [len(b.get(key)) for key in range(0, 200, 5)] == [
+        1000 if key % 10 == 0 else 10 for key in range(0, 200, 5)
+    ]
+    b.close()
+
+
+def test_split_policy_invalid():
+    with pytest.raises(ValueError):
+        BPlusTree(filename, split_policy='foo')
+    with pytest.raises(ValueError):
+        BPlusTree(filename, fill_factor=0.4)
+
+
+def test_delete(b):
+    for i in range(100):
+        b.insert(i, str(i).encode())
+
+    for i in range(0, 100, 3):
+        b.delete(i)
+    del b[1]
+    with pytest.raises(KeyError):
+        b.delete(3)
+    with pytest.raises(KeyError):
+        del b[200]
+
+    keys = [i for i in range(2, 100) if i % 3]
+    assert list(b.keys()) == keys
+    assert len(b) == len(keys)
+    assert b.rank(50) == keys.index(50)
+    assert b.select(10) == keys[10]
+    assert 3 not in b
+
+    # Emptied leaves still take new keys
+    for i in keys:
+        b.delete(i)
+    assert len(b) == 0
+    b.insert(42, b'42')
+    assert list(b.items()) == [(42, b'42')]
+
+
+def test_delete_overflow():
+    b = BPlusTree(filename, value_size=16)
+    b.insert(1, b'1' * 10000)
+    last_page = b._mem.last_page
+    b.delete(1)
+    assert b.get(1) is None
+    b.insert(2, b'2' * 10000)
+    assert b._mem.last_page == last_page
+    b.close()
+
+
+def test_batch_insert_fills_leaves():
+    b = BPlusTree(filename, order=20)
+    b.batch_insert((key, str(key).encode()) for key in range(1000))
+    assert all(size >= 17 for size in leaf_sizes(b)[:-1])
+    b.close()
+
+
+def test_insert_in_last_leaf():
+    b = BPlusTree(filename, order=20)
+    for i in range(1, 96):
+        b.insert(i, str(i).encode())
+
+    low, high, path, page = b._last_leaf
+    assert low <= 95 and high is None
+    assert path[0] == (b._root_node_page, len(b._root_node.entries))
+    assert page == leaf_pages(b)[-1]
+
+    # Keys within the bounds of the last leaf do not go through the root
+    with mock.patch.object(BPlusTree, '_root_node',
+                           new_callable=mock.PropertyMock) as mock_root:
+        b.insert(96, b'96')
+        with pytest.raises(ValueError):
+            b.insert(96, b'96')
+        b.insert(96, b'foo', replace=True)
+    assert not mock_root.called
+    assert b._last_leaf[2:] == (path, page)
+
+    # Other keys and splits change the last leaf
+    b.insert(0, b'0')
+    assert b._last_leaf[0] is None
+    for i in range(97, 200):
+        b.insert(i, str(i).encode())
+    assert b._last_leaf is None or b._last_leaf[3] == leaf_pages(b)[-1]
+
+    assert list(b.keys()) == list(range(200))
+    assert len(b) == 200
+    assert b.rank(150) == 150
+    assert b[96] == b'foo'
+    b.close()
+
+
+def test_insert_in_last_leaf_after_compact(b):
+    for i in range(100):
+        b.insert(i, str(i).encode())
+    b.compact()
+    for i in range(100, 200):
+        b.insert(i, str(i).encode())
+    assert list(b.keys()) == list(range(200))
+    assert len(b) == 200
+
+
 def test_checkpoint(b):
     b.checkpoint()
     b.insert(1, b'foo')
@@ -232,6 +861,79 @@ def test_checkpoint(b):
     assert not b._mem._wal._committed_pages
 
 
+def test_checkpoint_in_transaction(b):
+    with b.transaction():
+        b.insert(1, b'foo')
+        with pytest.raises(ValueError):
+            b.checkpoint()
+    assert b[1] == b'foo'
+
+
+@pytest.mark.parametrize('method', ['compact', 'vacuum'])
+def test_rewrite_in_transaction(b, method):
+    with b.transaction():
+        for i in range(100):
+            b.insert(i, b'foo')
+        with pytest.raises(ValueError):
+            getattr(b, method)()
+    assert len(b) == 100
+    assert list(b.keys()) == list(range(100))
+
+
+def test_transaction(b):
+    with mock.patch('bplustree.memory.fsync_file_and_dir') as fsync:
+        with b.transaction() as tree:
+            for i in range(100):
+                tree.insert(i, str(i).encode())
+            with b.transaction():
+                b.insert(100, b'foo')
+            del b[0]
+            assert len(b) == 100
+    assert fsync.call_count == 1
+    assert list(b.keys()) == list(range(1, 101))
+
+
+def test_transaction_rollback():
+    b = BPlusTree(filename, order=4)
+    b.insert(1, b'foo')
+    root_node_page = b._root_node_page
+
+    with pytest.raises(ValueError):
+        with b.transaction():
+            b.batch_insert((i, b'bar') for i in range(2, 100))
+            assert b._root_node_page != root_node_page
+            raise ValueError('Foo')
+
+    assert b._root_node_page == root_node_page
+    assert list(b.items()) == [(1, b'foo')]
+    b.insert(2, b'baz')
+    b.close()
+
+    b = BPlusTree(filename, order=4)
+    assert list(b.items()) == [(1, b'foo'), (2, b'baz')]
+    b.close()
+
+
+def test_write_leaves_read_nodes_unchanged():
+    b = BPlusTree(filename, order=4)
+    b.batch_insert((i, b'foo') for i in range(10))
+    nodes = [b._mem.get_node(page) for page in b._get_tree_pages()]
+    dumps = [bytes(node.dump()) for node in nodes]
+
+    # Nodes read from the cache are copied before being modified, an
+    # aborted write does not leave uncommitted changes in them
+    with pytest.raises(ValueError):
+        with b.transaction():
+            b.insert(100, b'bar')
+            b.insert(3, b'baz', replace=True)
+            del b[5]
+            raise ValueError('Foo')
+
+    assert [bytes(node.dump()) for node in nodes] == dumps
+    assert list(b.items()) == [(i, b'foo') for i in range(10)]
+    b.close()
+
+
 def test_left_record_node_in_tree():
     b = BPlusTree(filename, order=3)
     assert b._left_record_node == b._root_node
@@ -329,16 +1031,40 @@ def test_overflow(b):
     with b._mem.read_transaction:
         assert b._read_from_overflow(first_overflow_page) == data
 
-    assert b._mem.last_page == 81
+    # 80 pages of data and their directory
+    assert b._mem.last_page == 82
+    assert first_overflow_page == 82
 
     with b._mem.write_transaction:
         b._delete_overflow(first_overflow_page)
 
     with b._mem.write_transaction:
-        for i in range(81, 2, -1):
+        for i in range(82, 2, -1):
             assert b._mem.next_available_page == i
 
 
+def test_overflow_directory_levels():
+    b = BPlusTree(filename, page_size=64, value_size=16)
+    slice_size = b.OverflowDirectoryNode().slice_size
+    max_children = b.OverflowDirectoryNode().max_children
+    assert max_children == 10
+
+    for num_slices, level in ((10, 0), (11, 1), (100, 1), (101, 2)):
+        data = os.urandom(slice_size * num_slices)
+        with b._mem.write_transaction:
+            directory_page = b._create_overflow(data)
+            directory = b._mem.get_node(directory_page)
+            assert directory.level == level
+            assert directory.length == len(data)
+            directories, pages = b._traverse_overflow(directory_page)
+            assert len(pages) == num_slices
+            assert b._read_from_overflow(directory_page) == data
+            b._delete_overflow(directory_page)
+            assert b._mem.next_available_page == directories[0].page
+
+    b.close()
+
+
 def test_batch_insert(b):
     def generate(from_, to):
         for i in range(from_, to):
@@ -355,6 +1081,42 @@ def test_batch_insert(b):
     assert i == 2000
 
 
+def test_batch_insert_after_delete(b):
+    b.batch_insert((i, str(i).encode()) for i in range(100))
+    for i in range(50, 100):
+        b.delete(i)
+
+    # Keys go to the leaves emptied by deletes
+    b.batch_insert((i, str(i).encode()) for i in range(60, 200))
+    assert list(b.keys()) == list(range(50)) + list(range(60, 200))
+    for i in (0, 60, 80, 199):
+        assert b[i] == str(i).encode()
+    assert len(b) == 190
+
+
+def test_values_where():
+    b = BPlusTree(filename, value_size=16)
+    for i in range(100):
+        b.insert(i, str(i).encode())
+    b.insert(100, b'1' * 1000)
+
+    def where(value):
+        return bytes(value).startswith(b'1')
+
+    assert list(b.values(where=where)) == [
+        str(i).encode() for i in range(100) if str(i).startswith('1')
+    ] + [b'1' * 1000]
+    assert list(b.items(slice(20, 30), where=where)) == []
+
+    values = list(b.values(raw=True))
+    assert isinstance(values[0], memoryview)
+    assert values == list(b.values())
+    assert dict(b.items(slice(10, 13), where=where)) == {
+        10: b'10', 11: b'11', 12: b'12'
+    }
+    b.close()
+
+
 def test_batch_insert_no_in_order(b):
     with pytest.raises(ValueError):
         b.batch_insert([(2, b'2'), (1, b'1')])
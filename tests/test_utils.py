@@ -1,6 +1,14 @@
+import io
+
 import pytest
 
-from bplustree.utils import pairwise, iter_slice
+from bplustree.utils import (
+    pairwise, iter_slice, read_exactly, iter_stream_slice, prefix_successor,
+    bisect_key_bytes, common_prefix
+)
+from bplustree.entry import Record
+from bplustree.const import TreeConf
+from bplustree.serializer import StrSerializer
 
 
 def test_pairwise():
@@ -26,3 +34,66 @@ def test_iter_slice():
     assert next(i) == (b'456', True)
     with pytest.raises(StopIteration):
         next(i)
+
+
+class ChunkedReader(io.RawIOBase):
+    """Binary stream returning at most 2 bytes per read."""
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._data.read(min(len(buffer), 2))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def test_read_exactly():
+    f = ChunkedReader(b'12345')
+    assert read_exactly(f, 3) == b'123'
+    assert read_exactly(f, 3) == b'45'
+    assert read_exactly(f, 3) == b''
+
+
+def test_iter_stream_slice():
+    i = iter_stream_slice(ChunkedReader(b'23456'), 3, head=b'1')
+    assert next(i) == (b'123', False)
+    assert next(i) == (b'456', True)
+    with pytest.raises(StopIteration):
+        next(i)
+
+    i = iter_stream_slice(ChunkedReader(b'12345'), 3)
+    assert list(i) == [(b'123', False), (b'45', True)]
+
+    i = iter_stream_slice(ChunkedReader(b''), 3, head=b'12')
+    assert list(i) == [(b'12', True)]
+
+
+def test_prefix_successor():
+    assert prefix_successor(b'ab') == b'ac'
+    assert prefix_successor(b'a\xff') == b'b'
+    assert prefix_successor(b'a\xff\xff') == b'b'
+    assert prefix_successor(b'\xff') is None
+    assert prefix_successor(b'') is None
+
+
+def test_bisect_key_bytes():
+    tree_conf = TreeConf(4096, 4, 16, 16, StrSerializer())
+    entries = [Record(tree_conf, k, b'') for k in ('a', 'b', 'b', 'd')]
+    entries = [Record(tree_conf, data=e.dump()) for e in entries]
+    assert bisect_key_bytes(entries, b'') == 0
+    assert bisect_key_bytes(entries, b'b') == 1
+    assert bisect_key_bytes(entries, b'b', right=True) == 3
+    assert bisect_key_bytes(entries, b'c') == 3
+    assert bisect_key_bytes(entries, b'e') == 4
+
+
+def test_common_prefix():
+    assert common_prefix([]) == b''
+    assert common_prefix([b'abc']) == b'abc'
+    assert common_prefix([b'abd', b'abc', b'abcd']) == b'ab'
+    assert common_prefix([b'abc', b'ab']) == b'ab'
+    assert common_prefix([b'abc', b'xyz']) == b''